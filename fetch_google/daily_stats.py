@@ -0,0 +1,336 @@
+"""
+Daily statistics rollup: entry count, sensor names and newest TimeStamp per
+(Owner, MAC_address, Exp_name, day), the statistics the fetch_google notebook used to compute
+with full scans of every table. process_files adds the rows of each successful table insert,
+and the notebook reads the rollup instead of querying the tables.
+This file is shared by process_files and fetch_google and must be kept identical in both.
+
+The statistics of an owner/MAC are one document of the state store (state_store.py, kept
+identical in both directories): {"days": {exp_name: {day: stats}}, "applied": {delta_id: time}}.
+Each delta recorded with an ID (process_files uses the file and batch the rows come from) is
+added once: the IDs applied in the last DAILY_STATS_APPLIED_TTL seconds are kept with the
+statistics, so a retried event does not count its rows again.
+
+Backend selected with DAILY_STATS_BACKEND:
+  "gcs"    - in DAILY_STATS_BUCKET (default STATE_BUCKET), shared by all instances; the default
+             when a bucket is set
+  "memory" - in-process, for tests and offline runs
+  "none"   - disabled, the default without a bucket
+
+    python daily_stats.py [--backend BACKEND] [--bucket BUCKET] show [--owner OWNER ...]
+        Prints the per-experiment statistics of the rollup.
+
+    python daily_stats.py [--backend BACKEND] [--bucket BUCKET] check (--local-dir DIR | --project PROJECT) [--owner OWNER ...] [--repair]
+        Compares the rollup with a raw scan of the tables: the newline-delimited JSON files of
+        the "local" ingestion backend of process_files in DIR, or the BigQuery tables (which
+        scans them, at the cost the rollup avoids). --repair replaces the entries of the
+        owner/MACs that differ with the raw-scan values, which also backfills history
+        inserted before the rollup existed.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import state_store
+
+DAILY_STATS_BUCKET = os.environ.get("DAILY_STATS_BUCKET", state_store.STATE_BUCKET)
+DAILY_STATS_BACKEND = state_store.default_backend(os.environ.get("DAILY_STATS_BACKEND"), DAILY_STATS_BUCKET)
+# Storage triggers are retried for up to 7 days
+DAILY_STATS_APPLIED_TTL = int(os.environ.get("DAILY_STATS_APPLIED_TTL", 7 * 24 * 3600))
+
+# Newest timestamps are stored in this format, which sorts as text
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+_store = state_store.StateStore("daily_stats", DAILY_STATS_BACKEND, DAILY_STATS_BUCKET)
+
+
+# Selects the backend and bucket, e.g. in the notebook or from the command line
+def configure(backend=None, bucket=None):
+    global _store
+    bucket = bucket or DAILY_STATS_BUCKET
+    _store = state_store.StateStore("daily_stats", state_store.default_backend(backend, bucket), bucket)
+
+
+def enabled():
+    return _store.enabled
+
+
+# Converts a TimeStamp value (datetime or ISO string, as flattened by process_files) to UTC
+# TIMESTAMP_FORMAT, or None when it cannot be parsed
+def normalize_timestamp(value):
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value).replace("Z", "+00:00").replace(" ", "T"))
+        except ValueError:
+            return None
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+# Aggregates flattened rows of one table into {(exp_name, day): stats}, where stats is
+# {"num_entries", "sensors" (set of SensorData_Name), "last_timestamp"}.
+# Rows without an experiment or a TimeStamp are counted under "".
+def rollup_rows(rows):
+    rollup = {}
+    for row in rows:
+        timestamp = normalize_timestamp(row.get("TimeStamp"))
+        key = (row.get("ExperimentData_Exp_name") or "", timestamp[:10] if timestamp else "")
+        stats = rollup.get(key)
+        if stats is None:
+            stats = rollup[key] = {"num_entries": 0, "sensors": set(), "last_timestamp": None}
+        stats["num_entries"] += 1
+        if row.get("SensorData_Name") is not None:
+            stats["sensors"].add(row["SensorData_Name"])
+        if timestamp and (stats["last_timestamp"] is None or timestamp > stats["last_timestamp"]):
+            stats["last_timestamp"] = timestamp
+    return rollup
+
+
+# Adds the stats of a delta to the current stats of the same key
+def merge_stats(current, delta):
+    if current is None:
+        return {"num_entries": delta["num_entries"], "sensors": set(delta["sensors"]),
+                "last_timestamp": delta["last_timestamp"]}
+    last_timestamps = [t for t in (current["last_timestamp"], delta["last_timestamp"]) if t]
+    return {
+        "num_entries": current["num_entries"] + delta["num_entries"],
+        "sensors": set(current["sensors"]) | set(delta["sensors"]),
+        "last_timestamp": max(last_timestamps) if last_timestamps else None,
+    }
+
+
+def _to_json(stats):
+    return {"num_entries": stats["num_entries"], "sensors": sorted(stats["sensors"]),
+            "last_timestamp": stats["last_timestamp"]}
+
+
+def _from_json(stats):
+    return {"num_entries": stats["num_entries"], "sensors": set(stats["sensors"]),
+            "last_timestamp": stats["last_timestamp"]}
+
+
+def _days(document):
+    return (document or {}).get("days", {})
+
+
+# Adds the rollup of newly inserted rows ({(exp_name, day): stats}) to an owner/MAC. A delta with
+# a delta_id already applied is skipped. Returns False when the update could not be written
+# because other writers kept changing the statistics of the owner/MAC.
+def record_daily_stats(owner, mac_address, rollup, delta_id=None):
+    if not _store.enabled or not rollup:
+        return True
+
+    def add(document):
+        document = document or {"days": {}, "applied": {}}
+        now = time.time()
+        applied = {key: applied_at for key, applied_at in document.get("applied", {}).items()
+                   if applied_at >= now - DAILY_STATS_APPLIED_TTL}
+        if delta_id is not None and delta_id in applied:
+            return None
+        days = document.setdefault("days", {})
+        for (exp_name, day), stats in rollup.items():
+            exp_days = days.setdefault(exp_name, {})
+            current = _from_json(exp_days[day]) if day in exp_days else None
+            exp_days[day] = _to_json(merge_stats(current, stats))
+        if delta_id is not None:
+            applied[delta_id] = now
+        document["applied"] = applied
+        return document
+
+    return _store.update(f"{owner}/{mac_address}", add)
+
+
+# Replaces all the statistics of an owner/MAC, keeping the IDs of the deltas already applied
+def replace_daily_stats(owner, mac_address, rollup):
+    if not _store.enabled:
+        return True
+
+    def replace(document):
+        days = {}
+        for (exp_name, day), stats in rollup.items():
+            days.setdefault(exp_name, {})[day] = _to_json(stats)
+        return {"days": days, "applied": (document or {}).get("applied", {})}
+
+    return _store.update(f"{owner}/{mac_address}", replace)
+
+
+def _entries(stats_by_key):
+    return [
+        {"owner": owner, "mac_address": mac_address, "exp_name": exp_name, "date": day,
+         "num_entries": stats["num_entries"], "sensors": sorted(stats["sensors"]),
+         "last_timestamp": stats["last_timestamp"]}
+        for (owner, mac_address, exp_name, day), stats in sorted(stats_by_key.items())
+    ]
+
+
+# Returns the rollup entries, one dict per owner, MAC, experiment and day:
+# {"owner", "mac_address", "exp_name", "date", "num_entries", "sensors", "last_timestamp"}
+def read_daily_stats(owners=None):
+    if not _store.enabled:
+        return []
+    keys = [key for prefix in ([f"{owner}/" for owner in owners] if owners is not None else [""])
+            for key in _store.keys(prefix)]
+    stats_by_key = {}
+    for key, document in _store.get_many(keys).items():
+        owner, mac_address = key.split("/", 1)
+        for exp_name, days in _days(document).items():
+            for day, stats in days.items():
+                stats_by_key[(owner, mac_address, exp_name, day)] = _from_json(stats)
+    return _entries(stats_by_key)
+
+
+# Rows of the notebook's query_combined_data for all tables: distinct sensors, entries and
+# newest TimeStamp per dataset (owner), table (MAC) and experiment
+def combined_stats(entries):
+    combined = {}
+    for entry in entries:
+        key = (entry["owner"], entry["mac_address"], entry["exp_name"])
+        combined[key] = merge_stats(combined.get(key), {
+            "num_entries": entry["num_entries"], "sensors": entry["sensors"], "last_timestamp": entry["last_timestamp"]})
+    return [
+        {"dataset_id": owner, "table_id": mac_address, "ExperimentData_Exp_name": exp_name,
+         "sensor_count": len(stats["sensors"]), "num_entries": stats["num_entries"],
+         "last_timestamp": stats["last_timestamp"]}
+        for (owner, mac_address, exp_name), stats in sorted(combined.items())
+    ]
+
+
+# Rows of the notebook's query_daily_data for all tables: entries per dataset, table and day
+def daily_counts(entries):
+    counts = {}
+    for entry in entries:
+        key = (entry["owner"], entry["mac_address"], entry["date"])
+        counts[key] = counts.get(key, 0) + entry["num_entries"]
+    return [
+        {"dataset_id": owner, "table_id": mac_address, "date": day, "num_entries": num_entries}
+        for (owner, mac_address, day), num_entries in sorted(counts.items())
+    ]
+
+
+# Raw scan of flattened rows, {(owner, mac_address): rows}, into entries like read_daily_stats
+def scan_rows(rows_by_table):
+    stats_by_key = {}
+    for (owner, mac_address), rows in rows_by_table.items():
+        for (exp_name, day), stats in rollup_rows(rows).items():
+            stats_by_key[(owner, mac_address, exp_name, day)] = stats
+    return _entries(stats_by_key)
+
+
+# Raw scan of the files written by the "local" ingestion backend of process_files
+# (LOCAL_INGEST_DIR/<project>.<owner>.<mac_address>.json)
+def scan_local_dir(local_dir, owners=None):
+    rows_by_table = {}
+    for name in sorted(os.listdir(local_dir)):
+        if not name.endswith(".json") or name.count(".") != 3:
+            continue
+        _, owner, mac_address, _ = name.split(".")
+        if owners is not None and owner not in owners:
+            continue
+        with open(os.path.join(local_dir, name), encoding="utf-8") as f:
+            rows_by_table[(owner, mac_address)] = [json.loads(line) for line in f if line.strip()]
+    return scan_rows(rows_by_table)
+
+
+# Raw scan of the BigQuery tables, one GROUP BY query per table
+def scan_bigquery(client, owners=None):
+    stats_by_key = {}
+    for dataset in client.list_datasets():
+        owner = dataset.dataset_id
+        if owners is not None and owner not in owners:
+            continue
+        for table in client.list_tables(owner):
+            query = f"""
+            SELECT
+              IFNULL(ExperimentData_Exp_name, '') AS exp_name,
+              IFNULL(CAST(DATE(TimeStamp) AS STRING), '') AS day,
+              COUNT(*) AS num_entries,
+              ARRAY_AGG(DISTINCT SensorData_Name IGNORE NULLS) AS sensors,
+              MAX(TimeStamp) AS last_timestamp
+            FROM `{client.project}.{owner}.{table.table_id}`
+            GROUP BY exp_name, day
+            """
+            for row in client.query(query).result():
+                stats_by_key[(owner, table.table_id, row["exp_name"], row["day"])] = {
+                    "num_entries": row["num_entries"], "sensors": set(row["sensors"] or []),
+                    "last_timestamp": normalize_timestamp(row["last_timestamp"])}
+    return _entries(stats_by_key)
+
+
+# Returns the differences between rollup entries and raw-scan entries:
+# [{"owner", "mac_address", "exp_name", "date", "rollup", "raw"}], None for a missing side
+def compare(rollup_entries, raw_entries):
+    def by_key(entries):
+        return {(e["owner"], e["mac_address"], e["exp_name"], e["date"]): e for e in entries}
+
+    rollup, raw = by_key(rollup_entries), by_key(raw_entries)
+    differences = []
+    for key in sorted(rollup.keys() | raw.keys()):
+        values = []
+        for entries in (rollup, raw):
+            entry = entries.get(key)
+            values.append(None if entry is None else
+                          {"num_entries": entry["num_entries"], "sensors": entry["sensors"],
+                           "last_timestamp": entry["last_timestamp"]})
+        if values[0] != values[1]:
+            owner, mac_address, exp_name, day = key
+            differences.append({"owner": owner, "mac_address": mac_address, "exp_name": exp_name,
+                                "date": day, "rollup": values[0], "raw": values[1]})
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", help="Rollup backend, default DAILY_STATS_BACKEND")
+    parser.add_argument("--bucket", help="Bucket of the gcs backend, default DAILY_STATS_BUCKET")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("show")
+    show.add_argument("--owner", action="append", help="Only this owner (dataset), repeatable")
+    check = commands.add_parser("check")
+    source = check.add_mutually_exclusive_group(required=True)
+    source.add_argument("--local-dir", help="LOCAL_INGEST_DIR of the local ingestion backend")
+    source.add_argument("--project", help="Scan the BigQuery tables of this project")
+    check.add_argument("--owner", action="append", help="Only this owner (dataset), repeatable")
+    check.add_argument("--repair", action="store_true", help="Replace differing owner/MACs with the raw scan")
+    args = parser.parse_args()
+
+    if args.backend or args.bucket:
+        configure(args.backend, args.bucket)
+    rollup_entries = read_daily_stats(args.owner)
+    if args.command == "show":
+        for row in combined_stats(rollup_entries):
+            print(json.dumps(row))
+        return
+
+    if args.local_dir:
+        raw_entries = scan_local_dir(args.local_dir, args.owner)
+    else:
+        from google.cloud import bigquery
+
+        raw_entries = scan_bigquery(bigquery.Client(project=args.project), args.owner)
+
+    differences = compare(rollup_entries, raw_entries)
+    for difference in differences:
+        print(json.dumps(difference))
+    print(f"{len(differences)} differences over {len(raw_entries)} raw-scan entries and "
+          f"{len(rollup_entries)} rollup entries.")
+
+    if args.repair and differences:
+        tables = sorted({(d["owner"], d["mac_address"]) for d in differences})
+        for owner, mac_address in tables:
+            replaced = replace_daily_stats(owner, mac_address, {
+                (e["exp_name"], e["date"]): {"num_entries": e["num_entries"], "sensors": set(e["sensors"]),
+                                             "last_timestamp": e["last_timestamp"]}
+                for e in raw_entries if (e["owner"], e["mac_address"]) == (owner, mac_address)
+            })
+            if not replaced:
+                print(f"Could not replace the statistics of {owner}/{mac_address}, they kept changing: run again.")
+        print(f"Replaced the statistics of {len(tables)} owner/MACs.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""
+Local incremental cache of the sensor tables, for analysis without querying BigQuery again.
+
+    python sensor_cache.py sync [--project iucc-f4d] [--credentials read_BQ.json] [--dataset OWNER ...]
+                                [--table MAC ...] [--cache-dir DIR] [--max-workers 4]
+    python sensor_cache.py info [--cache-dir DIR]
+
+Each owner/MAC table is mirrored as Parquet files partitioned by experiment and day:
+
+    <cache dir>/<owner>/<mac>/exp=<Exp_name>/date=<YYYY-MM-DD>/part-<sync or compaction id>.parquet
+    <cache dir>/<owner>/<mac>/_sync.json
+
+A sync fetches the rows with an InsertDate up to SENSOR_CACHE_DELAY_MINUTES ago, so rows still
+being streamed are left for the next sync, and after the watermark of the table (_sync.json)
+minus SENSOR_CACHE_OVERLAP_MINUTES: rows whose InsertDate was taken before the watermark but
+that became visible after it are not missed. The UniqueIDs of the rows cached within the overlap
+are kept in _sync.json, and the rows read again are dropped by UniqueID (rows without one are
+only taken after the watermark). The watermark then moves to the cutoff. Files of a sync are
+only read once the sync is recorded in _sync.json, and files of an interrupted sync are removed
+by the next one, so rows are never read twice.
+
+The tables are partitioned on TimeStamp, so a sync also bounds TimeStamp from
+SENSOR_CACHE_MAX_UPLOAD_LAG_DAYS before its window and BigQuery scans only the recent partitions:
+readings a device uploads later than that are not cached. After a sync, the part files of each
+experiment and day with SENSOR_CACHE_COMPACT_PARTS files or more are merged into one.
+
+update-labels rewrites the labels of rows already cached. Its incremental runs move the
+labels_watermark label of the table: when a sync finds it moved, the experiments with rows
+inserted since the previous labels watermark (minus the overlap) are marked stale in _sync.json,
+their files removed and their rows fetched again. A full rewrite of the labels
+(LABELS_MODE=full) does not move the label; remove the directory of the table after one, so the
+next sync fetches it again.
+
+load_sensor_data reads the cache for the notebook's plots: only the files of the requested
+experiments and days are opened, memory-mapped, and only the requested columns are read.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import quote, unquote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+PROJECT = "iucc-f4d"
+SENSOR_CACHE_DIR = os.environ.get(
+    "SENSOR_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sensor_cache"))
+SENSOR_CACHE_MAX_WORKERS = int(os.environ.get("SENSOR_CACHE_MAX_WORKERS", 4))
+# Rows inserted in the last minutes may not be visible to queries yet
+SENSOR_CACHE_DELAY = timedelta(minutes=int(os.environ.get("SENSOR_CACHE_DELAY_MINUTES", 5)))
+# Window before the watermark read again by every sync, for rows that became visible late.
+# Also covers the overlap update-labels reads before its own watermark (10 minutes by default).
+SENSOR_CACHE_OVERLAP = timedelta(minutes=int(os.environ.get("SENSOR_CACHE_OVERLAP_MINUTES", 30)))
+# Longest a device keeps readings before uploading them. The tables are partitioned on TimeStamp:
+# a sync only reads the partitions from this long before its InsertDate window, so BigQuery does
+# not bill a scan of the whole table. Readings uploaded later than that are not cached.
+SENSOR_CACHE_MAX_UPLOAD_LAG = timedelta(days=int(os.environ.get("SENSOR_CACHE_MAX_UPLOAD_LAG_DAYS", 30)))
+# Part files of an experiment and day merged into one after a sync, once there are this many
+SENSOR_CACHE_COMPACT_PARTS = int(os.environ.get("SENSOR_CACHE_COMPACT_PARTS", 2))
+
+# Table label of the InsertDate watermark of the update-labels incremental runs
+# (WATERMARK_LABEL in update-labels/main.py)
+LABELS_WATERMARK_LABEL = "labels_watermark"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Partition value of rows without an experiment or a TimeStamp
+NULL_PARTITION = "__null__"
+SYNC_FILE = "_sync.json"
+
+# The TimeStamp bound prunes the partitions; rows without a TimeStamp are in the NULL partition
+SYNC_QUERY = """
+SELECT *
+FROM `{table}`
+WHERE InsertDate > @window_start AND InsertDate <= @cutoff
+  AND (TimeStamp >= @timestamp_start OR TimeStamp IS NULL)
+"""
+
+# Rows of the stale experiments, up to the watermark of the cache, from their first cached day
+REFETCH_QUERY = """
+SELECT *
+FROM `{table}`
+WHERE (ExperimentData_Exp_name IN UNNEST(@experiments) OR (@null_experiment AND ExperimentData_Exp_name IS NULL))
+  AND InsertDate <= @cutoff
+  AND (TimeStamp >= @timestamp_start OR TimeStamp IS NULL)
+"""
+
+
+def table_dir(cache_dir, owner, mac_address):
+    return os.path.join(cache_dir, quote(owner, safe=""), quote(mac_address, safe=""))
+
+
+# Returns {"watermark": ISO timestamp, "syncs": [sync ids], "rows": rows cached,
+#          "recent_ids": {UniqueID: InsertDate} of the rows cached within the overlap,
+#          "labels_watermark": label of the table at the last sync (missing before the first one),
+#          "stale_experiments": [names],
+#          "compactions": {merged file id: [sync ids of the parts it replaces]} until these are removed}
+def read_sync_state(directory):
+    try:
+        with open(os.path.join(directory, SYNC_FILE), encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {"watermark": EPOCH.isoformat(), "syncs": [], "rows": 0}
+    # Caches written before the overlap and the labels check
+    state.setdefault("recent_ids", {})
+    state.setdefault("stale_experiments", [])
+    state.setdefault("compactions", {})
+    return state
+
+
+def write_sync_state(directory, state):
+    path = os.path.join(directory, SYNC_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def _sync_id(name):
+    return os.path.basename(name)[len("part-"):-len(".parquet")]
+
+
+# Yields (experiment, day, path) of the part files of a table, recorded syncs only. In a day
+# directory holding the file of a recorded compaction, the parts it replaces are skipped.
+def iter_parts(directory, syncs, compactions=None):
+    syncs = set(syncs)
+    if not os.path.isdir(directory):
+        return
+    for exp_dir in sorted(os.listdir(directory)):
+        if not exp_dir.startswith("exp="):
+            continue
+        for date_dir in sorted(os.listdir(os.path.join(directory, exp_dir))):
+            recorded = [name for name in sorted(os.listdir(os.path.join(directory, exp_dir, date_dir)))
+                        if name.startswith("part-") and _sync_id(name) in syncs]
+            replaced = {sync_id for name in recorded for sync_id in (compactions or {}).get(_sync_id(name), ())}
+            for name in recorded:
+                if _sync_id(name) not in replaced:
+                    yield unquote(exp_dir[len("exp="):]), date_dir[len("date="):], \
+                        os.path.join(directory, exp_dir, date_dir, name)
+
+
+# Removes the part files of syncs that were interrupted before being recorded, and the parts
+# replaced by recorded compactions
+def remove_unrecorded_parts(directory, syncs, compactions=None):
+    recorded = {path for _, _, path in iter_parts(directory, syncs, compactions)}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.startswith("part-") and path not in recorded:
+                os.remove(path)
+
+
+def _exp_dir(directory, exp_name):
+    return os.path.join(directory, f"exp={quote(exp_name if exp_name is not None else NULL_PARTITION, safe='')}")
+
+
+# Keeps the first row of each UniqueID and drops the rows of the UniqueIDs in known_ids.
+# Rows without a UniqueID are kept.
+def drop_duplicate_rows(table, known_ids=()):
+    if "UniqueID" not in table.column_names:
+        return table
+    seen = set(known_ids)
+    keep = []
+    for index, unique_id in enumerate(table.column("UniqueID").to_pylist()):
+        if unique_id is None:
+            keep.append(index)
+        elif unique_id not in seen:
+            seen.add(unique_id)
+            keep.append(index)
+    return table if len(keep) == table.num_rows else table.take(pa.array(keep, pa.int64()))
+
+
+# Writes the rows of one sync as one Parquet file per experiment and day
+def write_partitions(directory, table, sync_id):
+    exp_names = table.column("ExperimentData_Exp_name").to_pylist() \
+        if "ExperimentData_Exp_name" in table.column_names else [None] * table.num_rows
+    days = pc.cast(table.column("TimeStamp"), pa.date32()).to_pylist() \
+        if "TimeStamp" in table.column_names else [None] * table.num_rows
+
+    partitions = {}
+    for index, (exp_name, day) in enumerate(zip(exp_names, days)):
+        key = (exp_name if exp_name is not None else NULL_PARTITION,
+               day.isoformat() if day is not None else NULL_PARTITION)
+        partitions.setdefault(key, []).append(index)
+
+    for (exp_name, day), indices in partitions.items():
+        path = os.path.join(_exp_dir(directory, exp_name), f"date={day}")
+        os.makedirs(path, exist_ok=True)
+        pq.write_table(table.take(indices), os.path.join(path, f"part-{sync_id}.parquet"))
+    return len(partitions)
+
+
+# Removes the parts replaced by the recorded compactions, then forgets the compactions and the
+# sync ids left without files
+def finish_compactions(directory, state):
+    if not state["compactions"]:
+        return
+    remove_unrecorded_parts(directory, state["syncs"], state["compactions"])
+    present = {_sync_id(path) for _, _, path in iter_parts(directory, state["syncs"])}
+    state["syncs"] = [sync_id for sync_id in state["syncs"] if sync_id in present]
+    state["compactions"] = {}
+    write_sync_state(directory, state)
+
+
+# Merges the part files of each experiment and day that has SENSOR_CACHE_COMPACT_PARTS of them or
+# more into one file sorted by TimeStamp, so a day is read from one file whatever the number of
+# syncs. The merged files are recorded with the sync ids of the parts they replace before these
+# are removed: readers skip the replaced parts meanwhile, and the next sync finishes a compaction
+# interrupted in between. Returns the number of days merged.
+def compact_table(directory, state):
+    days = {}
+    for _, _, path in iter_parts(directory, state["syncs"], state["compactions"]):
+        days.setdefault(os.path.dirname(path), []).append(path)
+    days = {day_dir: paths for day_dir, paths in days.items() if len(paths) >= max(SENSOR_CACHE_COMPACT_PARTS, 2)}
+    if not days:
+        return 0
+
+    compaction_id = uuid.uuid4().hex
+    replaced = set()
+    for day_dir, paths in days.items():
+        table = pa.concat_tables([pq.ParquetFile(path).read() for path in paths], promote_options="default")
+        if "TimeStamp" in table.column_names:
+            table = table.sort_by("TimeStamp")
+        pq.write_table(table, os.path.join(day_dir, f"part-{compaction_id}.parquet"))
+        replaced.update(_sync_id(path) for path in paths)
+    state["syncs"].append(compaction_id)
+    state["compactions"][compaction_id] = sorted(replaced)
+    write_sync_state(directory, state)
+    finish_compactions(directory, state)
+    return len(days)
+
+
+# Rows of a sync read not cached yet: rows read again from the overlap are dropped by UniqueID,
+# or by InsertDate when they have none
+def new_rows(table, state, watermark):
+    if "InsertDate" in table.column_names and "UniqueID" in table.column_names:
+        insert_dates = table.column("InsertDate")
+        after_watermark = pc.fill_null(pc.greater(insert_dates, pa.scalar(watermark, insert_dates.type)), False)
+        table = table.filter(pc.or_(after_watermark, pc.is_valid(table.column("UniqueID"))))
+    return drop_duplicate_rows(table, state["recent_ids"])
+
+
+# {UniqueID: InsertDate} of the rows cached with an InsertDate after cutoff - SENSOR_CACHE_OVERLAP,
+# the rows the next sync reads again
+def recent_ids(previous, table, cutoff):
+    oldest = cutoff - SENSOR_CACHE_OVERLAP
+    ids = {unique_id: insert_date for unique_id, insert_date in previous.items()
+           if datetime.fromisoformat(insert_date) > oldest}
+    if "InsertDate" in table.column_names and "UniqueID" in table.column_names:
+        for unique_id, insert_date in zip(table.column("UniqueID").to_pylist(), table.column("InsertDate").to_pylist()):
+            if unique_id is not None and insert_date is not None and _as_timestamp(insert_date) > oldest:
+                ids[unique_id] = _as_timestamp(insert_date).isoformat()
+    return ids
+
+
+# InsertDate of a labels_watermark label value (epoch microseconds), the epoch without one
+def labels_watermark_time(value):
+    return EPOCH + timedelta(microseconds=int(value)) if value else EPOCH
+
+
+# Experiments (partition names) of the cached rows with an InsertDate in (start, end]
+def experiments_inserted_between(directory, syncs, compactions, start, end):
+    experiments = set()
+    for exp_name, _, path in iter_parts(directory, syncs, compactions):
+        if exp_name in experiments:
+            continue
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        if "InsertDate" not in parquet_file.schema_arrow.names:
+            continue
+        insert_dates = parquet_file.read(columns=["InsertDate"]).column("InsertDate")
+        in_window = pc.and_(pc.greater(insert_dates, pa.scalar(start, insert_dates.type)),
+                            pc.less_equal(insert_dates, pa.scalar(end, insert_dates.type)))
+        if pc.any(in_window).as_py():
+            experiments.add(exp_name)
+    return experiments
+
+
+def count_rows(directory, syncs, compactions=None):
+    return sum(pq.ParquetFile(path).metadata.num_rows for _, _, path in iter_parts(directory, syncs, compactions))
+
+
+# Removes the files of the stale experiments and fetches their rows again, up to the watermark.
+# Returns the number of rows fetched.
+def refetch_stale_experiments(client, table_ref, directory, state):
+    from google.cloud import bigquery
+
+    experiments = state["stale_experiments"]
+    # Their rows are fetched from the first day cached, all of them when one has no dated rows
+    first_days = {}
+    for exp_name, day, _ in iter_parts(directory, state["syncs"], state["compactions"]):
+        if exp_name in experiments and day != NULL_PARTITION:
+            first_days[exp_name] = min(day, first_days.get(exp_name, day))
+    timestamp_start = EPOCH
+    if first_days and set(first_days) == set(experiments):
+        timestamp_start = datetime.fromisoformat(min(first_days.values())).replace(tzinfo=timezone.utc)
+    for exp_name in experiments:
+        shutil.rmtree(_exp_dir(directory, exp_name), ignore_errors=True)
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("experiments", "STRING", [name for name in experiments if name != NULL_PARTITION]),
+        bigquery.ScalarQueryParameter("null_experiment", "BOOL", NULL_PARTITION in experiments),
+        bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", datetime.fromisoformat(state["watermark"])),
+        bigquery.ScalarQueryParameter("timestamp_start", "TIMESTAMP", timestamp_start),
+    ])
+    table = drop_duplicate_rows(client.query(REFETCH_QUERY.format(table=table_ref), job_config=job_config).to_arrow())
+    if table.num_rows:
+        sync_id = uuid.uuid4().hex
+        write_partitions(directory, table, sync_id)
+        state["syncs"].append(sync_id)
+    state["stale_experiments"] = []
+    state["rows"] = count_rows(directory, state["syncs"], state["compactions"])
+    write_sync_state(directory, state)
+    return table.num_rows
+
+
+# Fetches the rows inserted into a table since its watermark and adds them to the cache, then
+# fetches again the experiments whose labels update-labels may have changed since the last sync,
+# and merges the part files of the days written more than once.
+# Returns {"rows", "partitions", "watermark", "refetched_experiments", "refetched_rows", "compacted_days"}.
+def sync_table(client, owner, mac_address, cache_dir=SENSOR_CACHE_DIR, now=None):
+    from google.cloud import bigquery
+
+    directory = table_dir(cache_dir, owner, mac_address)
+    os.makedirs(directory, exist_ok=True)
+    state = read_sync_state(directory)
+    remove_unrecorded_parts(directory, state["syncs"], state["compactions"])
+    finish_compactions(directory, state)
+    table_ref = f"{client.project}.{owner}.{mac_address}"
+    # Read before the rows: labels changed while they are read are caught by the next sync
+    labels_watermark = (client.get_table(table_ref).labels or {}).get(LABELS_WATERMARK_LABEL)
+
+    watermark = datetime.fromisoformat(state["watermark"])
+    cutoff = (now or datetime.now(timezone.utc)) - SENSOR_CACHE_DELAY
+    rows = partitions = 0
+    if cutoff > watermark:
+        window_start = max(watermark - SENSOR_CACHE_OVERLAP, EPOCH)
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("window_start", "TIMESTAMP", window_start),
+            bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", cutoff),
+            bigquery.ScalarQueryParameter("timestamp_start", "TIMESTAMP", window_start - SENSOR_CACHE_MAX_UPLOAD_LAG),
+        ])
+        table = new_rows(client.query(SYNC_QUERY.format(table=table_ref), job_config=job_config).to_arrow(),
+                         state, watermark)
+        rows = table.num_rows
+        if rows:
+            sync_id = uuid.uuid4().hex
+            partitions = write_partitions(directory, table, sync_id)
+            state["syncs"].append(sync_id)
+            state["rows"] += rows
+        state["recent_ids"] = recent_ids(state["recent_ids"], table, cutoff)
+        state["watermark"] = cutoff.isoformat()
+        write_sync_state(directory, state)
+
+    # New caches have just fetched their rows with the current labels, and caches of an earlier
+    # version cannot tell what changed: the labels watermark is only recorded
+    if "labels_watermark" in state and labels_watermark != state["labels_watermark"]:
+        previous, current = labels_watermark_time(state["labels_watermark"]), labels_watermark_time(labels_watermark)
+        changed = experiments_inserted_between(directory, state["syncs"], state["compactions"], min(previous, current) - SENSOR_CACHE_OVERLAP,
+                                               max(previous, current))
+        state["stale_experiments"] = sorted(set(state["stale_experiments"]) | changed)
+    state["labels_watermark"] = labels_watermark
+    write_sync_state(directory, state)
+
+    refetched_experiments = list(state["stale_experiments"])
+    refetched_rows = refetch_stale_experiments(client, table_ref, directory, state) if refetched_experiments else 0
+    compacted_days = compact_table(directory, state)
+    return {"rows": rows, "partitions": partitions, "watermark": state["watermark"],
+            "refetched_experiments": refetched_experiments, "refetched_rows": refetched_rows,
+            "compacted_days": compacted_days}
+
+
+# Syncs every table (or those of the given datasets / MAC addresses) on max_workers threads.
+# Returns {"owner/mac": result of sync_table, or {"error"}}.
+def sync_tables(client, datasets=None, tables=None, cache_dir=SENSOR_CACHE_DIR, max_workers=SENSOR_CACHE_MAX_WORKERS):
+    pairs = [
+        (dataset.dataset_id, table.table_id)
+        for dataset in client.list_datasets() if datasets is None or dataset.dataset_id in datasets
+        for table in client.list_tables(dataset.dataset_id) if tables is None or table.table_id in tables
+    ]
+
+    def sync(pair):
+        try:
+            return sync_table(client, pair[0], pair[1], cache_dir)
+        except Exception as e:
+            print(f"Could not sync {pair[0]}/{pair[1]}: {e}")
+            return {"error": repr(e)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {f"{owner}/{mac_address}": result for (owner, mac_address), result in zip(pairs, executor.map(sync, pairs))}
+
+
+def _as_day(value):
+    if value is None or isinstance(value, str):
+        return value
+    return (value.date() if isinstance(value, datetime) else value).isoformat()
+
+
+def _as_timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+# Reads the cached rows of one owner/MAC as an Arrow table: only the files of the requested
+# experiments and of the days between start and end (inclusive dates or datetimes, TimeStamp
+# also filtered within the days) are opened, memory-mapped, and only the given columns are read.
+# Columns missing from older files (added later to the table) are null there.
+def read_sensor_table(owner, mac_address, columns=None, experiments=None, start=None, end=None,
+                      cache_dir=SENSOR_CACHE_DIR):
+    directory = table_dir(cache_dir, owner, mac_address)
+    state = read_sync_state(directory)
+    experiments = set(experiments) if experiments is not None else None
+    first_day, last_day = _as_day(start), _as_day(end)
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(list(columns) + (["TimeStamp"] if start or end else [])))
+
+    tables = []
+    for exp_name, day, path in iter_parts(directory, state["syncs"], state["compactions"]):
+        if experiments is not None and exp_name not in experiments:
+            continue
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        names = parquet_file.schema_arrow.names
+        tables.append(parquet_file.read(
+            columns=[name for name in read_columns if name in names] if read_columns is not None else None))
+
+    if not tables:
+        return pa.table({name: pa.array([], type=pa.null()) for name in (columns or [])})
+    table = pa.concat_tables(tables, promote_options="default")
+
+    if (start or end) and "TimeStamp" in table.column_names:
+        mask = None
+        if start:
+            mask = pc.greater_equal(table.column("TimeStamp"), pa.scalar(_as_timestamp(start), table.schema.field("TimeStamp").type))
+        if end and isinstance(end, datetime):
+            before = pc.less_equal(table.column("TimeStamp"), pa.scalar(_as_timestamp(end), table.schema.field("TimeStamp").type))
+            mask = before if mask is None else pc.and_(mask, before)
+        if mask is not None:
+            table = table.filter(mask)
+    if columns is not None:
+        table = table.select([name for name in columns if name in table.column_names])
+    return table
+
+
+# read_sensor_table as a pandas DataFrame, sorted by TimeStamp, for the plotting code
+def load_sensor_data(owner, mac_address, columns=None, experiments=None, start=None, end=None,
+                     cache_dir=SENSOR_CACHE_DIR):
+    df = read_sensor_table(owner, mac_address, columns, experiments, start, end, cache_dir).to_pandas()
+    if "TimeStamp" in df.columns:
+        df = df.sort_values("TimeStamp", ignore_index=True)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cache-dir", default=SENSOR_CACHE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync = commands.add_parser("sync")
+    sync.add_argument("--project", default=PROJECT)
+    sync.add_argument("--credentials", help="Service account JSON file, default credentials otherwise")
+    sync.add_argument("--dataset", action="append", help="Only this owner (dataset), repeatable")
+    sync.add_argument("--table", action="append", help="Only this MAC address (table), repeatable")
+    sync.add_argument("--max-workers", type=int, default=SENSOR_CACHE_MAX_WORKERS)
+    commands.add_parser("info")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        for owner in sorted(os.listdir(args.cache_dir)) if os.path.isdir(args.cache_dir) else []:
+            for mac_address in sorted(os.listdir(os.path.join(args.cache_dir, owner))):
+                state = read_sync_state(os.path.join(args.cache_dir, owner, mac_address))
+                print(f"{unquote(owner)}/{unquote(mac_address)}: {state['rows']} rows, up to {state['watermark']}")
+        return
+
+    from google.cloud import bigquery
+
+    credentials = None
+    if args.credentials:
+        from google.oauth2 import service_account
+
+        credentials = service_account.Credentials.from_service_account_file(args.credentials)
+    client = bigquery.Client(credentials=credentials, project=args.project)
+
+    started = time.perf_counter()
+    results = sync_tables(client, args.dataset, args.table, args.cache_dir, args.max_workers)
+    for table, result in results.items():
+        print(f"{table}: {json.dumps(result)}")
+    print(f"Synced {len(results)} tables, {sum(r.get('rows', 0) for r in results.values())} new rows, "
+          f"in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
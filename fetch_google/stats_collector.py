@@ -0,0 +1,258 @@
+"""
+Statistics of every sensor table of the project, from raw scans: distinct sensors, entries and
+newest TimeStamp per experiment (query_combined_data) and entries per day (query_daily_data),
+the queries of the notebook, collected concurrently under a bytes budget.
+
+    python stats_collector.py [--project iucc-f4d] [--credentials read_BQ.json] [--dataset DATASET ...]
+                              [--max-workers 8] [--max-gb 10] [--cache-dir DIR] [--no-cache]
+                              [--output combined.parquet] [--daily-output daily.parquet] [--estimate-only]
+
+Tables are listed, and their results looked up in the cache, first. The queries of the other
+tables are dry-run, and when their estimated bytes add up to more than the budget nothing is
+run. Otherwise they run on a pool of --max-workers threads, each capped with
+maximum_bytes_billed. Results are cached per table in --cache-dir, keyed by the table's
+modification time, row count and streaming buffer, so the next runs only query the tables that
+changed. For the daily figures without any scan, see the rollup read in the notebook
+(daily_stats.py).
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from google.cloud import bigquery
+
+PROJECT = "iucc-f4d"
+# On-demand price used for the cost estimates, in USD per TiB scanned
+PRICE_PER_TIB = 5
+STATS_MAX_WORKERS = int(os.environ.get("STATS_MAX_WORKERS", 8))
+# Bytes all the dry-run estimates of a run may add up to
+STATS_MAX_BYTES = int(float(os.environ.get("STATS_MAX_GB", 10)) * 1024 ** 3)
+STATS_CACHE_DIR = os.environ.get("STATS_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".stats_cache"))
+# BigQuery bills at least 10 MB per table referenced, so caps below that would fail every query
+MIN_BILLED_BYTES = 10 * 1024 ** 2
+
+COMBINED_COLUMNS = ["dataset_id", "table_id", "ExperimentData_Exp_name", "sensor_count", "num_entries",
+                    "last_timestamp", "estimated_cost"]
+DAILY_COLUMNS = ["dataset_id", "table_id", "date", "num_entries"]
+
+
+def combined_query(project, dataset_id, table_id):
+    return f"""
+    SELECT
+      ExperimentData_Exp_name,
+      COUNT(DISTINCT SensorData_Name) AS sensor_count,
+      COUNT(*) AS num_entries,
+      MAX(TimeStamp) AS last_timestamp
+    FROM
+      `{project}.{dataset_id}.{table_id}`
+    GROUP BY
+      ExperimentData_Exp_name
+    ORDER BY
+      ExperimentData_Exp_name;
+    """
+
+
+def daily_query(project, dataset_id, table_id):
+    return f"""
+    SELECT
+      DATE(TimeStamp) AS date,
+      COUNT(*) AS num_entries
+    FROM
+      `{project}.{dataset_id}.{table_id}`
+    GROUP BY
+      date
+    ORDER BY
+      date;
+    """
+
+
+def estimated_cost(bytes_processed):
+    return (bytes_processed / (1024 ** 4)) * PRICE_PER_TIB
+
+
+# Bytes a query would scan, from a dry run (free)
+def estimate_bytes(client, query):
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(query, job_config=job_config).total_bytes_processed or 0
+
+
+# Notebook version of the combined query on one table: returns (query results, estimated cost in USD)
+def query_combined_data(client, dataset_id, table_id, print_cost=False):
+    query = combined_query(client.project, dataset_id, table_id)
+    cost = estimated_cost(estimate_bytes(client, query))
+    if print_cost:
+        print(f"Estimated cost for table {table_id} in dataset {dataset_id}: ${cost:.4f}")
+    return client.query(query).result(), cost
+
+
+# Notebook version of the daily query on one table: returns (DataFrame of daily counts, estimated cost in USD)
+def query_daily_data(client, dataset_id, table_id):
+    query_job = client.query(daily_query(client.project, dataset_id, table_id))
+    results = query_job.result()
+    data = [{"dataset_id": dataset_id, "date": row["date"], "num_entries": row["num_entries"]} for row in results]
+    return pd.DataFrame(data), estimated_cost(query_job.total_bytes_processed or 0)
+
+
+# Cache key of a table: changes whenever rows are added, loaded or streamed
+def table_version(table):
+    streaming_rows = table.streaming_buffer.estimated_rows if table.streaming_buffer else 0
+    modified = table.modified.isoformat() if table.modified else ""
+    return f"{modified}|{table.num_rows}|{streaming_rows}"
+
+
+def _cache_path(cache_dir, project, dataset_id, table_id):
+    return os.path.join(cache_dir, f"{project}.{dataset_id}.{table_id}.json")
+
+
+def read_cache(cache_dir, project, dataset_id, table_id, version):
+    try:
+        with open(_cache_path(cache_dir, project, dataset_id, table_id), encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get("version") == version else None
+
+
+def write_cache(cache_dir, project, dataset_id, table_id, entry):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, project, dataset_id, table_id)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    os.replace(path + ".tmp", path)
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+# Runs both queries of one table, each capped at twice its dry-run estimate
+def query_table(client, dataset_id, table_id, estimates):
+    results = {}
+    for name, make_query, columns in (
+            ("combined", combined_query, ["ExperimentData_Exp_name", "sensor_count", "num_entries", "last_timestamp"]),
+            ("daily", daily_query, ["date", "num_entries"])):
+        job_config = bigquery.QueryJobConfig(maximum_bytes_billed=max(2 * estimates[name], MIN_BILLED_BYTES))
+        rows = client.query(make_query(client.project, dataset_id, table_id), job_config=job_config).result()
+        results[name] = [{column: _json_value(row[column]) for column in columns} for row in rows]
+    return results
+
+
+# Collects the statistics of every table (or of the given datasets). Returns
+# {"combined": DataFrame, "daily": DataFrame, "tables", "cached", "queried", "estimated_bytes",
+#  "estimated_cost", "errors": {table_ref: error}}.
+# Raises RuntimeError, before running any query, when the estimates exceed max_bytes.
+def collect_stats(client, datasets=None, max_workers=STATS_MAX_WORKERS, max_bytes=STATS_MAX_BYTES,
+                  cache_dir=STATS_CACHE_DIR, use_cache=True, estimate_only=False):
+    tables = [
+        (dataset.dataset_id, table.table_id)
+        for dataset in client.list_datasets() if datasets is None or dataset.dataset_id in datasets
+        for table in client.list_tables(dataset.dataset_id)
+    ]
+    summary = {"tables": len(tables), "cached": 0, "queried": 0, "estimated_bytes": 0, "estimated_cost": 0.0,
+               "errors": {}}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        versions = list(executor.map(
+            lambda pair: table_version(client.get_table(f"{client.project}.{pair[0]}.{pair[1]}")), tables))
+
+        results = {}
+        stale = []
+        for (dataset_id, table_id), version in zip(tables, versions):
+            entry = read_cache(cache_dir, client.project, dataset_id, table_id, version) if use_cache else None
+            if entry is None:
+                stale.append((dataset_id, table_id, version))
+            else:
+                results[(dataset_id, table_id)] = entry
+        summary["cached"] = len(results)
+
+        # Dry runs of every query to run, before any of them is run
+        def estimate(table):
+            dataset_id, table_id, _ = table
+            return {
+                "combined": estimate_bytes(client, combined_query(client.project, dataset_id, table_id)),
+                "daily": estimate_bytes(client, daily_query(client.project, dataset_id, table_id)),
+            }
+
+        estimates = list(executor.map(estimate, stale))
+        summary["estimated_bytes"] = sum(sum(table_estimates.values()) for table_estimates in estimates)
+        summary["estimated_cost"] = estimated_cost(summary["estimated_bytes"])
+        print(f"{len(tables)} tables, {len(results)} cached, {len(stale)} to query: "
+              f"{summary['estimated_bytes'] / 1024 ** 3:.3f} GiB estimated (${summary['estimated_cost']:.4f})")
+        if summary["estimated_bytes"] > max_bytes:
+            raise RuntimeError(f"Estimated {summary['estimated_bytes']} bytes for {len(stale)} tables, "
+                               f"over the budget of {max_bytes} bytes. Nothing was run.")
+        if estimate_only:
+            return summary
+
+        futures = [
+            (table, table_estimates, executor.submit(query_table, client, table[0], table[1], table_estimates))
+            for table, table_estimates in zip(stale, estimates)
+        ]
+        for (dataset_id, table_id, version), table_estimates, future in futures:
+            try:
+                entry = future.result()
+            except Exception as e:
+                summary["errors"][f"{dataset_id}.{table_id}"] = repr(e)
+                print(f"Could not collect the statistics of {dataset_id}.{table_id}: {e}")
+                continue
+            entry["version"] = version
+            entry["estimated_cost"] = estimated_cost(sum(table_estimates.values()))
+            if use_cache:
+                write_cache(cache_dir, client.project, dataset_id, table_id, entry)
+            results[(dataset_id, table_id)] = entry
+            summary["queried"] += 1
+
+    combined = []
+    daily = []
+    for (dataset_id, table_id), entry in sorted(results.items()):
+        combined.extend({"dataset_id": dataset_id, "table_id": table_id, **row,
+                         "estimated_cost": entry.get("estimated_cost", 0.0)} for row in entry["combined"])
+        daily.extend({"dataset_id": dataset_id, "table_id": table_id, **row} for row in entry["daily"])
+
+    summary["combined"] = pd.DataFrame(combined, columns=COMBINED_COLUMNS)
+    summary["combined"]["last_timestamp"] = pd.to_datetime(summary["combined"]["last_timestamp"], utc=True)
+    summary["daily"] = pd.DataFrame(daily, columns=DAILY_COLUMNS)
+    summary["daily"]["date"] = pd.to_datetime(summary["daily"]["date"])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--project", default=PROJECT)
+    parser.add_argument("--credentials", help="Service account JSON file, default credentials otherwise")
+    parser.add_argument("--dataset", action="append", help="Only this dataset, repeatable")
+    parser.add_argument("--max-workers", type=int, default=STATS_MAX_WORKERS, help="Tables queried at once")
+    parser.add_argument("--max-gb", type=float, default=STATS_MAX_BYTES / 1024 ** 3,
+                        help="Budget of the dry-run estimates, in GiB")
+    parser.add_argument("--cache-dir", default=STATS_CACHE_DIR)
+    parser.add_argument("--no-cache", action="store_true", help="Query every table and leave the cache as it is")
+    parser.add_argument("--output", default="combined_stats.parquet", help="Parquet file of the combined statistics")
+    parser.add_argument("--daily-output", help="Parquet file of the daily counts")
+    parser.add_argument("--estimate-only", action="store_true", help="Only report the estimated bytes")
+    args = parser.parse_args()
+
+    credentials = None
+    if args.credentials:
+        from google.oauth2 import service_account
+
+        credentials = service_account.Credentials.from_service_account_file(args.credentials)
+    client = bigquery.Client(credentials=credentials, project=args.project)
+
+    started = time.perf_counter()
+    summary = collect_stats(client, args.dataset, args.max_workers, int(args.max_gb * 1024 ** 3), args.cache_dir,
+                            use_cache=not args.no_cache, estimate_only=args.estimate_only)
+    if args.estimate_only:
+        return
+
+    summary["combined"].to_parquet(args.output, index=False)
+    if args.daily_output:
+        summary["daily"].to_parquet(args.daily_output, index=False)
+    print(f"Collected {summary['tables']} tables ({summary['cached']} cached, {summary['queried']} queried, "
+          f"{len(summary['errors'])} failed) in {time.perf_counter() - started:.1f} s, wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
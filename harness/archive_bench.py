@@ -0,0 +1,109 @@
+"""
+Time and size of the archival of upload_To_bucket (upload_files_to_gcs) against the serial
+upload of pretty-printed objects it replaced, on the fake storage backed by files in a
+temporary directory.
+
+    python harness/archive_bench.py [--requests 20] [--records 50] [--latency 0.02] [--workers 16] [--runs 3]
+
+--requests requests of --records records each (one device, as process_files sends them) are
+archived with each configuration; every storage call of the fake takes --latency seconds, like
+a round trip to Cloud Storage. Configurations: the serial loop of indent=4 objects, the
+per_record mode with one worker and with --workers workers, and the grouped mode. Reported:
+median time per request in milliseconds, objects and bytes written to the directory, and the
+time archive_reader.find_record takes to locate the last UniqueID.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+
+# The archival loop of upload_To_bucket before the concurrent uploader (without its client creation)
+def serial_upload(bucket, json_list):
+    for json_obj in json_list:
+        folder_path = f"{json_obj['Owner']}/{json_obj['ExperimentData']['MAC_address']}/{json_obj['ExperimentData']['Exp_name']}/"
+        blob = bucket.blob(f"{folder_path}{json_obj['UniqueID']}.json")
+        blob.upload_from_string(json.dumps(json_obj, indent=4), content_type='application/json')
+    return len(json_list)
+
+
+# Imports archive_reader with the upload_To_bucket main it reads the object names from
+def load_archive_reader(module):
+    saved = sys.modules.get("main")
+    sys.modules["main"] = module
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "upload_To_bucket_archive_reader", os.path.join(bench.REPO_DIR, "upload_To_bucket", "archive_reader.py"))
+        reader = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(reader)
+    finally:
+        if saved is None:
+            del sys.modules["main"]
+        else:
+            sys.modules["main"] = saved
+    return reader
+
+
+def files_on_disk(root):
+    sizes = [os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(root) for name in names]
+    return len(sizes), sum(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--records", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per storage call")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    module = bench.load_function("upload_To_bucket", "upload_To_bucket_main")
+    reader = load_archive_reader(module)
+    records = generator.generate_file(0, "owner_0", "mac0", args.requests * args.records, experiments=1)
+    requests = [records[index:index + args.records] for index in range(0, len(records), args.records)]
+    last = records[-1]
+
+    configs = [
+        ("serial indent=4", lambda json_list: serial_upload(module.get_bucket(), json_list)),
+        ("per_record x1", lambda json_list: module.upload_files_to_gcs(json_list, "per_record", 1)),
+        (f"per_record x{args.workers}", lambda json_list: module.upload_files_to_gcs(json_list, "per_record", args.workers)),
+        (f"grouped x{args.workers}", lambda json_list: module.upload_files_to_gcs(json_list, "grouped", args.workers)),
+    ]
+    print(f"{args.requests} requests of {args.records} records, {args.latency * 1000:.0f} ms per storage call, "
+          f"median of {args.runs} runs")
+    print(f"{'config':<18}{'ms/request':>11}{'objects':>9}{'MB':>8}{'lookup ms':>11}")
+    for name, upload in configs:
+        durations = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as root:
+                storage = fakes.FakeStorageClient(root=root, latency=args.latency)
+                bench.install_fakes(module, storage, fakes.FakeBigQueryClient())
+                module._bucket = None
+                for json_list in requests:
+                    started = time.perf_counter()
+                    upload(json_list)
+                    durations.append(time.perf_counter() - started)
+                objects, size = files_on_disk(root)
+                started = time.perf_counter()
+                found_name, json_obj = reader.find_record(last["Owner"], last["ExperimentData"]["MAC_address"],
+                                                          last["ExperimentData"]["Exp_name"], last["UniqueID"])
+                lookup = time.perf_counter() - started
+                assert json_obj == last, f"{last['UniqueID']} not found"
+        print(f"{name:<18}{statistics.median(durations) * 1000:>11.1f}{objects:>9}{size / 1024 ** 2:>8.2f}"
+              f"{lookup * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
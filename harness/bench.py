@@ -0,0 +1,290 @@
+"""
+Offline replay and load test of the ingestion chain, with local stand-ins for Cloud Storage,
+BigQuery and the HTTP calls between functions (fakes.py). Nothing is sent to Google Cloud,
+but the packages of the functions' requirements.txt must be installed.
+
+    python harness/bench.py [--files 30] [--records 500] [--rate 0] [--concurrency 1] [--ndjson]
+                            [--compression none] [--queries 3] [--storage-dir DIR] [--bq-latency S]
+                            [--gcs-latency S] [--bandwidth MBPS] [--no-memory] [--verbose]
+
+Synthetic uploads (generator.py) are written to the fake upload bucket at --rate files per
+second (0: as fast as possible) and replayed through process_files.catalog_and_insert on
+--concurrency workers. process_files archives through upload_To_bucket over the fake HTTP
+session and inserts into the fake BigQuery. query_last_timestamp is then called --queries
+times for every device, and update-labels once. With --compression the uploads are gzip or
+zstd files with that Content-Encoding. --bandwidth limits the transfers of the fake storage and
+HTTP session to MBPS megabytes per second.
+
+Reported per function: invocations, errors, records, records/sec over the phase wall time,
+p50/p99 latency and peak traced memory above the baseline (tracemalloc, which slows the run
+down; disable with --no-memory). upload_To_bucket runs inside process_files invocations, so
+its memory is included in theirs. With --concurrency > 1 the memory peaks of concurrent
+invocations overlap.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HARNESS_DIR)
+sys.path.insert(0, HARNESS_DIR)
+
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+UPLOAD_BUCKET = "harness-uploads"
+# Bucket of the state store of the functions (last-timestamp index...)
+STATE_BUCKET = "harness-state"
+
+
+# Imports the main.py of a function directory under its own name, with private copies of its
+# sibling modules (metrics, last_timestamp_index...), as if each function ran in its own instance
+def load_function(directory, module_name):
+    directory = os.path.join(REPO_DIR, directory)
+    siblings = {name[:-3] for name in os.listdir(directory) if name.endswith(".py") and name != "main.py"}
+    saved = {name: sys.modules.pop(name) for name in siblings if name in sys.modules}
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(directory, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        for name in siblings:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+    return module
+
+
+# Points the CLIENT_FACTORIES of a function module at the fakes
+def install_fakes(module, storage, bigquery, http_routes=None, http_session=None):
+    factories = module.CLIENT_FACTORIES
+    if "bigquery" in factories:
+        factories["bigquery"] = bigquery
+    if "storage" in factories:
+        factories["storage"] = lambda: storage
+    if "http_session" in factories:
+        factories["http_session"] = lambda: http_session or fakes.FakeHttpSession(http_routes or {})
+    if "id_token" in factories:
+        factories["id_token"] = fakes.fake_id_token
+
+
+# Calls an HTTP entry point with a JSON body in a Flask request context and returns (status, text)
+def call_http(app, handler, body, query_string=None, headers=None):
+    import flask
+
+    with app.test_request_context(method="POST", data=body, content_type="application/json",
+                                  query_string=query_string, headers=headers):
+        returned = handler(flask.request)
+    if isinstance(returned, tuple):
+        return returned[1], returned[0]
+    return returned.status_code, returned.get_data(as_text=True)
+
+
+class FunctionStats:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.records = 0
+        self.errors = 0
+        self.peak_bytes = None
+        self.wall_seconds = 0.0
+
+    def add(self, seconds, records, ok, peak_bytes=None):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.records += records
+            self.errors += not ok
+            if peak_bytes is not None:
+                self.peak_bytes = max(self.peak_bytes or 0, peak_bytes)
+
+    def row(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0.0
+
+        rate = self.records / self.wall_seconds if self.wall_seconds else 0.0
+        peak = f"{self.peak_bytes / 1024 ** 2:.1f}" if self.peak_bytes is not None else "n/a"
+        return (f"{self.name:<22} {len(latencies):>6} {self.errors:>6} {self.records:>9} {rate:>10.1f}"
+                f" {percentile(0.5):>9.1f} {percentile(0.99):>9.1f} {peak:>8}")
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.trace_memory = not args.no_memory
+        bandwidth = args.bandwidth * 1024 ** 2 if args.bandwidth else None
+        self.storage = fakes.FakeStorageClient(args.storage_dir, args.gcs_latency, bandwidth)
+        self.bigquery = fakes.FakeBigQueryClient(latency=args.bq_latency)
+        self.stats = {name: FunctionStats(name) for name in
+                      ("process_files", "upload_To_bucket", "query_last_timestamp", "update-labels")}
+
+        self.process_files = load_function("process_files", "process_files_main")
+        self.upload_to_bucket = load_function("upload_To_bucket", "upload_To_bucket_main")
+        self.query_last_timestamp = load_function("query_last_timestamp", "query_last_timestamp_main")
+        self.update_labels = load_function("update-labels", "update_labels_main")
+
+        self.http = fakes.FakeHttpSession({"upload_To_bucket": self.post_upload_to_bucket}, bandwidth)
+        install_fakes(self.process_files, self.storage, self.bigquery, http_session=self.http)
+        for module in (self.upload_to_bucket, self.query_last_timestamp, self.update_labels):
+            install_fakes(module, self.storage, self.bigquery)
+
+        import flask
+
+        self.app = flask.Flask("harness")
+
+    # Runs one top-level invocation and records its latency and memory peak
+    def measure(self, stats, records, func, *args):
+        if self.trace_memory and self.args.concurrency == 1:
+            tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        started = time.perf_counter()
+        ok = True
+        returned = None
+        try:
+            returned = func(*args)
+        except Exception:
+            ok = False
+        seconds = time.perf_counter() - started
+        if isinstance(returned, tuple) and isinstance(returned[0], int):
+            ok = ok and returned[0] < 400
+        peak = tracemalloc.get_traced_memory()[1] - baseline if self.trace_memory else None
+        stats.add(seconds, records, ok, peak)
+        return returned
+
+    # Route of the fake HTTP session: upload_To_bucket runs nested in process_files, so only
+    # its latency is recorded
+    def post_upload_to_bucket(self, payload, headers):
+        started = time.perf_counter()
+        content_encoding = {"Content-Encoding": headers["Content-Encoding"]} if "Content-Encoding" in headers else None
+        status_code, text = call_http(self.app, self.upload_to_bucket.upload_json_to_gcs, payload,
+                                      headers=content_encoding)
+        body = self.process_files.compression.decompress(payload, headers.get("Content-Encoding"))
+        records = body.count(b'"UniqueID"')
+        self.stats["upload_To_bucket"].add(time.perf_counter() - started, records, status_code < 400)
+        return status_code, text
+
+    def ingest(self, name, records):
+        data = generator.serialize(records, self.args.ndjson)
+        blob = self.storage.bucket(UPLOAD_BUCKET).blob(name)
+        event_data = {"bucket": UPLOAD_BUCKET, "name": name}
+        if self.args.compression != "none":
+            data = self.process_files.compression.compress(data, self.args.compression)
+            blob.content_encoding = event_data["contentEncoding"] = self.args.compression
+        blob.upload_from_string(data, content_type="application/json")
+        event_data.update(generation=str(blob.generation), size=str(len(data)))
+        event = fakes.FakeCloudEvent(event_data, event_id=f"harness-{blob.generation}")
+        self.measure(self.stats["process_files"], len(records), self.process_files.catalog_and_insert, event)
+
+    def run_ingest(self, uploads):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            futures = []
+            for index, (name, records) in enumerate(uploads):
+                if self.args.rate:
+                    delay = started + index / self.args.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(executor.submit(self.ingest, name, records))
+            for future in futures:
+                future.result()
+        wall = time.perf_counter() - started
+        self.stats["process_files"].wall_seconds = wall
+        self.stats["upload_To_bucket"].wall_seconds = wall
+
+    def run_queries(self, devices):
+        started = time.perf_counter()
+        experiment_names = [f"exp_{exp_id}" for exp_id in range(1, self.args.experiments + 1)]
+        for _ in range(self.args.queries):
+            for owner, mac_address in devices:
+                body = json.dumps({"owner": owner, "mac_address": mac_address, "experiment_names": experiment_names})
+                self.measure(self.stats["query_last_timestamp"], len(experiment_names), self.http_status,
+                             self.query_last_timestamp.query_last_timestamp, body)
+        self.stats["query_last_timestamp"].wall_seconds = time.perf_counter() - started
+
+    def run_update_labels(self):
+        started = time.perf_counter()
+        self.measure(self.stats["update-labels"], len(self.bigquery.tables), self.http_status,
+                     self.update_labels.hello_http, json.dumps({"mode": "incremental"}))
+        self.stats["update-labels"].wall_seconds = time.perf_counter() - started
+
+    def http_status(self, handler, body):
+        return call_http(self.app, handler, body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=30, help="Uploads to replay")
+    parser.add_argument("--records", type=int, default=500, help="Records per upload")
+    parser.add_argument("--owners", type=int, default=2)
+    parser.add_argument("--macs", type=int, default=3, help="Devices (MAC addresses) per owner")
+    parser.add_argument("--experiments", type=int, default=2, help="Experiments per device")
+    parser.add_argument("--rate", type=float, default=0, help="Uploads per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=1, help="process_files invocations at once")
+    parser.add_argument("--ndjson", action="store_true", help="Upload newline-delimited JSON instead of arrays")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none",
+                        help="Compression of the uploaded files")
+    parser.add_argument("--queries", type=int, default=3, help="query_last_timestamp calls per device")
+    parser.add_argument("--storage-dir", help="Keep the fake Cloud Storage objects in this directory")
+    parser.add_argument("--bq-latency", type=float, default=0.0, help="Seconds added to each BigQuery call")
+    parser.add_argument("--gcs-latency", type=float, default=0.0, help="Seconds added to each storage call")
+    parser.add_argument("--bandwidth", type=float, help="Megabytes per second of the storage and HTTP transfers")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the functions")
+    args = parser.parse_args()
+
+    # Settings read by the functions at import time; the last-timestamp index, the ingestion
+    # ledger and the daily statistics are shared through the fake storage, like the gcs state
+    # store of a deployment
+    os.environ.setdefault("STATE_BUCKET", STATE_BUCKET)
+    os.environ.setdefault("INGEST_BACKEND", "streaming")
+    os.environ.setdefault("LABELS_POLL_SECONDS", "0.01")
+    os.environ.setdefault("LABELS_STREAMING_DELAY_MINUTES", "0")
+
+    harness = Harness(args)
+    uploads = list(generator.generate_uploads(args.files, args.records, args.owners, args.macs, args.experiments))
+    devices = sorted({tuple(name.split("/")[:2]) for name, _ in uploads})
+    unique_ids = {record["UniqueID"] for _, records in uploads for record in records}
+
+    if harness.trace_memory:
+        tracemalloc.start()
+    output = sys.stdout if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(output):
+        harness.run_ingest(uploads)
+        harness.run_queries(devices)
+        harness.run_update_labels()
+
+    print(f"{'function':<22} {'calls':>6} {'errors':>6} {'records':>9} {'records/s':>10}"
+          f" {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for stats in harness.stats.values():
+        print(stats.row())
+
+    archived = sum(1 for bucket, _ in harness.storage.objects if bucket not in (UPLOAD_BUCKET, STATE_BUCKET))
+    left = sum(1 for bucket, _ in harness.storage.objects if bucket == UPLOAD_BUCKET)
+    print(f"\nBigQuery rows: {harness.bigquery.row_count()} (unique records uploaded: {len(unique_ids)}),"
+          f" tables: {len(harness.bigquery.tables)}, API calls: {harness.bigquery.calls}")
+    print(f"Archived objects: {archived}, uploads not deleted: {left}, storage calls: {harness.storage.calls}")
+    print(f"Bytes moved: storage writes {sum(harness.storage.bytes_written.values())},"
+          f" storage reads {sum(harness.storage.bytes_read.values())}, HTTP bodies {harness.http.bytes_sent}")
+
+    # The daily statistics rollup kept by process_files against a raw scan of the fake tables
+    daily_stats = harness.process_files.daily_stats
+    rollup_entries = daily_stats.read_daily_stats()
+    if rollup_entries and harness.bigquery.row_count():
+        raw_entries = daily_stats.scan_rows({tuple(ref.split(".")[1:]): rows for ref, rows in harness.bigquery.rows.items()})
+        differences = daily_stats.compare(rollup_entries, raw_entries)
+        print(f"Daily stats rollup: {len(rollup_entries)} entries, {len(differences)} differences with a raw scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Cold-start benchmark of the four function entry points.
+
+    python harness/cold_start.py [--runs 5] [--importtime]
+
+Each run starts a new interpreter per function, imports the function's main.py (import), sends
+it a representative request (first request) and then the same kind of request again (warm
+request), with the stand-ins of fakes.py. functions_framework and flask are imported before
+the timing starts, since the framework loads them before any function code. Client
+construction is faked, so the first request measures the lazy imports and caches of the
+function, not authentication or connection setup.
+
+Reports the median of the runs in milliseconds. With --importtime, the slowest imports of
+main.py in one run are listed (python -X importtime).
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS = ["process_files", "upload_To_bucket", "query_last_timestamp", "update-labels"]
+
+
+# Returns a callable sending one representative request to the function, a new one per call
+def make_request(name, module, storage, bigquery):
+    import flask
+
+    import bench
+    import fakes
+    import generator
+
+    app = flask.Flask("cold_start")
+    counter = iter(range(1_000_000))
+
+    if name == "process_files":
+        def request():
+            index = next(counter)
+            data = generator.serialize(generator.generate_file(index, "owner_0", "mac000000", 200))
+            blob = storage.bucket(bench.UPLOAD_BUCKET).blob(f"owner_0/mac000000/upload_{index}.json")
+            blob.upload_from_string(data)
+            event = fakes.FakeCloudEvent({"bucket": bench.UPLOAD_BUCKET, "name": blob.name,
+                                          "generation": str(blob.generation), "size": str(len(data))},
+                                         event_id=str(index))
+            module.catalog_and_insert(event)
+    elif name == "upload_To_bucket":
+        def request():
+            records = generator.generate_file(next(counter), "owner_0", "mac000000", 50)
+            bench.call_http(app, module.upload_json_to_gcs, json.dumps(records))
+    elif name == "query_last_timestamp":
+        def request():
+            body = {"owner": "owner_0", "mac_address": "mac000000", "experiment_names": ["exp_1", "exp_2"]}
+            bench.call_http(app, module.query_last_timestamp, json.dumps(body))
+    else:
+        def request():
+            bench.call_http(app, module.hello_http, json.dumps({"mode": "incremental"}))
+    return request
+
+
+# Runs in the child interpreter: prints {"import_ms", "first_ms", "warm_ms"} as JSON
+def child(name):
+    os.environ.setdefault("LAST_TIMESTAMP_BACKEND", "memory")
+    os.environ.setdefault("INGEST_LEDGER_BACKEND", "memory")
+    os.environ.setdefault("LABELS_POLL_SECONDS", "0.01")
+    import flask  # noqa: F401
+    import functions_framework  # noqa: F401
+
+    sys.path.insert(0, HARNESS_DIR)
+    import bench
+    import fakes
+
+    started = time.perf_counter()
+    module = bench.load_function(name, f"{name.replace('-', '_')}_main")
+    import_ms = (time.perf_counter() - started) * 1000
+
+    storage = fakes.FakeStorageClient()
+    bigquery = fakes.FakeBigQueryClient()
+    bench.install_fakes(module, storage, bigquery, {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+    request = make_request(name, module, storage, bigquery)
+
+    timings = []
+    for _ in range(2):
+        # The output of the function is not part of the result
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            started = time.perf_counter()
+            request()
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            sys.stdout = stdout
+    print(json.dumps({"import_ms": import_ms, "first_ms": timings[0], "warm_ms": timings[1]}))
+
+
+def run_child(name, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [__file__, "--child", name]
+    completed = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+# Returns [(cumulative ms, module)] of the slowest imports from python -X importtime output
+def slowest_imports(importtime_output, top=10):
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, module = line[len("import time:"):].split("|")
+        if cumulative_us.strip().isdigit():
+            imports.append((int(cumulative_us) / 1000, module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters started per function")
+    parser.add_argument("--importtime", action="store_true", help="List the slowest imports of each function")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    print(f"{'function':<22} {'import ms':>10} {'first request ms':>17} {'warm request ms':>16}")
+    for name in FUNCTIONS:
+        results = [run_child(name)[0] for _ in range(args.runs)]
+        print(f"{name:<22} {statistics.median(r['import_ms'] for r in results):>10.1f}"
+              f" {statistics.median(r['first_ms'] for r in results):>17.1f}"
+              f" {statistics.median(r['warm_ms'] for r in results):>16.1f}")
+
+    if args.importtime:
+        for name in FUNCTIONS:
+            print(f"\nSlowest imports of {name} (cumulative ms, includes the harness):")
+            for cumulative_ms, module in slowest_imports(run_child(name, importtime=True)[1]):
+                print(f"  {cumulative_ms:>8.1f}  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Bytes moved and end-to-end latency of the ingestion chain with plain and compressed transport,
+through the fakes of fakes.py.
+
+    python harness/compression_bench.py [--files 12] [--records 500] [--bandwidth 10 0]
+
+Each configuration replays the same uploads (generator.py) one at a time: the upload is
+compressed and written to the fake upload bucket, then process_files.catalog_and_insert reads
+it, posts the archive payloads to upload_To_bucket over the fake HTTP session, which writes
+the archived objects, and inserts into the fake BigQuery. Configurations:
+- plain: JSON uploads, uncompressed payloads and archived objects (the previous behaviour)
+- gzip: gzip uploads, gzip payloads, gzip archived objects (the defaults)
+- zstd: zstd uploads, zstd payloads, gzip archived objects
+Reported: bytes of the uploads, of the HTTP bodies and of the archived objects, and the median
+and p99 latency from the upload to the end of catalog_and_insert. The run is repeated for each
+--bandwidth, in megabytes per second for every storage and HTTP transfer (0: no limit, CPU only).
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import generator  # noqa: E402
+
+ARCHIVE_BUCKET = "hu-post-process-bucket"
+
+# name -> (compression of the uploads, UPLOAD_CONTENT_ENCODING, ARCHIVE_CONTENT_ENCODING)
+CONFIGURATIONS = {
+    "plain": ("none", "identity", "identity"),
+    "gzip": ("gzip", "gzip", "gzip"),
+    "zstd": ("zstd", "zstd", "gzip"),
+}
+
+
+def run(name, uploads, bandwidth):
+    compression, upload_encoding, archive_encoding = CONFIGURATIONS[name]
+    # Read by the functions when the harness imports them
+    os.environ["UPLOAD_CONTENT_ENCODING"] = upload_encoding
+    os.environ["ARCHIVE_CONTENT_ENCODING"] = archive_encoding
+
+    args = argparse.Namespace(storage_dir=None, gcs_latency=0.0, bq_latency=0.0, bandwidth=bandwidth,
+                              no_memory=True, concurrency=1, compression=compression, ndjson=False)
+    harness = bench.Harness(args)
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for file_name, records in uploads:
+            started = time.perf_counter()
+            harness.ingest(file_name, records)
+            latencies.append(time.perf_counter() - started)
+
+    records = sum(len(records) for _, records in uploads)
+    assert harness.bigquery.row_count() == records, f"{name}: {harness.bigquery.row_count()} rows of {records}"
+    assert harness.stats["process_files"].errors == 0
+    latencies.sort()
+    return {
+        "uploads": harness.storage.bytes_written.get(bench.UPLOAD_BUCKET, 0),
+        "http": harness.http.bytes_sent,
+        "archive": harness.storage.bytes_written.get(ARCHIVE_BUCKET, 0),
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=12, help="Uploads to replay")
+    parser.add_argument("--records", type=int, default=500, help="Records per upload")
+    parser.add_argument("--bandwidth", type=float, nargs="+", default=[10, 0],
+                        help="Megabytes per second of the storage and HTTP transfers, 0 for no limit")
+    args = parser.parse_args()
+
+    os.environ.setdefault("STATE_BUCKET", bench.STATE_BUCKET)
+    os.environ.setdefault("INGEST_BACKEND", "streaming")
+    uploads = list(generator.generate_uploads(args.files, args.records))
+
+    print(f"{len(uploads)} uploads of {args.records} records")
+    print(f"{'bandwidth':>9} {'config':<7} {'upload MB':>9} {'HTTP MB':>8} {'archive MB':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for bandwidth in args.bandwidth:
+        for name in CONFIGURATIONS:
+            result = run(name, uploads, bandwidth or None)
+            label = f"{bandwidth:g} MB/s" if bandwidth else "none"
+            print(f"{label:>9} {name:<7} {result['uploads'] / 1024 ** 2:>9.2f} {result['http'] / 1024 ** 2:>8.2f}"
+                  f" {result['archive'] / 1024 ** 2:>10.2f} {result['p50']:>8.1f} {result['p99']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
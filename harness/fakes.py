@@ -0,0 +1,550 @@
+# Local stand-ins for Cloud Storage, BigQuery and the HTTP calls between functions,
+# covering the API surface the four functions use. They are injected through the
+# CLIENT_FACTORIES of each main.py.
+import base64
+import copy
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import types
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+
+# Sleeps for the transfer of size bytes at bandwidth bytes per second (None: no delay)
+def transfer(size, bandwidth):
+    if bandwidth:
+        time.sleep(size / bandwidth)
+
+
+# Cloud Storage: objects kept in memory, or as files under root when it is given.
+# bytes_read / bytes_written count the bytes moved per bucket, as stored (compressed for
+# compressed objects).
+class FakeStorageClient:
+    def __init__(self, root=None, latency=0.0, bandwidth=None):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.objects = {}  # (bucket, name) -> {"data", "generation", "content_type", "content_encoding"}
+        self.generation = 0
+        self.calls = 0
+        self.call_counts = Counter()  # method -> calls
+        self.bytes_read = {}
+        self.bytes_written = {}
+
+    def call(self, method):
+        with self.lock:
+            self.calls += 1
+            self.call_counts[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
+
+    def list_blobs(self, bucket, prefix=""):
+        self.call("list_blobs")
+        bucket_name = bucket.name if isinstance(bucket, FakeBucket) else bucket
+        with self.lock:
+            names = sorted(name for bucket, name in self.objects if bucket == bucket_name and name.startswith(prefix))
+        return [FakeBlob(self, bucket_name, name) for name in names]
+
+    def _path(self, bucket_name, name):
+        return os.path.join(self.root, bucket_name, quote(name, safe="/"))
+
+    def read(self, bucket_name, name):
+        with self.lock:
+            entry = self.objects.get((bucket_name, name))
+        if entry is None:
+            raise NotFound(f"gs://{bucket_name}/{name}")
+        if self.root:
+            with open(self._path(bucket_name, name), "rb") as f:
+                data = f.read()
+        else:
+            data = entry["data"]
+        with self.lock:
+            self.bytes_read[bucket_name] = self.bytes_read.get(bucket_name, 0) + len(data)
+        transfer(len(data), self.bandwidth)
+        return data, entry
+
+    def write(self, bucket_name, name, data, content_type=None, content_encoding=None, if_generation_match=None):
+        with self.lock:
+            current = self.objects.get((bucket_name, name))
+            if if_generation_match is not None and (current["generation"] if current else 0) != if_generation_match:
+                raise PreconditionFailed(f"gs://{bucket_name}/{name}")
+            self.generation += 1
+            self.bytes_written[bucket_name] = self.bytes_written.get(bucket_name, 0) + len(data)
+            entry = {"generation": self.generation, "content_type": content_type,
+                     "content_encoding": content_encoding, "size": len(data)}
+            if self.root:
+                path = self._path(bucket_name, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+            else:
+                entry["data"] = data
+            self.objects[(bucket_name, name)] = entry
+        transfer(len(data), self.bandwidth)
+        return entry
+
+    # Copies a local file into an object stored under root
+    def write_file(self, bucket_name, name, filename, content_type=None, content_encoding=None):
+        path = self._path(bucket_name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.generation += 1
+            self.bytes_written[bucket_name] = self.bytes_written.get(bucket_name, 0) + size
+            entry = {"generation": self.generation, "content_type": content_type,
+                     "content_encoding": content_encoding, "size": size}
+            self.objects[(bucket_name, name)] = entry
+        return entry
+
+    # Opens the file of an object stored under root; its size is counted as read at once
+    def open_file(self, bucket_name, name):
+        with self.lock:
+            entry = self.objects.get((bucket_name, name))
+        if entry is None:
+            raise NotFound(f"gs://{bucket_name}/{name}")
+        with self.lock:
+            self.bytes_read[bucket_name] = self.bytes_read.get(bucket_name, 0) + entry["size"]
+        transfer(entry["size"], self.bandwidth)
+        return open(self._path(bucket_name, name), "rb"), entry
+
+    def delete(self, bucket_name, name):
+        with self.lock:
+            if self.objects.pop((bucket_name, name), None) is None:
+                raise NotFound(f"gs://{bucket_name}/{name}")
+        if self.root:
+            os.remove(self._path(bucket_name, name))
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.client, self.name, name)
+
+
+class FakeBlob:
+    def __init__(self, client, bucket_name, name):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = name
+        self.content_encoding = None
+        self.generation = None
+        self.size = None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.client.call("upload_from_string")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        entry = self.client.write(self.bucket_name, self.name, data, content_type, self.content_encoding,
+                                  if_generation_match)
+        self.generation = entry["generation"]
+        self.size = entry["size"]
+
+    def upload_from_file(self, file_obj, content_type=None):
+        self.upload_from_string(file_obj.read(), content_type)
+
+    # With a root, the file is copied without being read into memory
+    def upload_from_filename(self, filename, content_type=None):
+        if not self.client.root:
+            with open(filename, "rb") as f:
+                return self.upload_from_string(f.read(), content_type)
+        self.client.call("upload_from_filename")
+        entry = self.client.write_file(self.bucket_name, self.name, filename, content_type, self.content_encoding)
+        self.generation = entry["generation"]
+        self.size = entry["size"]
+
+    # gzip objects are decompressed unless raw_download, like the decompressive transcoding
+    # of Cloud Storage
+    def download_as_bytes(self, raw_download=False):
+        self.client.call("download_as_bytes")
+        data, entry = self.client.read(self.bucket_name, self.name)
+        self.generation = entry["generation"]
+        self.content_encoding = entry["content_encoding"]
+        if entry["content_encoding"] == "gzip" and not raw_download:
+            data = gzip.decompress(data)
+        return data
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode("utf-8")
+
+    # With a root, the object is read from its file as the stream is read, like the ranged reads
+    # of the client
+    def open(self, mode="rb", chunk_size=None, raw_download=False):
+        if not self.client.root:
+            return io.BytesIO(self.download_as_bytes(raw_download=raw_download))
+        self.client.call("open")
+        stream, entry = self.client.open_file(self.bucket_name, self.name)
+        self.generation = entry["generation"]
+        self.content_encoding = entry["content_encoding"]
+        if entry["content_encoding"] == "gzip" and not raw_download:
+            return gzip.GzipFile(fileobj=stream)
+        return stream
+
+    def exists(self):
+        self.client.call("exists")
+        with self.client.lock:
+            return (self.bucket_name, self.name) in self.client.objects
+
+    def delete(self):
+        self.client.call("delete")
+        self.client.delete(self.bucket_name, self.name)
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00").replace(" ", "T"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+# TimeStamp >= start OR TimeStamp IS NULL, the partition filter of fetch_google/sensor_cache.py
+def _timestamp_from(row, start):
+    timestamp = _parse_timestamp(row.get("TimeStamp"))
+    return timestamp is None or timestamp >= start
+
+
+class FakeQueryJob:
+    def __init__(self, rows, total_bytes_processed=0, schema=None):
+        self.rows = rows
+        self.total_bytes_processed = total_bytes_processed
+        self.schema = schema
+        self.job_id = f"fake_job_{id(self)}"
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self.rows
+
+    # Arrow table typed from the BigQuery schema of the columns, like the client's to_arrow
+    def to_arrow(self):
+        import pyarrow as pa
+
+        fields = self.schema or []
+        columns = {}
+        for field in fields:
+            values = [row.get(field.name) for row in self.rows]
+            if field.mode == "REPEATED":
+                columns[field.name] = pa.array(values, type=pa.list_(pa.string()))
+            elif field.field_type in ("FLOAT64", "FLOAT"):
+                columns[field.name] = pa.array(values, type=pa.float64())
+            elif field.field_type == "TIMESTAMP":
+                columns[field.name] = pa.array([_parse_timestamp(value) for value in values],
+                                               type=pa.timestamp("us", tz="UTC"))
+            else:
+                columns[field.name] = pa.array([None if value is None else str(value) for value in values],
+                                               type=pa.string())
+        return pa.table(columns)
+
+    def to_dataframe(self):
+        return self.to_arrow().to_pandas()
+
+
+# BigQuery: datasets, tables (the bigquery.Table objects given to create_table) and their rows.
+# Tables have an etag, changed by metadata updates and by the DML of the update-labels scripts.
+# Streaming inserts deduplicate on insertId and reject fields missing from the schema.
+# query() only evaluates the queries of query_last_timestamp, the watermark of the
+# update-labels incremental script, the two queries of fetch_google/stats_collector.py, the
+# incremental reads and experiment refetches of fetch_google/sensor_cache.py and time ranges
+# of selected columns; every other statement succeeds without changing the rows. Dry runs estimate the bytes
+# processed as the JSON size of the rows of the table. bytes_scanned adds up the bytes the
+# query_last_timestamp queries read, as BigQuery bills them: 8 bytes per TIMESTAMP and 2 bytes
+# plus the length per STRING, over the day partitions within the lookback.
+class FakeBigQueryClient:
+    def __init__(self, project="iucc-f4d", latency=0.0):
+        self.project = project
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.datasets = set()
+        self.tables = {}  # "project.dataset.table" -> bigquery.Table
+        self.rows = {}  # "project.dataset.table" -> [row]
+        self.insert_ids = {}  # "project.dataset.table" -> set of insertIds
+        self.calls = 0
+        self.call_counts = Counter()  # method -> calls
+        self.bytes_scanned = 0
+
+    def __call__(self, project=None):
+        # Used as the factory: every function shares this client
+        return self
+
+    def call(self, method):
+        with self.lock:
+            self.calls += 1
+            self.call_counts[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _ref(self, ref):
+        ref = str(ref).strip("`")
+        return ref if ref.count(".") == 2 else f"{self.project}.{ref}"
+
+    def get_dataset(self, dataset_ref):
+        self.call("get_dataset")
+        dataset_id = str(dataset_ref).split(".")[-1]
+        if dataset_id not in self.datasets:
+            raise NotFound(f"Dataset {dataset_ref}")
+        return types.SimpleNamespace(dataset_id=dataset_id, project=self.project)
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.call("create_dataset")
+        with self.lock:
+            self.datasets.add(dataset.dataset_id)
+        return dataset
+
+    def list_datasets(self):
+        self.call("list_datasets")
+        return [types.SimpleNamespace(dataset_id=dataset_id) for dataset_id in sorted(self.datasets)]
+
+    def list_tables(self, dataset_id):
+        self.call("list_tables")
+        prefix = f"{self.project}.{dataset_id}."
+        return [types.SimpleNamespace(table_id=ref[len(prefix):]) for ref in sorted(self.tables) if ref.startswith(prefix)]
+
+    # Returns a copy of the table, like each get_table of the client returns a new object
+    def get_table(self, table_ref):
+        self.call("get_table")
+        table = self.tables.get(self._ref(table_ref))
+        if table is None:
+            raise NotFound(f"Table {table_ref}")
+        with self.lock:
+            return bigquery.Table.from_api_repr(copy.deepcopy(table.to_api_repr()))
+
+    # A new etag for the table, after a change of its metadata or of its rows by a DML statement
+    def _touch(self, ref):
+        table = self.tables[ref]
+        table._properties["etag"] = str(int(table._properties.get("etag", "0")) + 1)
+
+    def create_table(self, table, exists_ok=False):
+        self.call("create_table")
+        ref = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        with self.lock:
+            if ref not in self.tables:
+                self.tables[ref] = table
+                self.rows[ref] = []
+                self.insert_ids[ref] = set()
+                self._touch(ref)
+            return self.tables[ref]
+
+    # Like the client, sends the etag of the table when it has one: the update fails with
+    # PreconditionFailed when the table changed since it was read
+    def update_table(self, table, fields):
+        self.call("update_table")
+        ref = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        with self.lock:
+            stored = self.tables.get(ref)
+            if stored is None:
+                raise NotFound(f"Table {ref}")
+            if table.etag and table.etag != stored.etag:
+                raise PreconditionFailed(f"Table {ref} changed since it was read (etag {table.etag})")
+            for field in fields:
+                setattr(stored, field, getattr(table, field))
+            self._touch(ref)
+            return bigquery.Table.from_api_repr(copy.deepcopy(stored.to_api_repr()))
+
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        self.call("insert_rows_json")
+        ref = self._ref(table_ref)
+        table = self.tables.get(ref)
+        if table is None:
+            raise NotFound(f"Table {table_ref}")
+        field_names = {field.name for field in table.schema}
+        errors = []
+        with self.lock:
+            for index, row in enumerate(json_rows):
+                unknown = [name for name in row if name not in field_names]
+                if unknown:
+                    errors.append({"index": index, "errors": [
+                        {"reason": "invalid", "message": f"no such field: {unknown[0]}."}]})
+                    continue
+                insert_id = row_ids[index] if row_ids else None
+                if insert_id is not None and insert_id in self.insert_ids[ref]:
+                    continue
+                self.insert_ids[ref].add(insert_id)
+                self.rows[ref].append(row)
+            # Table metadata read by stats_collector.table_version
+            now = str(int(time.time() * 1000))
+            table._properties["lastModifiedTime"] = now
+            table._properties["numRows"] = str(len(self.rows[ref]))
+            # Streamed rows stay in the streaming buffer until flush_streaming_buffer
+            buffer = table._properties.setdefault("streamingBuffer", {"estimatedRows": "0", "oldestEntryTime": now})
+            buffer["estimatedRows"] = str(int(buffer["estimatedRows"]) + len(json_rows) - len(errors))
+        return errors
+
+    # Moves the streamed rows of a table to its storage, as BigQuery does within 90 minutes
+    def flush_streaming_buffer(self, table_ref):
+        with self.lock:
+            self.tables[self._ref(table_ref)]._properties.pop("streamingBuffer", None)
+
+    def query(self, query, job_config=None):
+        self.call("query")
+        params = {}
+        for param in getattr(job_config, "query_parameters", None) or []:
+            params[param.name] = param.values if hasattr(param, "values") else param.value
+        match = re.search(r"`([^`]+)`", query)
+        ref = self._ref(match.group(1)) if match else None
+        rows = self.rows.get(ref, []) if match else []
+
+        if getattr(job_config, "dry_run", False):
+            return FakeQueryJob([], sum(len(json.dumps(row, default=str)) for row in rows))
+        if "COUNT(DISTINCT SensorData_Name)" in query:
+            return FakeQueryJob(self._combined_stats(rows))
+        if "DATE(TimeStamp) AS date" in query:
+            return FakeQueryJob(self._daily_counts(rows))
+        if "InsertDate > @window_start AND InsertDate <= @cutoff" in query and query.lstrip().startswith("SELECT"):
+            # Incremental reads of fetch_google/sensor_cache.py
+            rows = [row for row in rows
+                    if params["window_start"] < _parse_timestamp(row.get("InsertDate")) <= params["cutoff"]
+                    and _timestamp_from(row, params["timestamp_start"])]
+            return FakeQueryJob(rows, schema=self.tables[ref].schema)
+        if "ExperimentData_Exp_name IN UNNEST(@experiments)" in query:
+            # Experiments fetched again by fetch_google/sensor_cache.py
+            experiments = set(params["experiments"])
+            rows = [row for row in rows
+                    if (row.get("ExperimentData_Exp_name") in experiments
+                        or (params["null_experiment"] and row.get("ExperimentData_Exp_name") is None))
+                    and _parse_timestamp(row.get("InsertDate")) <= params["cutoff"]
+                    and _timestamp_from(row, params["timestamp_start"])]
+            return FakeQueryJob(rows, schema=self.tables[ref].schema)
+        if "TimeStamp >= @start AND TimeStamp < @end" in query:
+            # Time range of selected columns, e.g. SELECT a, b FROM `table` WHERE TimeStamp >= @start AND ...
+            names = [name.strip() for name in query.split("SELECT", 1)[1].split("FROM", 1)[0].split(",")]
+            schema = [field for field in self.tables[ref].schema if field.name in names]
+            rows = [{name: row.get(name) for name in names} for row in rows
+                    if params["start"] <= _parse_timestamp(row.get("TimeStamp")) < params["end"]]
+            return FakeQueryJob(rows, schema=schema)
+        if "MAX(TimeStamp)" in query and "experiment_names" in params:
+            rows, scanned = self._max_timestamps(rows, params)
+            with self.lock:
+                self.bytes_scanned += scanned
+            return FakeQueryJob(rows, scanned)
+        if "DECLARE new_watermark" in query:
+            insert_dates = [
+                _parse_timestamp(row.get("InsertDate")) for row in rows
+                if params["watermark"] < _parse_timestamp(row.get("InsertDate")) <= params["cutoff"]
+            ]
+            if insert_dates:
+                # The MERGE of the script ran
+                with self.lock:
+                    self._touch(ref)
+            return FakeQueryJob([{"new_watermark": max(insert_dates) if insert_dates else None}])
+        if query.lstrip().startswith("CREATE OR REPLACE TABLE") and ref in self.tables:
+            with self.lock:
+                self._touch(ref)
+        return FakeQueryJob([])
+
+    def _max_timestamps(self, rows, params):
+        names = set(params["experiment_names"])
+        oldest = first_partition = None
+        if params.get("lookback_days"):
+            oldest = datetime.now(timezone.utc).timestamp() - params["lookback_days"] * 86400
+            first_partition = oldest - oldest % 86400
+        last_timestamps = {}
+        scanned = 0
+        for row in rows:
+            name = row.get("ExperimentData_Exp_name")
+            timestamp = _parse_timestamp(row.get("TimeStamp"))
+            if first_partition and (timestamp is None or timestamp.timestamp() < first_partition):
+                continue
+            scanned += 8 + 2 + len((name or "").encode("utf-8"))
+            if name not in names or timestamp is None or (oldest and timestamp.timestamp() < oldest):
+                continue
+            if name not in last_timestamps or timestamp > last_timestamps[name]:
+                last_timestamps[name] = timestamp
+        return [{"experiment_name": name, "last_timestamp": timestamp}
+                for name, timestamp in last_timestamps.items()], scanned
+
+    def _combined_stats(self, rows):
+        stats = {}
+        for row in rows:
+            entry = stats.setdefault(row.get("ExperimentData_Exp_name"), {"sensors": set(), "num_entries": 0, "last": None})
+            entry["num_entries"] += 1
+            if row.get("SensorData_Name") is not None:
+                entry["sensors"].add(row["SensorData_Name"])
+            timestamp = _parse_timestamp(row.get("TimeStamp"))
+            if timestamp is not None and (entry["last"] is None or timestamp > entry["last"]):
+                entry["last"] = timestamp
+        return [
+            {"ExperimentData_Exp_name": name, "sensor_count": len(entry["sensors"]),
+             "num_entries": entry["num_entries"], "last_timestamp": entry["last"]}
+            for name, entry in sorted(stats.items(), key=lambda item: item[0] or "")
+        ]
+
+    def _daily_counts(self, rows):
+        counts = {}
+        for row in rows:
+            timestamp = _parse_timestamp(row.get("TimeStamp"))
+            date = timestamp.date() if timestamp is not None else None
+            counts[date] = counts.get(date, 0) + 1
+        return [{"date": date, "num_entries": num_entries}
+                for date, num_entries in sorted(counts.items(), key=lambda item: item[0] or datetime.min.date())]
+
+    def row_count(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+
+# ID token accepted by google.auth.jwt.decode(verify=False), valid for an hour
+def fake_id_token(audience):
+    def segment(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+    claims = {"aud": audience, "exp": int(time.time()) + 3600}
+    return f"{segment({'alg': 'none', 'typ': 'JWT'})}.{segment(claims)}.{segment('signature')}"
+
+
+class FakeResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+# HTTP session posting to the other functions in process. routes maps the last path segment
+# of the URL to a callable taking (payload bytes, headers) and returning (status, text).
+# bytes_sent counts the request bodies, as sent (compressed or not).
+class FakeHttpSession:
+    def __init__(self, routes, bandwidth=None):
+        self.routes = routes
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        route = self.routes.get(url.rstrip("/").rsplit("/", 1)[-1])
+        if route is None:
+            return FakeResponse(404, f"No route for {url}")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.lock:
+            self.bytes_sent += len(data)
+        transfer(len(data), self.bandwidth)
+        status_code, text = route(data, headers or {})
+        return FakeResponse(status_code, text)
+
+
+# Storage trigger event: data plus the id and type attributes read with event["id"]
+class FakeCloudEvent(dict):
+    def __init__(self, data, event_id, event_type="google.cloud.storage.object.v1.finalized"):
+        super().__init__(id=event_id, type=event_type)
+        self.data = data
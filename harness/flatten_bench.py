@@ -0,0 +1,56 @@
+"""
+Time of flatten_record, the memoized flattener of the process_files insert path, against
+flatten_json on synthetic sensor records.
+
+    python harness/flatten_bench.py [--records 20000] [--runs 5]
+
+Each run flattens every record with both functions, after a first pass that compiles the key
+plans of flatten_record (warm instance) and fills the cache of its timestamp parser. Median of
+--runs runs, in milliseconds and microseconds per record.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import generator  # noqa: E402
+
+
+def timed(runs, func, records):
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for record in records:
+            func(record)
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    module = bench.load_function("process_files", "process_files_main")
+    records = [record for _, file_records in generator.generate_uploads(-(-args.records // 500), 500)
+               for record in file_records][:args.records]
+    for record in records:
+        assert module.flatten_record(record) == module.flatten_json(record)
+
+    print(f"{len(records)} records, median of {args.runs} runs")
+    baseline = None
+    for name, func in (("flatten_json", module.flatten_json), ("flatten_record", module.flatten_record)):
+        seconds = timed(args.runs, func, records)
+        baseline = baseline or seconds
+        print(f"{name:<16}{seconds * 1000:>9.1f} ms{seconds / len(records) * 1e6:>8.1f} us/record"
+              f"{baseline / seconds:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
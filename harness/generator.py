@@ -0,0 +1,89 @@
+# Synthetic sensor records with the Owner/ExperimentData/SensorData/MetaData shape of the
+# uploaded files (see the example in process_files/README.md)
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+SENSORS_PER_DEVICE = 5
+
+SENSOR_FIELDS = [
+    "tmp107_amb", "tmp107_obj", "rssi",
+    "bmp_390_u18_pressure", "bmp_390_u18_temperature", "bmp_390_u19_pressure", "bmp_390_u19_temperature",
+    "hdc_2010_u13_temperature", "hdc_2010_u13_humidity", "hdc_2010_u16_temperature", "hdc_2010_u16_humidity",
+    "hdc_2010_u17_temperature", "hdc_2010_u17_humidity",
+    "opt_3001_u1_light_intensity", "opt_3001_u2_light_intensity", "opt_3001_u3_light_intensity",
+    "opt_3001_u4_light_intensity", "opt_3001_u5_light_intensity",
+    "batmon_temperature", "batmon_battery_voltage", "co2_ppm", "air_velocity",
+]
+
+
+def make_record(rng, owner, mac_address, exp_id, sensor, timestamp):
+    exp_name = f"exp_{exp_id}"
+    lla = f"{mac_address}_{sensor}"
+    iso_timestamp = timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + f"{timestamp.microsecond // 1000:03d}Z"
+    sensor_data = {
+        "Name": f"Sensor_{sensor}",
+        "battery": rng.randint(2500, 3300),
+        "temperature": round(rng.uniform(15, 35), 2),
+        "humidity": round(rng.uniform(30, 90), 2),
+        "light": round(rng.uniform(0, 2000), 1),
+        "barometric_pressure": round(rng.uniform(990, 1030), 2),
+        "barometric_temp": round(rng.uniform(15, 35), 2),
+        "Coordinates": {"x": sensor, "y": 0, "z": 0},
+        "Labels": ["synthetic"] if rng.random() < 0.1 else [],
+        "LabelOptions": ["synthetic", "control"],
+    }
+    for field in SENSOR_FIELDS:
+        sensor_data[field] = round(rng.uniform(0, 100), 3) if rng.random() < 0.5 else None
+
+    return {
+        "UniqueID": f"{exp_name}_{lla}_{iso_timestamp}_{mac_address}",
+        "Owner": owner,
+        "MetaData": {
+            "LLA": lla,
+            "Location": f"Sensor_{sensor}",
+            "Coordinates": {"x": sensor, "y": 0, "z": 0},
+            "Version": "V1",
+            "GeneralData": {
+                "Project": "Synthetic Project",
+                "Researcher": "Load Test",
+                "Institution": "Harness",
+                "Description": "Synthetic sensor data for the offline harness",
+            },
+        },
+        "ExperimentData": {"MAC_address": mac_address, "Exp_id": exp_id, "Exp_name": exp_name},
+        "TimeStamp": iso_timestamp,
+        "SensorData": sensor_data,
+    }
+
+
+# Returns the records of one upload: records_per_file readings spread over the sensors of
+# one owner/MAC, one minute apart, starting at start
+def generate_file(seed, owner, mac_address, records_per_file, experiments=2, sensors=SENSORS_PER_DEVICE, start=None):
+    rng = random.Random(seed)
+    start = start or datetime.now(timezone.utc) - timedelta(hours=1)
+    records = []
+    for index in range(records_per_file):
+        timestamp = start + timedelta(minutes=index // sensors)
+        exp_id = 1 + (index // sensors) % experiments
+        records.append(make_record(rng, owner, mac_address, exp_id, index % sensors, timestamp))
+    return records
+
+
+# Yields (file name, records) of the uploads: owners x macs devices, taking turns
+def generate_uploads(files, records_per_file, owners=2, macs_per_owner=3, experiments=2, seed=0):
+    devices = [(f"owner_{owner}", f"mac{owner:02d}{mac:04x}") for owner in range(owners) for mac in range(macs_per_owner)]
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    for index in range(files):
+        owner, mac_address = devices[index % len(devices)]
+        # Each file continues the readings of the previous file of the same device
+        file_minutes = -(-records_per_file // SENSORS_PER_DEVICE)
+        file_start = start + timedelta(minutes=file_minutes * (index // len(devices)))
+        records = generate_file(seed + index, owner, mac_address, records_per_file, experiments, start=file_start)
+        yield f"{owner}/{mac_address}/upload_{index:06d}.json", records
+
+
+def serialize(records, ndjson=False):
+    if ndjson:
+        return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+    return json.dumps(records).encode("utf-8")
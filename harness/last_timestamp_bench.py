@@ -0,0 +1,117 @@
+"""
+Latency of query_last_timestamp answered from the last-timestamp index, against the queries to
+BigQuery it falls back to, with the fakes of fakes.py.
+
+    python harness/last_timestamp_bench.py [--requests 50] [--experiments 5] [--records 2000]
+                                           [--bq-latency 0.5] [--gcs-latency 0.02]
+
+--records readings of one device over --experiments experiments are ingested by process_files
+into the fake BigQuery, then query_last_timestamp is asked --requests times for the last
+timestamp of every experiment, with each index configuration (a new instance of the function
+each):
+- no index: LAST_TIMESTAMP_BACKEND=none, every request queries BigQuery
+- index miss: the gcs backend, with the owner/MAC invalidated before each request, so every
+  request queries BigQuery and back-fills the index
+- warm index (gcs): the gcs backend, back-filled by a first request that is not counted
+- warm index (memory): the in-process backend, back-filled the same way
+Every BigQuery call of the fake takes --bq-latency seconds (a query job round trip) and every
+storage call --gcs-latency seconds (a read of the index object). Reported: p50 and p99 latency
+in milliseconds and BigQuery queries per request. The responses of every configuration are
+checked to be equal.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+OWNER = "owner_0"
+MAC_ADDRESS = "mac0"
+STATE_BUCKET = "bench-state"
+
+
+# Imports query_last_timestamp with the index backend given, the environment restored afterwards
+def load_query(module_name, backend):
+    saved = {name: os.environ.get(name) for name in ("STATE_BUCKET", "LAST_TIMESTAMP_BACKEND")}
+    os.environ.update(STATE_BUCKET=STATE_BUCKET, LAST_TIMESTAMP_BACKEND=backend)
+    try:
+        return bench.load_function("query_last_timestamp", module_name)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def make_source(args):
+    bigquery = fakes.FakeBigQueryClient()
+    module = bench.load_function("process_files", "process_files_main")
+    bench.install_fakes(module, fakes.FakeStorageClient(), bigquery, {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+    records = generator.generate_file(0, OWNER, MAC_ADDRESS, args.records, experiments=args.experiments)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = module.process_data(records)
+    assert stats["ok"], stats["errors"]
+    return bigquery
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--experiments", type=int, default=5, help="Experiments of the device, all asked for")
+    parser.add_argument("--records", type=int, default=2000, help="Readings ingested before the requests")
+    parser.add_argument("--bq-latency", type=float, default=0.5, help="Seconds per BigQuery call")
+    parser.add_argument("--gcs-latency", type=float, default=0.02, help="Seconds per storage call")
+    args = parser.parse_args()
+
+    import flask
+
+    app = flask.Flask("last_timestamp_bench")
+    bigquery = make_source(args)
+    bigquery.latency = args.bq_latency
+    body = json.dumps({"owner": OWNER, "mac_address": MAC_ADDRESS,
+                       "experiment_names": [f"exp_{exp_id}" for exp_id in range(1, args.experiments + 1)]})
+
+    configs = [("no index", "none", False, False), ("index miss", "gcs", False, True),
+               ("warm index (gcs)", "gcs", True, False), ("warm index (memory)", "memory", True, False)]
+    print(f"{args.requests} requests for {args.experiments} experiments, {args.bq_latency * 1000:.0f} ms per BigQuery"
+          f" call, {args.gcs_latency * 1000:.0f} ms per storage call")
+    print(f"{'config':<21}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}")
+    expected = None
+    for index, (name, backend, warm, invalidate) in enumerate(configs):
+        module = load_query(f"query_last_timestamp_{index}", backend)
+        bench.install_fakes(module, fakes.FakeStorageClient(latency=args.gcs_latency), bigquery)
+        module._clients.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if warm:
+                bench.call_http(app, module.query_last_timestamp, body)
+            bigquery.call_counts.clear()
+            latencies = []
+            for _ in range(args.requests):
+                if invalidate:
+                    module.last_timestamp_index.invalidate_last_timestamps(OWNER, MAC_ADDRESS)
+                started = time.perf_counter()
+                status, text = bench.call_http(app, module.query_last_timestamp, body)
+                latencies.append(time.perf_counter() - started)
+                assert status == 200, text
+        response = json.loads(text)
+        assert expected is None or response == expected, f"{name}: {response} != {expected}"
+        expected = response
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+        print(f"{name:<21}{statistics.median(latencies) * 1000:>9.1f}{p99 * 1000:>9.1f}"
+              f"{bigquery.call_counts['query'] / args.requests:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
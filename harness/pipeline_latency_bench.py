@@ -0,0 +1,86 @@
+"""
+Latency of process_files.process_data, whose archival and BigQuery branches run at the same
+time, against the same steps run one after the other, with delays injected in the fakes.
+
+    python harness/pipeline_latency_bench.py [--records 2000] [--batches 5]
+                                             [--bq-latency 0.05] [--upload-latency 0.1] [--runs 3]
+
+Every fake BigQuery call takes --bq-latency seconds, and every request of the upload_To_bucket
+stand-in (upload_standin.py) --upload-latency seconds. Each batch of --records records goes to
+tables that already exist, like the uploads of known devices. The sequential run calls the
+steps of process_data in order: send_lists_to_gcs, then create_bq_datasets_and_tables,
+map_tables_to_lists and batch_insert_to_bq. Median latency per batch over --runs runs, in ms.
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+os.environ.setdefault("INGEST_LEDGER_BACKEND", "none")
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+from upload_standin import UploadStandIn  # noqa: E402
+
+
+# The steps of process_data one after the other
+def process_sequentially(module, records):
+    batch = module.build_record_batch(records)
+    table_pairs = module.extract_paths(batch)[3]
+    failed_chunks = module.send_lists_to_gcs(records)
+    module.create_bq_datasets_and_tables(table_pairs, batch)
+    results = module.batch_insert_to_bq(module.map_tables_to_lists(batch))
+    assert not failed_chunks and not any(result["rows_failed"] for result in results.values())
+
+
+def process_concurrently(module, records):
+    stats = module.process_data(records)
+    assert stats["ok"], stats["errors"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--bq-latency", type=float, default=0.05)
+    parser.add_argument("--upload-latency", type=float, default=0.1)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    module = bench.load_function("process_files", "process_files_main")
+    batches = [generator.generate_file(seed, f"owner_{seed % 2}", f"mac{seed % 3}", args.records)
+               for seed in range(args.batches)]
+
+    print(f"{args.batches} batches of {args.records} records, BigQuery {args.bq_latency * 1000:.0f} ms per call, "
+          f"upload_To_bucket {args.upload_latency * 1000:.0f} ms per request, median of {args.runs} runs")
+    results = {}
+    for mode, process in (("sequential", process_sequentially), ("concurrent", process_concurrently)):
+        latencies = []
+        for _ in range(args.runs):
+            bench.install_fakes(module, fakes.FakeStorageClient(), fakes.FakeBigQueryClient(latency=args.bq_latency),
+                                {"upload_To_bucket": UploadStandIn(module.compression.decompress,
+                                                                   latency=args.upload_latency)})
+            module._http_session = None
+            module._schema_cache.clear()
+            module._routing_index.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                # Creates the tables
+                process(module, batches[0])
+                for records in batches:
+                    started = time.perf_counter()
+                    process(module, records)
+                    latencies.append(time.perf_counter() - started)
+        results[mode] = statistics.median(latencies)
+        print(f"{mode:<12}{results[mode] * 1000:>9.1f} ms per batch")
+    print(f"speedup     {results['sequential'] / results['concurrent']:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
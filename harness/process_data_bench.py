@@ -0,0 +1,83 @@
+"""
+CPU time of process_files.process_data on synthetic records, with the fakes of fakes.py.
+
+    python harness/process_data_bench.py [--records 100000] [--batch-size 5000] [--runs 3]
+
+The records (--records, in batches of --batch-size as catalog_and_insert hands them over)
+go through process_data with the streaming backend of the fake BigQuery. upload_To_bucket
+answers at once, so the archival branch only costs the serialization of its payloads.
+Reported: process CPU time of all threads (time.process_time) and the stage times summed over
+the batches, median of --runs runs over new fake tables. The first run, which creates the
+tables, is not counted.
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+os.environ.setdefault("LAST_TIMESTAMP_BACKEND", "memory")
+os.environ.setdefault("INGEST_LEDGER_BACKEND", "none")
+os.environ.setdefault("INGEST_BACKEND", "streaming")
+os.environ.setdefault("DAILY_STATS_BACKEND", "memory")
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+
+def run(module, batches):
+    stages = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.process_time()
+        for batch in batches:
+            stats = module.process_data(batch)
+            assert stats["ok"], stats["errors"]
+            for name, seconds in stats["stages"].items():
+                stages[name] = stages.get(name, 0.0) + seconds
+        cpu = time.process_time() - started
+    return cpu, stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    records = [record for _, file_records in generator.generate_uploads(args.records // 500, 500)
+               for record in file_records]
+    batches = [records[i:i + args.batch_size] for i in range(0, len(records), args.batch_size)]
+
+    module = bench.load_function("process_files", "process_files_main")
+    results = []
+    for index in range(args.runs + 1):
+        bigquery = fakes.FakeBigQueryClient()
+        bench.install_fakes(module, fakes.FakeStorageClient(), bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        module._clients.clear()
+        module._http_session = None
+        module._schema_cache.clear()
+        module._routing_index.clear()
+        # Tables are created by a first batch, like the uploads of known devices
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.process_data(batches[0])
+        cpu, stages = run(module, batches)
+        assert bigquery.row_count() == len(records)
+        if index:
+            results.append((cpu, stages))
+
+    print(f"{len(records)} records in {len(batches)} batches, median of {args.runs} runs")
+    print(f"process CPU time: {statistics.median(cpu for cpu, _ in results):.2f} s")
+    for name in results[0][1]:
+        print(f"  {name:<32} {statistics.median(stages[name] for _, stages in results):>7.2f} s (wall)")
+
+
+if __name__ == "__main__":
+    main()
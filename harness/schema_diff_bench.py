@@ -0,0 +1,93 @@
+"""
+Time of the schema diff of process_files (find_new_fields on a record batch) against the
+per-row loop it replaced, on flattened rows with many columns.
+
+    python harness/schema_diff_bench.py [--rows 50000] [--columns 200] [--new-columns 10] [--runs 3]
+
+The rows have --columns columns of floats, strings, lists and timestamps, some of them null.
+Two cases are timed: every column already in the table (the common path), and --new-columns
+columns missing from it. The per-row loop walks every field of every row and appends a field
+for each row a new column appears in; find_new_fields types each column once from the value
+kinds of the batch. Building the batch is not counted, process_data builds it once for all
+its steps. Median of --runs runs, in milliseconds.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+
+
+# Rows of columns named col_000..., typed by their index
+def make_rows(rows, columns, seed=0):
+    rng = random.Random(seed)
+    names = [f"col_{index:03d}" for index in range(columns - 1)]
+    result = []
+    for row_index in range(rows):
+        row = {"TimeStamp": f"2024-01-01T00:{row_index % 60:02d}:00.000000+00:00"}
+        for index, name in enumerate(names):
+            if rng.random() < 0.2:
+                row[name] = None
+            elif index % 4 == 0:
+                row[name] = f"value_{rng.randint(0, 9)}"
+            elif index % 4 == 1:
+                row[name] = ["a", "b"]
+            else:
+                row[name] = rng.uniform(0, 100)
+        result.append(row)
+    return result
+
+
+# The per-row diff of update_table_schema_if_needed before the schema cache (without its API calls)
+def per_row_diff(existing_fields, rows):
+    new_fields = []
+    for row in rows:
+        for field_name, value in row.items():
+            if field_name not in existing_fields:
+                if isinstance(value, (int, float)):
+                    field_type = "FLOAT64"
+                else:
+                    field_type = "STRING"
+                new_fields.append((field_name, field_type))
+    return new_fields
+
+
+def timed(runs, func, *args):
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func(*args)
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--columns", type=int, default=200)
+    parser.add_argument("--new-columns", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    module = bench.load_function("process_files", "process_files_main")
+    rows = make_rows(args.rows, args.columns)
+    batch = module.RecordBatch.from_rows(rows)
+    all_fields = set(batch.column_names)
+
+    print(f"{args.rows} rows x {args.columns} columns, median of {args.runs} runs")
+    print(f"{'case':<16}{'per-row ms':>12}{'fields':>9}{'batch ms':>10}{'fields':>8}")
+    for case, existing_fields in (("no new columns", all_fields),
+                                  (f"{args.new_columns} new columns", set(sorted(all_fields)[args.new_columns:]))):
+        per_row_ms, per_row_fields = timed(args.runs, per_row_diff, existing_fields, rows)
+        batch_ms, batch_fields = timed(args.runs, module.find_new_fields, existing_fields, batch)
+        print(f"{case:<16}{per_row_ms:>12.1f}{len(per_row_fields):>9}{batch_ms:>10.1f}{len(batch_fields):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Time of the schema inference of process_files (infer_schema on the record batch) over a large
+heterogeneous batch, against the schema of the first record that new tables used to get.
+
+    python harness/schema_inference_bench.py [--records 100000] [--optional-fields 20] [--runs 3]
+
+The records are those of generator.py, where half of the sensor fields are null in a given
+record, plus --optional-fields fields that each appear in about 1% of the records, some of them
+as lists or as numbers in some records and text in others. Reported, median of --runs runs in
+milliseconds: flattening the records into the batch (done once by process_data for all its
+steps), inferring the schema from the first record and from the whole batch, the fields of each
+schema and those of the batch it lacks. Then, with the fake BigQuery, the schema calls made by
+the first insert into a table created with each schema.
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+os.environ.setdefault("INGEST_BACKEND", "streaming")
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+SCHEMA_CALLS = ("get_table", "update_table")
+
+
+# Records of one device with optional_fields rare fields of mixed kinds
+def make_records(records, optional_fields, seed=0):
+    rng = random.Random(seed)
+    result = generator.generate_file(seed, "owner_0", "mac0", records)
+    for record in result:
+        for index in range(optional_fields):
+            if rng.random() < 0.01:
+                if index % 3 == 0:
+                    value = [f"tag_{rng.randint(0, 9)}"]
+                elif index % 3 == 1:
+                    value = rng.uniform(0, 100) if rng.random() < 0.5 else "n/a"
+                else:
+                    value = rng.uniform(0, 100)
+                record["SensorData"][f"optional_{index:02d}"] = value
+    return result
+
+
+def timed(runs, func, *args):
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func(*args)
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations) * 1000, result
+
+
+# Schema calls of process_data into a table created beforehand with schema (None: created by process_data)
+def first_insert_calls(records, schema=None):
+    from google.cloud import bigquery
+
+    module = bench.load_function("process_files", "process_files_main")
+    client = fakes.FakeBigQueryClient()
+    bench.install_fakes(module, fakes.FakeStorageClient(), client, {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+    if schema is not None:
+        client.create_dataset(bigquery.Dataset(f"{client.project}.owner_0"))
+        client.create_table(bigquery.Table(f"{client.project}.owner_0.mac0", schema=schema))
+    client.call_counts.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = module.process_data(records)
+    assert stats["ok"], stats["errors"]
+    return {method: client.call_counts[method] for method in SCHEMA_CALLS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--optional-fields", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    module = bench.load_function("process_files", "process_files_main")
+    records = make_records(args.records, args.optional_fields)
+
+    build_ms, batch = timed(args.runs, module.build_record_batch, records)
+    batch_fields = set(batch.column_names) | {"InsertDate"}
+    print(f"{args.records} records, {len(batch.column_names)} flattened fields, median of {args.runs} runs")
+    print(f"build_record_batch: {build_ms:.1f} ms")
+    print(f"{'schema':<14}{'infer ms':>10}{'fields':>8}{'missing':>9}{'get_table':>11}{'update_table':>14}")
+
+    first_ms, first_schema = timed(args.runs, module.infer_schema, batch.take([0]))
+    batch_ms, batch_schema = timed(args.runs, module.infer_schema, batch)
+    for name, infer_ms, schema, created in (("first record", first_ms, first_schema, first_schema),
+                                            ("whole batch", batch_ms, batch_schema, None)):
+        missing = len(batch_fields - {field.name for field in schema})
+        calls = first_insert_calls(records, created)
+        print(f"{name:<14}{infer_ms:>10.1f}{len(schema):>8}{missing:>9}"
+              f"{calls['get_table']:>11}{calls['update_table']:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Load time and memory of a month of sensor data: read from the local cache of
+fetch_google/sensor_cache.py, against a fresh query to the fake BigQuery.
+
+    python harness/sensor_cache_bench.py [--days 30] [--sensors 5] [--interval-minutes 5]
+                                         [--bq-latency 1.0] [--runs 3]
+
+One table of --days days of readings is synced into a temporary cache (reported: full sync,
+then an incremental sync after one more day). Each load then runs in a new interpreter, --runs
+times, and the median wall time and peak resident memory above the interpreter's baseline
+(Linux VmHWM) are reported:
+- fresh query: SELECT of the plotted columns over the month, to a DataFrame (to_dataframe)
+- cache: load_sensor_data of the same columns and month
+- cache, all columns: load_sensor_data of every column
+--bq-latency is added to the fresh query as the round trip to BigQuery; the transfer of the
+rows from BigQuery is not simulated, so the fresh query is faster here than in production.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(HARNESS_DIR), "fetch_google"))
+
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+OWNER = "owner_0"
+MAC_ADDRESS = "mac000000"
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+# Columns of a typical plot of the notebook
+PLOT_COLUMNS = ["TimeStamp", "ExperimentData_Exp_name", "SensorData_Name", "SensorData_temperature",
+                "SensorData_humidity", "SensorData_light"]
+
+
+def flatten(record, parent_key=""):
+    flattened = {}
+    for key, value in record.items():
+        new_key = f"{parent_key}_{key}" if parent_key else key
+        if isinstance(value, dict):
+            flattened.update(flatten(value, new_key))
+        else:
+            flattened[new_key] = value
+    return flattened
+
+
+# Flattened rows of one device, a reading per sensor every interval minutes, inserted by day
+def make_rows(first_day, days, sensors, interval_minutes):
+    import random
+
+    rng = random.Random(first_day)
+    rows = []
+    for step in range(days * 24 * 60 // interval_minutes):
+        timestamp = START + timedelta(days=first_day, minutes=step * interval_minutes)
+        # Inserted a minute after the reading
+        insert_date = (timestamp + timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        for sensor in range(sensors):
+            row = flatten(generator.make_record(rng, OWNER, MAC_ADDRESS, 1 + step // (24 * 60 // interval_minutes) % 2,
+                                                sensor, timestamp))
+            row["InsertDate"] = insert_date
+            rows.append(row)
+    return rows
+
+
+def schema_of(rows):
+    from google.cloud import bigquery
+
+    fields = {}
+    for row in rows[:100]:
+        for name, value in row.items():
+            if name in ("TimeStamp", "InsertDate"):
+                fields[name] = bigquery.SchemaField(name, "TIMESTAMP")
+            elif isinstance(value, list):
+                fields[name] = bigquery.SchemaField(name, "STRING", mode="REPEATED")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                fields[name] = bigquery.SchemaField(name, "FLOAT64")
+            elif name not in fields:
+                fields[name] = bigquery.SchemaField(name, "STRING")
+    return list(fields.values())
+
+
+def make_source(args, days):
+    from google.cloud import bigquery
+
+    client = fakes.FakeBigQueryClient()
+    rows = make_rows(0, days, args.sensors, args.interval_minutes)
+    client.create_dataset(bigquery.Dataset(f"{client.project}.{OWNER}"))
+    client.create_table(bigquery.Table(f"{client.project}.{OWNER}.{MAC_ADDRESS}", schema=schema_of(rows)))
+    client.insert_rows_json(f"{OWNER}.{MAC_ADDRESS}", rows)
+    return client
+
+
+def _memory_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+# Runs in the child interpreter: prints {"seconds", "peak_mb", "rows"} as JSON
+def child(args):
+    import sensor_cache
+    from google.cloud import bigquery
+
+    end = START + timedelta(days=args.days)
+    client = make_source(args, args.days) if args.child == "fresh" else None
+
+    # Peak resident memory from here on
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    baseline = _memory_kb("VmRSS")
+    started = time.perf_counter()
+    if args.child == "fresh":
+        client.latency = args.bq_latency
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("start", "TIMESTAMP", START),
+            bigquery.ScalarQueryParameter("end", "TIMESTAMP", end),
+        ])
+        df = client.query(f"SELECT {', '.join(PLOT_COLUMNS)} FROM `{client.project}.{OWNER}.{MAC_ADDRESS}`"
+                          f" WHERE TimeStamp >= @start AND TimeStamp < @end", job_config=job_config).to_dataframe()
+    else:
+        columns = PLOT_COLUMNS if args.child == "cache" else None
+        df = sensor_cache.load_sensor_data(OWNER, MAC_ADDRESS, columns, start=START, end=end - timedelta(microseconds=1),
+                                           cache_dir=args.cache_dir)
+    seconds = time.perf_counter() - started
+    print(json.dumps({"seconds": seconds, "peak_mb": (_memory_kb("VmHWM") - baseline) / 1024, "rows": len(df)}))
+
+
+def run_child(args, mode, cache_dir):
+    command = [sys.executable, __file__, "--child", mode, "--cache-dir", cache_dir,
+               "--days", str(args.days), "--sensors", str(args.sensors),
+               "--interval-minutes", str(args.interval_minutes), "--bq-latency", str(args.bq_latency)]
+    completed = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--sensors", type=int, default=5, help="Sensors of the device")
+    parser.add_argument("--interval-minutes", type=int, default=5, help="Minutes between readings of a sensor")
+    parser.add_argument("--bq-latency", type=float, default=1.0, help="Seconds added to the fresh query")
+    parser.add_argument("--runs", type=int, default=3, help="Interpreters started per load")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--cache-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    import sensor_cache
+
+    cache_dir = tempfile.mkdtemp(prefix="sensor_cache_")
+    client = make_source(args, args.days)
+    # The sync reads the rows inserted up to SENSOR_CACHE_DELAY before "now": the whole month
+    now = START + timedelta(days=args.days) + sensor_cache.SENSOR_CACHE_DELAY
+    started = time.perf_counter()
+    result = sensor_cache.sync_table(client, OWNER, MAC_ADDRESS, cache_dir, now=now)
+    print(f"Full sync: {result['rows']} rows in {result['partitions']} partitions, {time.perf_counter() - started:.2f} s")
+
+    client.insert_rows_json(f"{OWNER}.{MAC_ADDRESS}", make_rows(args.days, 1, args.sensors, args.interval_minutes))
+    started = time.perf_counter()
+    result = sensor_cache.sync_table(client, OWNER, MAC_ADDRESS, cache_dir, now=now + timedelta(days=1))
+    print(f"Incremental sync of one more day: {result['rows']} rows, {time.perf_counter() - started:.2f} s\n")
+
+    print(f"{'load':<20} {'rows':>8} {'seconds':>8} {'peak MB':>8}")
+    for mode, label in (("fresh", "fresh query"), ("cache", "cache"), ("cache_all", "cache, all columns")):
+        results = [run_child(args, mode, cache_dir) for _ in range(args.runs)]
+        print(f"{label:<20} {results[0]['rows']:>8} {statistics.median(r['seconds'] for r in results):>8.3f}"
+              f" {statistics.median(r['peak_mb'] for r in results):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
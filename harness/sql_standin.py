@@ -0,0 +1,80 @@
+# Runs the label queries of update-labels (build_full_query, build_incremental_query) on an
+# in-memory DuckDB database, as a stand-in for BigQuery. The BigQuery text is translated as
+# little as possible: backticks are dropped, query parameters become TIMESTAMP literals, MERGE
+# becomes MERGE INTO, and the DECLARE / IF of the incremental script are run from Python.
+# Timestamps are naive UTC. Needs the duckdb package (pip install duckdb).
+import re
+from datetime import timezone
+
+LABEL_COLUMNS = [
+    ("RowId", "BIGINT"),
+    ("MetaData_LLA", "VARCHAR"),
+    ("ExperimentData_Exp_name", "VARCHAR"),
+    ("SensorData_Labels", "VARCHAR[]"),
+    ("SensorData_LabelOptions", "VARCHAR[]"),
+    ("InsertDate", "TIMESTAMP"),
+]
+
+_SCRIPT_PATTERN = re.compile(
+    r"DECLARE new_watermark TIMESTAMP DEFAULT \((.*?)\);\s*IF new_watermark IS NOT NULL THEN(.*?)END IF;", re.S)
+
+
+def _naive_utc(value):
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+class LabelQueryStandIn:
+    def __init__(self):
+        import duckdb
+
+        self.connection = duckdb.connect()
+        self.connection.execute("CREATE MACRO TO_JSON_STRING(x) AS CAST(to_json(x) AS VARCHAR)")
+
+    # Creates (or replaces) the table "dataset.table" with rows of LABEL_COLUMNS. Repeated fields
+    # are never NULL in BigQuery, missing lists are stored as empty lists.
+    def create_table(self, name, rows):
+        dataset_id = name.split(".")[0]
+        self.connection.execute(f"CREATE SCHEMA IF NOT EXISTS {dataset_id}")
+        self.connection.execute(
+            f"CREATE OR REPLACE TABLE {name} ({', '.join(f'{column} {kind}' for column, kind in LABEL_COLUMNS)})")
+        self.insert_rows(name, rows)
+
+    def insert_rows(self, name, rows):
+        if not rows:
+            return
+        self.connection.executemany(
+            f"INSERT INTO {name} VALUES ({', '.join('?' for _ in LABEL_COLUMNS)})",
+            [[row["RowId"], row["MetaData_LLA"], row["ExperimentData_Exp_name"], row["SensorData_Labels"] or [],
+              row["SensorData_LabelOptions"] or [], _naive_utc(row["InsertDate"])] for row in rows])
+
+    # Rows of the table ordered by RowId, with NULL lists read as empty lists like BigQuery does
+    def rows(self, name):
+        columns = [column for column, _ in LABEL_COLUMNS]
+        result = []
+        for values in self.connection.execute(f"SELECT * FROM {name} ORDER BY RowId").fetchall():
+            row = dict(zip(columns, values))
+            row["SensorData_Labels"] = row["SensorData_Labels"] or []
+            row["SensorData_LabelOptions"] = row["SensorData_LabelOptions"] or []
+            result.append(row)
+        return result
+
+    def translate(self, sql, params=None):
+        sql = re.sub(r"`([^`]+)`", r"\1", sql)
+        sql = re.sub(r"^(\s*)MERGE ", r"\1MERGE INTO ", sql, flags=re.M)
+        for name, value in (params or {}).items():
+            sql = re.sub(rf"@{name}\b", f"TIMESTAMP '{_naive_utc(value).isoformat(sep=' ')}'", sql)
+        return sql
+
+    def run_full_query(self, query):
+        self.connection.execute(self.translate(query))
+
+    # Runs the incremental script with its parameters (watermark, window_start, cutoff) and
+    # returns new_watermark, like the SELECT at the end of the script
+    def run_incremental_query(self, script, params):
+        match = _SCRIPT_PATTERN.search(script)
+        new_watermark = self.connection.execute(self.translate(match.group(1), params)).fetchone()[0]
+        if new_watermark is not None:
+            for statement in match.group(2).split(";"):
+                if statement.strip():
+                    self.connection.execute(self.translate(statement, params))
+        return new_watermark.replace(tzinfo=timezone.utc) if new_watermark else None
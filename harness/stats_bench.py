@@ -0,0 +1,120 @@
+"""
+Wall time of the project statistics of fetch_google/stats_collector.py against the fake BigQuery.
+
+    python harness/stats_bench.py [--tables 10 100 1000] [--rows 100] [--bq-latency 0.02]
+                                  [--max-workers 8] [--serial-max 1000]
+
+For each number of tables (10 per dataset, --rows rows each), reports:
+- serial: the notebook loops, query_combined_data (dry run and query) then query_daily_data on
+  each table in turn (skipped above --serial-max tables)
+- cold: collect_stats with an empty cache
+- warm: collect_stats again, every table served from the cache
+- 10% changed: collect_stats after rows were streamed into a tenth of the tables
+with the number of BigQuery calls of each. --bq-latency is added to every call, as a stand-in
+for the round trip to BigQuery; the real queries take longer, so the gaps widen in production.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(HARNESS_DIR), "fetch_google"))
+
+from google.cloud import bigquery  # noqa: E402
+
+import fakes  # noqa: E402
+import stats_collector  # noqa: E402
+
+TABLES_PER_DATASET = 10
+SCHEMA = [
+    bigquery.SchemaField("ExperimentData_Exp_name", "STRING"),
+    bigquery.SchemaField("SensorData_Name", "STRING"),
+    bigquery.SchemaField("TimeStamp", "TIMESTAMP"),
+]
+
+
+def make_rows(count, start, offset=0):
+    return [
+        {"ExperimentData_Exp_name": f"exp_{1 + index % 2}", "SensorData_Name": f"Sensor_{index % 5}",
+         "TimeStamp": (start + timedelta(minutes=offset + index)).isoformat()}
+        for index in range(count)
+    ]
+
+
+# Fake BigQuery with tables tables of rows rows, TABLES_PER_DATASET per dataset
+def make_client(tables, rows):
+    client = fakes.FakeBigQueryClient()
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for index in range(tables):
+        dataset_id = f"owner_{index // TABLES_PER_DATASET}"
+        client.create_dataset(bigquery.Dataset(f"{client.project}.{dataset_id}"))
+        table = client.create_table(bigquery.Table(f"{client.project}.{dataset_id}.mac{index:06d}", schema=SCHEMA))
+        client.insert_rows_json(f"{dataset_id}.{table.table_id}", make_rows(rows, start))
+    return client
+
+
+# The loops of the notebook, one table after the other
+def serial_stats(client):
+    for dataset in client.list_datasets():
+        for table in client.list_tables(dataset.dataset_id):
+            results, _ = stats_collector.query_combined_data(client, dataset.dataset_id, table.table_id)
+            list(results)
+            stats_collector.query_daily_data(client, dataset.dataset_id, table.table_id)
+
+
+def timed(client, func, *args, **kwargs):
+    calls = client.calls
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+    return time.perf_counter() - started, client.calls - calls, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rows", type=int, default=100, help="Rows per table")
+    parser.add_argument("--bq-latency", type=float, default=0.02, help="Seconds added to each BigQuery call")
+    parser.add_argument("--max-workers", type=int, default=stats_collector.STATS_MAX_WORKERS)
+    parser.add_argument("--serial-max", type=int, default=1000, help="Largest number of tables run serially")
+    args = parser.parse_args()
+
+    print(f"{'tables':>6} {'mode':<12} {'wall s':>8} {'calls':>6}")
+    for tables in args.tables:
+        client = make_client(tables, args.rows)
+        client.latency = args.bq_latency
+        cache_dir = tempfile.mkdtemp(prefix="stats_cache_")
+
+        def collect():
+            return stats_collector.collect_stats(client, max_workers=args.max_workers, cache_dir=cache_dir)
+
+        results = []
+        if tables <= args.serial_max:
+            results.append(("serial", timed(client, serial_stats, client)))
+        results.append(("cold", timed(client, collect)))
+        results.append(("warm", timed(client, collect)))
+
+        # Stream rows into a tenth of the tables, so only those are queried again
+        client.latency = 0
+        for ref in sorted(client.tables)[::10]:
+            client.insert_rows_json(ref, make_rows(5, datetime(2025, 2, 1, tzinfo=timezone.utc), offset=tables))
+        client.latency = args.bq_latency
+        results.append(("10% changed", timed(client, collect)))
+
+        for mode, (seconds, calls, _) in results:
+            print(f"{tables:>6} {mode:<12} {seconds:>8.2f} {calls:>6}")
+
+        summary = results[-1][1][2]
+        assert summary["queried"] == len(sorted(client.tables)[::10]) and not summary["errors"]
+        assert summary["combined"]["num_entries"].sum() == client.row_count()
+        summary["combined"].to_parquet(os.path.join(cache_dir, "combined.parquet"), index=False)
+
+
+if __name__ == "__main__":
+    main()
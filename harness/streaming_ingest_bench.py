@@ -0,0 +1,151 @@
+"""
+Peak resident memory and throughput of process_files.catalog_and_insert on large uploads,
+against the whole-file read it replaced, with the fake storage backed by files in a temporary
+directory.
+
+    python harness/streaming_ingest_bench.py [--sizes 10000 100000 1000000] [--batch-size 5000]
+                                             [--whole-file-max 100000] [--runs 1]
+
+A JSON array of each size in --sizes (about 1.4 kB per record, 6 devices) is written to a
+temporary directory. Each ingestion then runs in a new interpreter, --runs times, and the
+median is reported:
+- streaming: catalog_and_insert, reading the file in STREAM_CHUNK_SIZE chunks and processing it
+  in batches of --batch-size records (STREAM_BATCH_SIZE)
+- whole file: the former path, download_as_string and json.loads of the file, then process_data
+  on the whole list; only for sizes up to --whole-file-max, as it needs several times the file
+  size in memory
+Reported: records/sec over the ingestion, the peak resident memory of the interpreter
+(resource.getrusage ru_maxrss) and its peak above the resident memory before the ingestion,
+once the functions and fakes are loaded. The fake BigQuery only counts the streamed rows and
+upload_To_bucket answers at once, so neither keeps the records in memory.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+UPLOAD_BUCKET = "harness-uploads"
+DEVICES = [(f"owner_{owner}", f"mac{owner:02d}{mac:04x}") for owner in range(2) for mac in range(3)]
+# Records generated and written at once
+WRITE_CHUNK = 10000
+
+
+# BigQuery counting the streamed rows without keeping them
+class CountingBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self):
+        super().__init__()
+        self.inserted = 0
+
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        self.call("insert_rows_json")
+        with self.lock:
+            self.inserted += len(json_rows)
+        return []
+
+
+# Writes a JSON array of records readings of the devices, WRITE_CHUNK records at a time
+def write_upload(path, records):
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    with open(path, "w") as f:
+        f.write("[")
+        for index, first in enumerate(range(0, records, WRITE_CHUNK)):
+            owner, mac_address = DEVICES[index % len(DEVICES)]
+            chunk_start = start + timedelta(minutes=(index // len(DEVICES)) * WRITE_CHUNK // generator.SENSORS_PER_DEVICE)
+            chunk = generator.generate_file(index, owner, mac_address, min(WRITE_CHUNK, records - first), start=chunk_start)
+            f.write(("," if first else "") + ",".join(json.dumps(record) for record in chunk))
+        f.write("]")
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+# Runs in the child interpreter: prints {"seconds", "peak_mb", "above_mb", "inserted"} as JSON
+def child(args):
+    import bench
+
+    module = bench.load_function("process_files", "process_files_main")
+    storage = fakes.FakeStorageClient(root=args.storage_dir)
+    bigquery = CountingBigQueryClient()
+    bench.install_fakes(module, storage, bigquery, {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+    blob = storage.bucket(UPLOAD_BUCKET).blob("owner_0/upload.json")
+    blob.upload_from_filename(args.upload, content_type="application/json")
+    event = fakes.FakeCloudEvent({"bucket": UPLOAD_BUCKET, "name": blob.name, "generation": str(blob.generation),
+                                  "size": str(blob.size)}, event_id="streaming-bench")
+
+    baseline = _rss_mb()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.child == "streaming":
+            module.catalog_and_insert(event)
+        else:
+            json_list = json.loads(blob.download_as_bytes().decode("utf-8"))
+            module.process_data(json_list)
+    seconds = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"seconds": seconds, "peak_mb": peak_mb, "above_mb": peak_mb - baseline,
+                      "inserted": bigquery.inserted}))
+
+
+def run_child(args, mode, upload, storage_dir):
+    command = [sys.executable, __file__, "--child", mode, "--upload", upload, "--storage-dir", storage_dir]
+    env = dict(os.environ, STREAM_BATCH_SIZE=str(args.batch_size), INGEST_BACKEND="streaming")
+    completed = subprocess.run(command, capture_output=True, text=True, check=True, env=env)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Records per file")
+    parser.add_argument("--batch-size", type=int, default=5000, help="STREAM_BATCH_SIZE of the streaming runs")
+    parser.add_argument("--whole-file-max", type=int, default=100000, help="Largest file read whole")
+    parser.add_argument("--runs", type=int, default=1, help="Interpreters started per ingestion")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--upload", help=argparse.SUPPRESS)
+    parser.add_argument("--storage-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    print(f"Batches of {args.batch_size} records, median of {args.runs} runs")
+    print(f"{'records':>9} {'file MB':>8} {'mode':<11} {'records/s':>10} {'peak RSS MB':>12} {'above MB':>9}")
+    with tempfile.TemporaryDirectory() as root:
+        upload = os.path.join(root, "upload.json")
+        for size in args.sizes:
+            write_upload(upload, size)
+            file_mb = os.path.getsize(upload) / 1024 ** 2
+            modes = ["streaming"] + (["whole_file"] if size <= args.whole_file_max else [])
+            for mode in modes:
+                results = []
+                for _ in range(args.runs):
+                    with tempfile.TemporaryDirectory(dir=root) as storage_dir:
+                        results.append(run_child(args, mode, upload, storage_dir))
+                assert results[0]["inserted"] == size, f"{results[0]['inserted']} of {size} rows inserted"
+                rate = size / statistics.median(r["seconds"] for r in results)
+                print(f"{size:>9} {file_mb:>8.1f} {mode.replace('_', ' '):<11} {rate:>10.0f}"
+                      f" {statistics.median(r['peak_mb'] for r in results):>12.1f}"
+                      f" {statistics.median(r['above_mb'] for r in results):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Checks of batch_to_arrow, which builds the Arrow columns of the load_parquet and write_api
+backends of process_files: values land as BigQuery stores the same JSON rows when streamed.
+
+    python -m unittest harness/test_batch_to_arrow.py
+"""
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+from google.cloud import bigquery  # noqa: E402
+
+import bench  # noqa: E402
+
+
+class BatchToArrowTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("process_files", "process_files_main")
+
+    def convert(self, rows, schema):
+        return self.module.batch_to_arrow(self.module.RecordBatch.from_rows(rows), schema).to_pylist()
+
+    def test_string_fields_hold_json_text(self):
+        rows = [{"flag": True}, {"flag": False}, {"flag": None}, {"flag": "x"}, {"flag": 1.5}, {}]
+        converted = self.convert(rows, [bigquery.SchemaField("flag", "STRING")])
+        self.assertEqual([row["flag"] for row in converted], ["true", "false", None, "x", "1.5", None])
+
+    def test_repeated_fields_hold_json_text(self):
+        rows = [{"tags": [True, "a", 2, {"b": None}]}, {"tags": []}, {"tags": None}]
+        converted = self.convert(rows, [bigquery.SchemaField("tags", "STRING", mode="REPEATED")])
+        self.assertEqual([row["tags"] for row in converted], [["true", "a", "2", '{"b": null}'], [], []])
+
+
+if __name__ == "__main__":
+    unittest.main()
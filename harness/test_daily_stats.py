@@ -0,0 +1,120 @@
+"""
+Checks of the daily statistics rollup of process_files (gcs backend on the fake storage): a
+retried upload does not count its rows twice, even without the ingestion ledger, an update given
+up after conflicts is logged as an error, and the IDs of applied deltas expire.
+
+    python -m unittest harness/test_daily_stats.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+from test_ingest_ledger import PartwayFailingBigQueryClient  # noqa: E402
+from test_last_timestamp_index import load_with_env  # noqa: E402
+
+UPLOAD_BUCKET = "uploads"
+STATE_BUCKET = "test-state"
+FILE_NAME = "owner_0/upload.json"
+BATCH_SIZE = 100
+
+
+# Storage whose writes of daily statistics always find them changed by another writer
+class ConflictingStorageClient(fakes.FakeStorageClient):
+    def write(self, bucket_name, name, data, content_type=None, content_encoding=None, if_generation_match=None):
+        if name.startswith("daily_stats/"):
+            from google.api_core.exceptions import PreconditionFailed
+
+            raise PreconditionFailed(f"gs://{bucket_name}/{name}")
+        return super().write(bucket_name, name, data, content_type, content_encoding, if_generation_match)
+
+
+class DailyStatsTest(unittest.TestCase):
+    def setUp(self):
+        # Without the ledger, a retry inserts every batch again
+        self.module = load_with_env("process_files", "process_files_main",
+                                    STATE_BUCKET=STATE_BUCKET, INGEST_LEDGER_BACKEND="none")
+        self.module.STREAM_BATCH_SIZE = BATCH_SIZE
+        self.module.INSERT_BACKOFF_SECONDS = 0
+        files = [generator.generate_file(mac, "owner_0", f"mac{mac}", 150) for mac in range(2)]
+        self.records = [record for pair in zip(*files) for record in pair]
+
+    def ingest(self, storage, bigquery):
+        bench.install_fakes(self.module, storage, bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        self.module._clients.clear()
+        event = fakes.FakeCloudEvent({"bucket": UPLOAD_BUCKET, "name": FILE_NAME, "generation": str(self.generation)},
+                                     event_id="1")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                self.module.catalog_and_insert(event)
+            except RuntimeError:
+                pass
+        return output.getvalue()
+
+    def upload(self, storage):
+        blob = storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME)
+        blob.upload_from_string(generator.serialize(self.records))
+        self.generation = blob.generation
+
+    # Raw scan of the rows in the fake BigQuery
+    def scanned(self, bigquery):
+        rows_by_table = {tuple(ref.split(".")[1:]): rows for ref, rows in bigquery.rows.items()}
+        return self.module.daily_stats.scan_rows(rows_by_table)
+
+    def test_retried_upload_is_counted_once(self):
+        storage = fakes.FakeStorageClient()
+        # The rows of the failed requests land, only their insertIds keep them from landing twice
+        bigquery = PartwayFailingBigQueryClient("owner_0.mac1", rows_land=True)
+        self.upload(storage)
+        self.ingest(storage, bigquery)
+        bigquery.fail = False
+        self.ingest(storage, bigquery)
+
+        # The retry inserted every batch again, its rows were counted once
+        self.assertEqual(bigquery.row_count(), len(self.records))
+        rollup = self.module.daily_stats.read_daily_stats()
+        self.assertEqual(sum(entry["num_entries"] for entry in rollup), len(self.records))
+        self.assertEqual(self.module.daily_stats.compare(rollup, self.scanned(bigquery)), [])
+
+    def test_given_up_update_is_logged_as_an_error(self):
+        storage = ConflictingStorageClient()
+        bigquery = fakes.FakeBigQueryClient()
+        self.upload(storage)
+        output = self.ingest(storage, bigquery)
+
+        self.assertEqual(bigquery.row_count(), len(self.records))
+        errors = [json.loads(line) for line in output.splitlines() if '"severity": "ERROR"' in line]
+        self.assertTrue(errors)
+        self.assertTrue(all("daily_stats.py check" in error["message"] for error in errors))
+        summary = [json.loads(line)["metrics"] for line in output.splitlines() if '"process_files metrics"' in line]
+        self.assertEqual(summary[0]["counters"]["daily_stats_update_failed"], len(errors))
+
+    def test_applied_delta_ids_expire(self):
+        daily_stats = self.module.daily_stats
+        storage = fakes.FakeStorageClient()
+        bench.install_fakes(self.module, storage, fakes.FakeBigQueryClient())
+        self.module._clients.clear()
+        rollup = {("exp_1", "2025-01-01"): {"num_entries": 1, "sensors": {"s"}, "last_timestamp": None}}
+
+        for delta_id in ("a", "a", "b"):
+            self.assertTrue(daily_stats.record_daily_stats("owner_0", "mac0", rollup, delta_id))
+        self.assertEqual([entry["num_entries"] for entry in daily_stats.read_daily_stats()], [2])
+
+        daily_stats.DAILY_STATS_APPLIED_TTL = -1
+        self.assertTrue(daily_stats.record_daily_stats("owner_0", "mac0", rollup, "c"))
+        document = json.loads(storage.bucket(STATE_BUCKET).blob("daily_stats/owner_0/mac0.json").download_as_bytes())
+        self.assertEqual(list(document["applied"]), ["c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
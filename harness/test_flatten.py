@@ -0,0 +1,81 @@
+"""
+Equivalence of flatten_record, the memoized flattener of the process_files insert path, with
+flatten_json: same keys in the same order and the same values, serialized byte for byte.
+
+    python -m unittest harness/test_flatten.py
+"""
+import json
+import os
+import random
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import generator  # noqa: E402
+
+EDGE_CASES = [
+    {},
+    {"a": {}},
+    # Keys sanitized to the same flattened key, at one level and across levels
+    {"a.b": 1, "a$b": 2, "a_b": 3},
+    {"a_b": 1, "a": {"b": 2}, "x": {"y.z": 3, "y_z": 4}},
+    # Lists are kept as they are, including lists of objects
+    {"Labels": [], "Nested": [{"a": 1}, {"b": [1, 2]}], "TimeStamps": ["2024-01-01T00:00:00.000Z"]},
+    # TimeStamp keys at any level, in the device format or not
+    {"TimeStamp": "2024-02-29T23:59:59.999Z", "Meta": {"LastTimeStamp": "2024-01-01T00:00:00.5Z"}},
+    {"TimeStamp": "2024-01-01T00:00:00.123456Z", "TimeStampLocal": "2024-01-01T00:00:00Z"},
+    {"TimeStamp": "2024-1-5T3:04:05.1Z", "OtherTimeStamp": "2024-13-01T00:00:00.000Z"},
+    {"TimeStamp": "2024-01-01T24:00:00.000Z", "xTimeStamp": "not a date", "yTimeStamp": ""},
+    {"TimeStamp": "2024-01-01T00:00:00.000Z\n", "zTimeStamp": " 2024-01-01T00:00:00.000Z"},
+    # Values of other types under TimeStamp keys
+    {"TimeStamp": 1704067200, "aTimeStamp": None, "bTimeStamp": True, "cTimeStamp": {"d": "e"}},
+    # Unicode keys and values
+    {"é.ü": "ñ", "数据": {"值$": 1.5}},
+]
+
+
+class FlattenEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("process_files", "process_files_main")
+
+    def assertSameFlattening(self, record):
+        expected = self.module.flatten_json(record)
+        flattened = self.module.flatten_record(record)
+        self.assertEqual(list(flattened.items()), list(expected.items()))
+        self.assertEqual(json.dumps(flattened), json.dumps(expected))
+
+    def test_generated_records(self):
+        for _, records in generator.generate_uploads(12, 200):
+            for record in records:
+                self.assertSameFlattening(record)
+
+    def test_edge_cases(self):
+        for record in EDGE_CASES:
+            with self.subTest(record=record):
+                # Twice: when the plan is compiled and when it is reused
+                self.assertSameFlattening(record)
+                self.assertSameFlattening(record)
+
+    def test_shapes_vary_between_records(self):
+        # Random subsets and orders of the keys of generated records
+        rng = random.Random(0)
+        for record in generator.generate_file(0, "owner", "mac", 500):
+            keys = list(record)
+            rng.shuffle(keys)
+            shaped = {key: record[key] for key in keys[:rng.randint(1, len(keys))]}
+            if isinstance(shaped.get("SensorData"), dict) and rng.random() < 0.5:
+                shaped["SensorData"] = {**shaped["SensorData"], f"extra_{rng.randint(0, 9)}": rng.random()}
+            self.assertSameFlattening(shaped)
+
+    def test_shapes_beyond_the_plan_cache(self):
+        self.module.FLATTEN_PLAN_CACHE_SIZE = 4
+        for index in range(20):
+            self.assertSameFlattening({f"key_{index}": {"TimeStamp": "2024-01-01T00:00:00.000Z", "v": index}})
+        self.assertLessEqual(len(self.module._flatten_plans), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+"""
+Checks of the ingestion ledger of process_files (gcs backend on the fake storage): an upload whose
+inserts fail partway is retried without inserting the committed tables again, nor the committed
+rows of a table whose other rows failed; rows rejected as invalid are reported and not retried;
+rows sent again keep their insertIds, with or without a UniqueID.
+
+    python -m unittest harness/test_ingest_ledger.py
+"""
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+UPLOAD_BUCKET = "uploads"
+STATE_BUCKET = "test-state"
+FILE_NAME = "owner_0/upload.json"
+BATCH_SIZE = 100
+
+
+# BigQuery whose inserts into failing_table fail after its first insert request, either before
+# the rows land or after (like a timeout of a request that went through), while fail is set.
+# Records the insertIds sent per table.
+class PartwayFailingBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self, failing_table, rows_land=False):
+        super().__init__()
+        self.failing_table = failing_table
+        self.rows_land = rows_land
+        self.fail = True
+        self.sent_ids = {}
+
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        table = ".".join(str(table_ref).split(".")[-2:])
+        with self.lock:
+            sent = self.sent_ids.setdefault(table, [])
+            failing = self.fail and table == self.failing_table and bool(sent)
+            sent.extend(row_ids)
+        if failing and not self.rows_land:
+            raise RuntimeError("Injected insert failure")
+        errors = super().insert_rows_json(table_ref, json_rows, row_ids)
+        if failing:
+            raise RuntimeError("Injected timeout after the insert")
+        return errors
+
+
+# BigQuery rejecting the rows whose insertId is in invalid_ids as "invalid", and failing the rows
+# whose insertId is in flaky_ids with a transient error while fail is set. Records the insertIds
+# sent per table.
+class RejectingBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self, invalid_ids, flaky_ids=()):
+        super().__init__()
+        self.invalid_ids = set(invalid_ids)
+        self.flaky_ids = set(flaky_ids)
+        self.fail = True
+        self.sent_ids = {}
+
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        table = ".".join(str(table_ref).split(".")[-2:])
+        with self.lock:
+            self.sent_ids.setdefault(table, []).extend(row_ids)
+        rejected = {}
+        for index, insert_id in enumerate(row_ids):
+            if insert_id in self.invalid_ids:
+                rejected[index] = {"reason": "invalid", "message": "Cannot convert value to floating point."}
+            elif self.fail and insert_id in self.flaky_ids:
+                rejected[index] = {"reason": "backendError", "message": "Injected transient failure"}
+        super().insert_rows_json(table_ref, [row for index, row in enumerate(json_rows) if index not in rejected],
+                                 [insert_id for index, insert_id in enumerate(row_ids) if index not in rejected])
+        return [{"index": index, "errors": [error]} for index, error in sorted(rejected.items())]
+
+
+class IngestLedgerTest(unittest.TestCase):
+    def setUp(self):
+        os.environ["STATE_BUCKET"] = STATE_BUCKET
+        try:
+            self.module = bench.load_function("process_files", "process_files_main")
+        finally:
+            del os.environ["STATE_BUCKET"]
+        self.module.STREAM_BATCH_SIZE = BATCH_SIZE
+        self.module.INSERT_BACKOFF_SECONDS = 0
+        self.storage = fakes.FakeStorageClient()
+        # Two devices taking turns, so every batch has rows of both tables
+        files = [generator.generate_file(mac, "owner_0", f"mac{mac}", 150) for mac in range(2)]
+        self.records = [record for pair in zip(*files) for record in pair]
+
+    def ingest(self, bigquery):
+        bench.install_fakes(self.module, self.storage, bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        self.module._clients.clear()
+        event = fakes.FakeCloudEvent({"bucket": UPLOAD_BUCKET, "name": FILE_NAME, "generation": str(self.generation)},
+                                     event_id="1")
+        self.output = io.StringIO()
+        with contextlib.redirect_stdout(self.output):
+            try:
+                self.module.catalog_and_insert(event)
+            except RuntimeError:
+                return False
+        return True
+
+    def upload(self, records):
+        blob = self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME)
+        blob.upload_from_string(generator.serialize(records))
+        self.generation = blob.generation
+
+    def ledger_objects(self):
+        return [name for bucket, name in self.storage.objects
+                if bucket == STATE_BUCKET and name.startswith("ingest_ledger/")]
+
+    def test_retry_after_a_partial_failure_skips_the_committed_tables(self):
+        self.upload(self.records)
+        bigquery = PartwayFailingBigQueryClient("owner_0.mac1")
+
+        self.assertFalse(self.ingest(bigquery))
+        self.assertTrue(self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME).exists())
+        # The first batch of mac1 landed, the next two failed; every batch of mac0 landed
+        self.assertEqual(bigquery.row_count(), 150 + 50)
+        self.assertEqual(len(self.ledger_objects()), 3)
+        sent_before = {table: len(ids) for table, ids in bigquery.sent_ids.items()}
+
+        bigquery.fail = False
+        self.assertTrue(self.ingest(bigquery))
+
+        self.assertFalse(self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME).exists())
+        self.assertEqual(bigquery.row_count(), len(self.records))
+        # The retry only sent the rows of the batches that failed
+        self.assertEqual(len(bigquery.sent_ids["owner_0.mac0"]), sent_before["owner_0.mac0"])
+        self.assertEqual(len(bigquery.sent_ids["owner_0.mac1"]) - sent_before["owner_0.mac1"], 100)
+        self.assertEqual(self.ledger_objects(), [])
+
+    def test_invalid_rows_are_reported_and_not_retried(self):
+        self.upload(self.records)
+        invalid_id = self.records[41]["UniqueID"]
+        bigquery = RejectingBigQueryClient({invalid_id})
+
+        # The file is done with: the invalid row is logged, the others are inserted
+        self.assertTrue(self.ingest(bigquery))
+        self.assertFalse(self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME).exists())
+        self.assertEqual(bigquery.row_count(), len(self.records) - 1)
+        self.assertEqual(bigquery.sent_ids["owner_0.mac1"].count(invalid_id), 1)
+        errors = [json.loads(line) for line in self.output.getvalue().splitlines() if '"severity": "ERROR"' in line]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["unique_ids"], [invalid_id])
+        self.assertEqual(self.ledger_objects(), [])
+
+    def test_retry_skips_the_landed_rows_of_a_partially_failed_table(self):
+        self.upload(self.records)
+        invalid_id, flaky_id = self.records[41]["UniqueID"], self.records[43]["UniqueID"]
+        bigquery = RejectingBigQueryClient({invalid_id}, {flaky_id})
+
+        # The transient failure outlasts the insert retries: the file is kept for a retried event
+        self.assertFalse(self.ingest(bigquery))
+        self.assertEqual(bigquery.row_count(), len(self.records) - 2)
+        sent_before = {table: len(ids) for table, ids in bigquery.sent_ids.items()}
+
+        bigquery.fail = False
+        self.assertTrue(self.ingest(bigquery))
+
+        # Only the row that failed transiently was sent again, not its table's other rows nor the invalid row
+        self.assertEqual(len(bigquery.sent_ids["owner_0.mac0"]), sent_before["owner_0.mac0"])
+        self.assertEqual(bigquery.sent_ids["owner_0.mac1"][sent_before["owner_0.mac1"]:], [flaky_id])
+        self.assertEqual(bigquery.row_count(), len(self.records) - 1)
+        self.assertFalse(self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME).exists())
+        self.assertEqual(self.ledger_objects(), [])
+        # The rows that landed on the first attempt are counted once by the daily statistics
+        daily_stats = self.module.daily_stats
+        raw = daily_stats.scan_rows({tuple(ref.split(".")[1:]): rows for ref, rows in bigquery.rows.items()})
+        self.assertEqual(daily_stats.compare(daily_stats.read_daily_stats(), raw), [])
+
+    def test_rows_without_unique_id_keep_their_insert_ids(self):
+        for record in self.records:
+            del record["UniqueID"]
+        self.upload(self.records)
+        # The failed requests went through: only the insertIds keep their rows from landing twice
+        bigquery = PartwayFailingBigQueryClient("owner_0.mac1", rows_land=True)
+
+        self.assertFalse(self.ingest(bigquery))
+        bigquery.fail = False
+        self.assertTrue(self.ingest(bigquery))
+
+        self.assertEqual(bigquery.row_count(), len(self.records))
+        key = f"{UPLOAD_BUCKET}/{FILE_NAME}#{self.generation}"
+        expected = {hashlib.sha1(f"{key}:{offset}".encode("utf-8")).hexdigest()
+                    for offset in range(1, len(self.records), 2)}
+        self.assertEqual(set(bigquery.sent_ids["owner_0.mac1"]), expected)
+
+    def test_ledger_entries_of_other_batch_sizes_are_ignored(self):
+        self.upload(self.records)
+        bigquery = PartwayFailingBigQueryClient("owner_0.mac1")
+        self.assertFalse(self.ingest(bigquery))
+
+        # A new deployment reads the file in other batches: nothing can be skipped, but the
+        # rows inserted again are dropped by their insertIds
+        self.module.STREAM_BATCH_SIZE = 120
+        bigquery.fail = False
+        self.assertTrue(self.ingest(bigquery))
+        self.assertEqual(bigquery.row_count(), len(self.records))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Checks of the streaming insert engine of process_files (batch_insert_to_bq) with a fake
+BigQuery enforcing request size limits and failing random rows.
+
+    python -m unittest harness/test_insert_engine.py
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+from google.api_core.exceptions import BadRequest  # noqa: E402
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+# BigQuery rejecting insert requests over max_rows rows or max_bytes bytes, and failing each row
+# with probability failure_rate (reason: reason), at most max_failures times per insertId.
+# Counts the rows sent and the inserts running at the same time.
+class LimitedBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self, max_rows, max_bytes, failure_rate=0.0, reason="backendError", max_failures=None,
+                 insert_latency=0.0, seed=0):
+        super().__init__()
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.failure_rate = failure_rate
+        self.reason = reason
+        self.max_failures = max_failures
+        self.insert_latency = insert_latency
+        self.rng = random.Random(seed)
+        self.failures = {}  # insertId -> failures injected
+        self.request_sizes = []  # (rows, bytes) of each request
+        self.rows_sent = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        size = len(json.dumps(json_rows).encode("utf-8"))
+        with self.lock:
+            self.request_sizes.append((len(json_rows), size))
+            self.rows_sent += len(json_rows)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if len(json_rows) > self.max_rows or size > self.max_bytes:
+                raise BadRequest(f"Request of {len(json_rows)} rows and {size} bytes is too large")
+            if self.insert_latency:
+                time.sleep(self.insert_latency)
+
+            failed = set()
+            with self.lock:
+                for index, insert_id in enumerate(row_ids):
+                    if self.rng.random() < self.failure_rate and \
+                            (self.max_failures is None or self.failures.get(insert_id, 0) < self.max_failures):
+                        self.failures[insert_id] = self.failures.get(insert_id, 0) + 1
+                        failed.add(index)
+            errors = super().insert_rows_json(
+                table_ref, [row for index, row in enumerate(json_rows) if index not in failed],
+                [insert_id for index, insert_id in enumerate(row_ids) if index not in failed])
+            assert not errors, errors
+            return [{"index": index, "errors": [{"reason": self.reason, "message": "Injected failure"}]}
+                    for index in sorted(failed)]
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class InsertEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("process_files", "process_files_main")
+        self.module.INSERT_BACKOFF_SECONDS = 0
+
+    # Fake enforcing the request limits the engine is configured with
+    def client(self, **kwargs):
+        return LimitedBigQueryClient(self.module.INSERT_MAX_ROWS, self.module.INSERT_MAX_BYTES, **kwargs)
+
+    def insert(self, bigquery, records):
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), bigquery)
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch = self.module.build_record_batch(records)
+            self.module.create_bq_datasets_and_tables(self.module.extract_paths(batch)[3], batch)
+            return self.module.batch_insert_to_bq(self.module.map_tables_to_lists(batch))
+
+    def test_requests_stay_within_the_size_limits(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 3000)
+        # Large rows, so the byte limit is reached before the row limit
+        for record in records[:1000]:
+            record["SensorData"]["notes"] = "x" * 20000
+        bigquery = self.client()
+        results = self.insert(bigquery, records)
+
+        result = results[f"{bigquery.project}.owner_0.mac0"]
+        self.assertEqual((result["rows_ok"], result["rows_failed"], result["retries"]), (3000, 0, 0))
+        self.assertEqual(bigquery.row_count(), 3000)
+        self.assertTrue(all(rows <= bigquery.max_rows and size <= bigquery.max_bytes
+                            for rows, size in bigquery.request_sizes))
+        self.assertGreater(max(size for _, size in bigquery.request_sizes), bigquery.max_bytes / 2)
+        self.assertEqual(set(result), {"rows_ok", "rows_failed", "retries", "latency", "errors", "failed_rows",
+                                       "invalid_rows"})
+
+    def test_only_failed_rows_are_retried(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 2000)
+        bigquery = self.client(failure_rate=0.2, max_failures=self.module.INSERT_MAX_RETRIES)
+        results = self.insert(bigquery, records)
+
+        result = results[f"{bigquery.project}.owner_0.mac0"]
+        self.assertEqual((result["rows_ok"], result["rows_failed"]), (2000, 0))
+        self.assertGreater(result["retries"], 0)
+        # Each row is sent once, plus once per injected failure
+        self.assertEqual(bigquery.rows_sent, 2000 + sum(bigquery.failures.values()))
+        self.assertEqual(bigquery.row_count(), 2000)
+
+    def test_rows_failing_every_attempt_are_reported(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 600)
+        bigquery = self.client(failure_rate=1.0)
+        result = self.insert(bigquery, records)[f"{bigquery.project}.owner_0.mac0"]
+
+        self.assertEqual((result["rows_ok"], result["rows_failed"]), (0, 600))
+        self.assertEqual(bigquery.rows_sent, 600 * (self.module.INSERT_MAX_RETRIES + 1))
+        self.assertLessEqual(len(result["errors"]), 10)
+
+    def test_invalid_rows_are_not_retried(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 600)
+        bigquery = self.client(failure_rate=0.1, reason="invalid")
+        result = self.insert(bigquery, records)[f"{bigquery.project}.owner_0.mac0"]
+
+        failed = sum(bigquery.failures.values())
+        self.assertGreater(failed, 0)
+        self.assertEqual((result["rows_ok"], result["rows_failed"], result["retries"]), (600 - failed, failed, 0))
+        self.assertEqual(bigquery.rows_sent, 600)
+        self.assertEqual(len(result["invalid_rows"]), failed)
+        self.assertEqual(result["failed_rows"], result["invalid_rows"])
+
+    def test_tables_are_inserted_concurrently(self):
+        records = [record for owner in range(2) for mac in range(4)
+                   for record in generator.generate_file(owner * 4 + mac, f"owner_{owner}", f"mac{mac}", 50)]
+        bigquery = self.client(insert_latency=0.05)
+        results = self.insert(bigquery, records)
+
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result["rows_ok"] == 50 for result in results.values()))
+        self.assertGreater(bigquery.peak_in_flight, 1)
+        self.assertLessEqual(bigquery.peak_in_flight, self.module.INSERT_MAX_WORKERS)
+
+
+if __name__ == "__main__":
+    unittest.main()
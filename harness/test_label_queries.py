@@ -0,0 +1,136 @@
+"""
+Checks of the label updates of update-labels: the incremental script, run pass after pass on a
+SQL stand-in (sql_standin.py, DuckDB), leaves the rows as the full rewrite would; and the
+incremental mode moves the watermark of tables changed by the script (fake BigQuery).
+
+    python -m unittest harness/test_label_queries.py
+"""
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+TABLE = "owner_0.mac0"
+LABELS = [[], ["control"], ["synthetic"], ["synthetic", "control"]]
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@unittest.skipUnless(importlib.util.find_spec("duckdb"), "needs duckdb (pip install duckdb)")
+class IncrementalAgainstFullRewriteTest(unittest.TestCase):
+    def setUp(self):
+        from sql_standin import LabelQueryStandIn
+
+        self.module = bench.load_function("update-labels", "update_labels_main")
+        self.rng = random.Random(0)
+        self.next_id = 0
+        self.raw = []  # every row as inserted, before any label update
+        self.incremental = LabelQueryStandIn()
+        self.incremental.create_table(TABLE, [])
+        self.watermark = datetime.fromtimestamp(0, timezone.utc)
+
+    # Rows of 4 sensors x 2 experiments, and a few without a group key, with random labels
+    def add_rows(self, count, start, end):
+        rows = []
+        for _ in range(count):
+            self.next_id += 1
+            group = self.rng.randrange(9)
+            rows.append({
+                "RowId": self.next_id,
+                "MetaData_LLA": f"lla_{group % 4}" if group < 8 else None,
+                "ExperimentData_Exp_name": f"exp_{group // 4}" if group < 8 else None,
+                "SensorData_Labels": self.rng.choice(LABELS),
+                "SensorData_LabelOptions": ["synthetic", "control"],
+                "InsertDate": start + (end - start) * self.rng.random(),
+            })
+        self.raw.extend(rows)
+        self.incremental.insert_rows(TABLE, rows)
+
+    # One incremental pass at cutoff, then the full rewrite of the rows up to the cutoff
+    def check_pass(self, cutoff):
+        params = {"watermark": self.watermark, "window_start": self.watermark - self.module.WATERMARK_OVERLAP,
+                  "cutoff": cutoff}
+        new_watermark = self.incremental.run_incremental_query(
+            self.module.build_incremental_query(f"`{TABLE}`"), params)
+        if new_watermark is not None:
+            self.watermark = new_watermark
+
+        from sql_standin import LabelQueryStandIn
+
+        full = LabelQueryStandIn()
+        full.create_table(TABLE, [row for row in self.raw if row["InsertDate"] <= cutoff])
+        full.run_full_query(self.module.build_full_query(f"`{TABLE}`"))
+
+        rows = self.incremental.rows(TABLE)
+        naive_cutoff = cutoff.replace(tzinfo=None)
+        self.assertEqual([row for row in rows if row["InsertDate"] <= naive_cutoff], full.rows(TABLE))
+        # Rows after the cutoff (still in the streaming buffer) keep the labels they were inserted with
+        raw = {row["RowId"]: row for row in self.raw}
+        for row in rows:
+            if row["InsertDate"] > naive_cutoff:
+                self.assertEqual(row["SensorData_Labels"], raw[row["RowId"]]["SensorData_Labels"])
+        return new_watermark
+
+    def test_passes_match_the_full_rewrite(self):
+        hour = timedelta(hours=1)
+        # First pass over a day of rows, some of them after the cutoff
+        self.add_rows(300, START, START + 24 * hour)
+        self.assertIsNotNone(self.check_pass(START + 20 * hour))
+
+        # New rows, including rows inserted late, a few minutes before the watermark
+        self.add_rows(100, START + 24 * hour, START + 30 * hour)
+        self.add_rows(10, self.watermark - self.module.WATERMARK_OVERLAP / 2, self.watermark)
+        self.assertIsNotNone(self.check_pass(START + 28 * hour))
+
+        # No new rows: nothing changes
+        self.assertIsNone(self.check_pass(START + 28 * hour))
+
+        # Label changes of a single group
+        for _ in range(5):
+            self.next_id += 1
+            row = {"RowId": self.next_id, "MetaData_LLA": "lla_1", "ExperimentData_Exp_name": "exp_0",
+                   "SensorData_Labels": ["control"], "SensorData_LabelOptions": ["synthetic", "control"],
+                   "InsertDate": START + 29 * hour + self.next_id * timedelta(seconds=1)}
+            self.raw.append(row)
+            self.incremental.insert_rows(TABLE, [row])
+        self.assertIsNotNone(self.check_pass(START + 40 * hour))
+
+
+class IncrementalWatermarkTest(unittest.TestCase):
+    def test_watermark_moves_after_the_merge(self):
+        # The MERGE changes the etag of the table: the watermark is set on a table read after it
+        os.environ["LABELS_STREAMING_DELAY_MINUTES"] = "0"
+        try:
+            module = bench.load_function("update-labels", "update_labels_main")
+        finally:
+            del os.environ["LABELS_STREAMING_DELAY_MINUTES"]
+        module.LABELS_POLL_SECONDS = 0.01
+        bigquery = fakes.FakeBigQueryClient()
+        process_files = bench.load_function("process_files", "process_files_main")
+        bench.install_fakes(process_files, fakes.FakeStorageClient(), bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        bench.install_fakes(module, fakes.FakeStorageClient(), bigquery)
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_files.process_data(generator.generate_file(0, "owner_0", "mac0", 20))
+            summary = module.update_labels("incremental")
+            again = module.update_labels("incremental")
+
+        self.assertEqual(summary["tables"][TABLE]["status"], "updated", summary)
+        table = bigquery.get_table(TABLE)
+        self.assertIn(module.WATERMARK_LABEL, table.labels)
+        # The next pass starts from the watermark
+        self.assertEqual(again["tables"][TABLE]["status"], "no_new_rows", again)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Checks of the label-update job scheduler of update-labels with a fake BigQuery whose jobs take
+time and sometimes fail: concurrency cap, per-table status, time budget and checkpoint, and the
+validation of the cap given in the request.
+
+    python -m unittest harness/test_label_scheduler.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+from google.cloud import bigquery  # noqa: E402
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+
+CHECKPOINT_URI = "gs://labels-state/checkpoint.json"
+
+
+class SlowJob:
+    def __init__(self, client, duration, error):
+        self.client = client
+        self.finishes_at = time.time() + duration
+        self.error = error
+        self.job_id = f"slow_job_{id(self)}"
+
+    def done(self):
+        return time.time() >= self.finishes_at
+
+    def result(self):
+        with self.client.lock:
+            self.client.open_jobs -= 1
+        if self.error:
+            raise RuntimeError(self.error)
+        return []
+
+
+# BigQuery whose label jobs take job_seconds, fail for the tables in failing_jobs and cannot be
+# submitted for the tables in failing_submits. Counts the jobs submitted and not collected yet.
+class SlowJobsBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self, tables, job_seconds, failing_jobs=(), failing_submits=()):
+        super().__init__()
+        self.job_seconds = job_seconds
+        self.failing_jobs = set(failing_jobs)
+        self.failing_submits = set(failing_submits)
+        self.open_jobs = 0
+        self.peak_open_jobs = 0
+        self.submitted = []
+        for name in tables:
+            dataset_id = name.split(".")[0]
+            self.datasets.add(dataset_id)
+            self.create_table(bigquery.Table(f"{self.project}.{name}"))
+
+    def query(self, query, job_config=None):
+        self.call("query")
+        name = query.split("`")[1]
+        if name in self.failing_submits:
+            raise RuntimeError(f"Injected submit failure for {name}")
+        with self.lock:
+            self.submitted.append(name)
+            self.open_jobs += 1
+            self.peak_open_jobs = max(self.peak_open_jobs, self.open_jobs)
+        error = f"Injected job failure for {name}" if name in self.failing_jobs else None
+        return SlowJob(self, self.job_seconds, error)
+
+
+class LabelSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("update-labels", "update_labels_main")
+        self.module.LABELS_POLL_SECONDS = 0.005
+        self.storage = fakes.FakeStorageClient()
+        self.tables = sorted(f"owner_{owner}.mac{mac}" for owner in range(3) for mac in range(4))
+
+    def run_labels(self, bigquery, max_concurrent):
+        bench.install_fakes(self.module, self.storage, bigquery)
+        self.module._clients.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.module.update_labels("full", max_concurrent=max_concurrent)
+
+    def test_jobs_run_concurrently_up_to_the_cap(self):
+        bigquery = SlowJobsBigQueryClient(self.tables, job_seconds=0.05)
+        started = time.perf_counter()
+        summary = self.run_labels(bigquery, max_concurrent=4)
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual({result["status"] for result in summary["tables"].values()}, {"updated"})
+        self.assertEqual(set(summary["tables"]), set(self.tables))
+        self.assertEqual(bigquery.peak_open_jobs, 4)
+        # 12 jobs of 50 ms, 4 at a time
+        self.assertLess(elapsed, 12 * 0.05 * 0.6)
+        self.assertEqual((summary["failed"], summary["incomplete"]), (0, 0))
+
+    def test_failures_are_reported_per_table(self):
+        bigquery = SlowJobsBigQueryClient(self.tables, job_seconds=0.01,
+                                          failing_jobs={"owner_0.mac1"}, failing_submits={"owner_2.mac3"})
+        summary = self.run_labels(bigquery, max_concurrent=4)
+
+        tables = summary["tables"]
+        self.assertEqual(tables["owner_0.mac1"]["status"], "failed")
+        self.assertIn("Injected job failure", tables["owner_0.mac1"]["error"])
+        self.assertEqual(tables["owner_2.mac3"]["status"], "failed")
+        self.assertIn("Injected submit failure", tables["owner_2.mac3"]["error"])
+        self.assertEqual(sum(result["status"] == "updated" for result in tables.values()), len(self.tables) - 2)
+        self.assertEqual(summary["failed"], 2)
+        self.assertTrue(all("duration" in result for result in tables.values()))
+
+    def test_cut_short_pass_resumes_from_the_checkpoint(self):
+        self.module.LABELS_CHECKPOINT_URI = CHECKPOINT_URI
+        self.module.LABELS_TIME_BUDGET_SECONDS = 0.12
+        self.module.LABELS_DRAIN_SECONDS = 0
+        bigquery = SlowJobsBigQueryClient(self.tables, job_seconds=0.05)
+
+        first = self.run_labels(bigquery, max_concurrent=2)
+        statuses = {table: result["status"] for table, result in first["tables"].items()}
+        completed = {table for table, status in statuses.items() if status == "updated"}
+        self.assertTrue(completed)
+        self.assertGreater(first["incomplete"], 0)
+        self.assertTrue(self.storage.bucket("labels-state").blob("checkpoint.json").exists())
+
+        # The next invocations skip the completed tables, until the pass is over
+        passes = [first]
+        while passes[-1]["incomplete"]:
+            passes.append(self.run_labels(bigquery, max_concurrent=2))
+            self.assertLess(len(passes), 20)
+        second = passes[1]
+        self.assertEqual({table for table, result in second["tables"].items()
+                          if result["status"] == "done_in_previous_invocation"}, completed)
+
+        # Each table was submitted once, and again when its job was left running, then the checkpoint is cleared
+        self.assertEqual(sorted(bigquery.submitted), sorted(self.tables + [
+            table for summary in passes for table, result in summary["tables"].items()
+            if result["status"] == "running"]))
+        self.assertFalse(self.storage.bucket("labels-state").blob("checkpoint.json").exists())
+
+    def test_invalid_max_concurrent_is_refused(self):
+        import flask
+
+        bigquery = SlowJobsBigQueryClient(self.tables, job_seconds=0.01)
+        bench.install_fakes(self.module, self.storage, bigquery)
+        self.module._clients.clear()
+        app = flask.Flask("test_label_scheduler")
+        for value in ("many", 0, -3, 2.5, True, None):
+            with contextlib.redirect_stdout(io.StringIO()):
+                status, text = bench.call_http(app, self.module.hello_http,
+                                               json.dumps({"mode": "full", "max_concurrent": value}))
+            self.assertEqual(status, 400, value)
+            self.assertIn("max_concurrent", json.loads(text)["error"])
+        self.assertEqual(bigquery.submitted, [])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, text = bench.call_http(app, self.module.hello_http, json.dumps({"mode": "full", "max_concurrent": "3"}))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(text)["failed"], 0)
+        self.assertEqual(sorted(bigquery.submitted), self.tables)
+
+
+if __name__ == "__main__":
+    unittest.main()
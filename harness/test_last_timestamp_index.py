@@ -0,0 +1,189 @@
+"""
+Checks of the last-timestamp index shared by process_files and query_last_timestamp through the
+gcs backend of the state store, on the fake storage: answers without BigQuery once back-filled and
+raised by ingests, expired entries, re-uploads and backfills of older rows, concurrent writers,
+and the default backend.
+
+    python -m unittest harness/test_last_timestamp_index.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+STATE_BUCKET = "test-state"
+
+
+# Imports a function with the given environment, restored afterwards
+def load_with_env(directory, module_name, **env):
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        return bench.load_function(directory, module_name)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+class LastTimestampIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = fakes.FakeStorageClient()
+        self.bigquery = fakes.FakeBigQueryClient()
+        self.process_files = load_with_env("process_files", "process_files_main", STATE_BUCKET=STATE_BUCKET)
+        self.query = load_with_env("query_last_timestamp", "query_last_timestamp_main", STATE_BUCKET=STATE_BUCKET)
+        bench.install_fakes(self.process_files, self.storage, self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        bench.install_fakes(self.query, self.storage, self.bigquery)
+        self.query._clients.clear()
+
+    def ingest(self, records):
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = self.process_files.process_data(records)
+        self.assertTrue(stats["ok"], stats["errors"])
+
+    def request(self, experiment_names, mac_address="mac0"):
+        import flask
+
+        self.bigquery.call_counts.clear()
+        body = json.dumps({"owner": "owner_0", "mac_address": mac_address, "experiment_names": experiment_names})
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, text = bench.call_http(flask.Flask(__name__), self.query.query_last_timestamp, body)
+        self.assertEqual(status, 200, text)
+        return json.loads(text)
+
+    # Start of readings a day before or after the records
+    def earlier(self, records):
+        return self.parse(records[0]["TimeStamp"]) - timedelta(days=1)
+
+    def later(self, records):
+        return self.parse(records[-1]["TimeStamp"]) + timedelta(days=1)
+
+    def parse(self, timestamp):
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+
+    # Newest TimeStamp per experiment of the records, in the format of the response
+    def newest(self, records):
+        newest = {}
+        for record in records:
+            timestamp = record["TimeStamp"][:19].replace("T", " ")
+            name = record["ExperimentData"]["Exp_name"]
+            newest[name] = max(newest.get(name, ""), timestamp)
+        return newest
+
+    def test_back_filled_experiments_follow_the_ingests(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 40)
+        self.ingest(records)
+        # Experiments are added to the index by the back-fill of query_last_timestamp
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+        self.assertTrue(self.storage.bucket(STATE_BUCKET).blob("last_timestamps/owner_0/mac0.json").exists())
+
+        # Then raised by the ingests, and answered without BigQuery
+        newer = generator.generate_file(1, "owner_0", "mac0", 40, start=self.later(records))
+        self.ingest(newer)
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(newer))
+        self.assertEqual(self.bigquery.call_counts["query"], 0)
+
+        # Only the experiment missing from the index goes to BigQuery
+        response = self.request(["exp_1", "exp_9"])
+        self.assertEqual(response["exp_9"], 0)
+        self.assertEqual(self.bigquery.call_counts["query"], 2)
+
+    def test_expired_entries_are_read_from_bigquery_and_back_filled(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 40)
+        self.ingest(records)
+        self.request(["exp_1", "exp_2"])
+        self.query.last_timestamp_index.LAST_TIMESTAMP_TTL = -1
+
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+
+        self.query.last_timestamp_index.LAST_TIMESTAMP_TTL = 3600
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 0)
+
+    def test_older_ingests_do_not_lower_the_index(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 40)
+        older = generator.generate_file(1, "owner_0", "mac0", 40, start=self.earlier(records))
+        self.ingest(records)
+        self.request(["exp_1", "exp_2"])
+
+        # A re-upload of older rows while the entries are live
+        self.ingest(older)
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 0)
+
+        # And once they expired: they are kept, not renewed, and read from BigQuery again
+        index = self.process_files.last_timestamp_index
+        expired = index._store.get("owner_0/mac0")
+        index.LAST_TIMESTAMP_TTL = self.query.last_timestamp_index.LAST_TIMESTAMP_TTL = -1
+        self.ingest(older)
+        self.assertEqual(index._store.get("owner_0/mac0"), expired)
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+
+    def test_ingests_do_not_add_experiments(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 40)
+        self.ingest(records)
+        self.process_files.last_timestamp_index.invalidate_last_timestamps("owner_0", "mac0")
+
+        # A backfill of older rows, once the index lost the owner/MAC, is not taken for the newest rows
+        self.ingest(generator.generate_file(1, "owner_0", "mac0", 40, start=self.earlier(records)))
+        self.assertIsNone(self.process_files.last_timestamp_index._store.get("owner_0/mac0"))
+        self.assertEqual(self.request(["exp_1", "exp_2"]), self.newest(records))
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+
+    def test_older_values_do_not_replace_newer_ones(self):
+        index = self.process_files.last_timestamp_index
+        index.record_last_timestamps("owner_0", "mac0", {"exp_1": "2025-01-02 00:00:00"})
+        # A back-fill of query_last_timestamp that read BigQuery before the insert
+        self.query.last_timestamp_index.record_last_timestamps("owner_0", "mac0", {"exp_1": "2025-01-01 00:00:00"})
+
+        self.assertEqual(index.get_last_timestamps("owner_0", "mac0", ["exp_1"]), {"exp_1": "2025-01-02 00:00:00"})
+
+    def test_concurrent_writers_do_not_lose_updates(self):
+        index = self.process_files.last_timestamp_index
+        barrier = threading.Barrier(4)
+
+        def record(worker):
+            barrier.wait()
+            for step in range(3):
+                index.record_last_timestamps("owner_0", "mac0", {f"exp_{worker}_{step}": "2025-01-01 00:00:00"})
+
+        threads = [threading.Thread(target=record, args=(worker,)) for worker in range(4)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        names = [f"exp_{worker}_{step}" for worker in range(4) for step in range(3)]
+        self.assertEqual(len(index.get_last_timestamps("owner_0", "mac0", names)), len(names))
+
+    def test_the_index_is_disabled_without_a_bucket(self):
+        saved = os.environ.pop("STATE_BUCKET", None)
+        try:
+            module = bench.load_function("query_last_timestamp", "query_last_timestamp_plain")
+        finally:
+            if saved is not None:
+                os.environ["STATE_BUCKET"] = saved
+        self.assertEqual(module.last_timestamp_index.LAST_TIMESTAMP_BACKEND, "none")
+        self.assertEqual(self.query.last_timestamp_index.LAST_TIMESTAMP_BACKEND, "gcs")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Checks of the BigQuery lookups of query_last_timestamp with a fake BigQuery counting the query
+jobs and the bytes they scan, the last-timestamp index being disabled.
+
+    python -m unittest harness/test_last_timestamp_query.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+from google.cloud import bigquery  # noqa: E402
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+
+OWNER = "owner_0"
+MAC = "mac0"
+EXPERIMENTS = 20
+ROWS_PER_EXPERIMENT = 50
+
+
+class LastTimestampQueryTest(unittest.TestCase):
+    def setUp(self):
+        os.environ["LAST_TIMESTAMP_BACKEND"] = "none"
+        try:
+            self.module = bench.load_function("query_last_timestamp", "query_last_timestamp_main")
+        finally:
+            del os.environ["LAST_TIMESTAMP_BACKEND"]
+        self.bigquery = fakes.FakeBigQueryClient()
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), self.bigquery)
+        self.module._clients.clear()
+        self.bigquery.datasets.add(OWNER)
+        self.bigquery.create_table(bigquery.Table(f"{self.bigquery.project}.{OWNER}.{MAC}", schema=[
+            bigquery.SchemaField("ExperimentData_Exp_name", "STRING"),
+            bigquery.SchemaField("TimeStamp", "TIMESTAMP"),
+        ]))
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+
+    # Rows of the experiments, one minute apart, the newest age before now
+    def add_rows(self, experiment_names, age):
+        rows = [{"ExperimentData_Exp_name": name,
+                 "TimeStamp": (self.now - age - timedelta(minutes=index)).isoformat()}
+                for name in experiment_names for index in range(ROWS_PER_EXPERIMENT)]
+        errors = self.bigquery.insert_rows_json(f"{OWNER}.{MAC}", rows, [None] * len(rows))
+        self.assertEqual(errors, [])
+
+    def request(self, experiment_names):
+        import flask
+
+        self.bigquery.call_counts.clear()
+        self.bigquery.bytes_scanned = 0
+        body = json.dumps({"owner": OWNER, "mac_address": MAC, "experiment_names": experiment_names})
+        with contextlib.redirect_stdout(io.StringIO()):
+            status, text = bench.call_http(flask.Flask(__name__), self.module.query_last_timestamp, body)
+        self.assertEqual(status, 200, text)
+        return json.loads(text)
+
+    # Bytes of the two columns read for each row, as the fake bills them
+    def table_bytes(self, rows=None):
+        rows = self.bigquery.rows[f"{self.bigquery.project}.{OWNER}.{MAC}"] if rows is None else rows
+        return sum(10 + len(row["ExperimentData_Exp_name"]) for row in rows)
+
+    def test_all_experiments_are_answered_by_one_job(self):
+        names = [f"exp_{index}" for index in range(EXPERIMENTS)]
+        self.add_rows(names, timedelta(hours=1))
+
+        response = self.request(names)
+
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+        self.assertEqual(self.bigquery.bytes_scanned, self.table_bytes())
+        expected = (self.now - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        self.assertEqual(response, {name: expected for name in names})
+
+    def test_missing_experiments_are_reported_as_zero(self):
+        self.add_rows(["exp_0"], timedelta(hours=1))
+
+        response = self.request(["exp_0", "exp_missing"])
+
+        self.assertEqual(response["exp_missing"], 0)
+        self.assertIsInstance(response["exp_0"], str)
+        # The recent partitions, then the whole table for the experiment not found there
+        self.assertEqual(self.bigquery.call_counts["query"], 2)
+        self.assertEqual(list(response), ["exp_0", "exp_missing"])
+
+    def test_old_experiments_scan_the_whole_table_once(self):
+        recent = [f"exp_{index}" for index in range(EXPERIMENTS // 2)]
+        old = [f"exp_{index}" for index in range(EXPERIMENTS // 2, EXPERIMENTS)]
+        self.add_rows(recent, timedelta(hours=1))
+        self.add_rows(old, timedelta(days=self.module.LAST_TIMESTAMP_LOOKBACK_DAYS + 30))
+
+        response = self.request(recent + old)
+
+        self.assertEqual(self.bigquery.call_counts["query"], 2)
+        all_rows = self.bigquery.rows[f"{self.bigquery.project}.{OWNER}.{MAC}"]
+        recent_rows = [row for row in all_rows if row["ExperimentData_Exp_name"] in recent]
+        # The lookback query prunes the old partitions
+        self.assertEqual(self.bigquery.bytes_scanned, self.table_bytes(recent_rows) + self.table_bytes())
+        expected = (self.now - timedelta(days=self.module.LAST_TIMESTAMP_LOOKBACK_DAYS + 30))
+        self.assertEqual(response[old[0]], expected.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+if __name__ == "__main__":
+    unittest.main()
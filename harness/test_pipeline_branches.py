@@ -0,0 +1,100 @@
+"""
+Checks of the two branches of process_files.process_data (archival fan-out, BigQuery ingest):
+they run at the same time, and catalog_and_insert only deletes the upload when both succeed.
+
+    python -m unittest harness/test_pipeline_branches.py
+"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+from upload_standin import UploadStandIn  # noqa: E402
+
+UPLOAD_BUCKET = "uploads"
+FILE_NAME = "owner_0/mac0/upload.json"
+
+
+# BigQuery whose streaming inserts always fail
+class FailingInsertsBigQueryClient(fakes.FakeBigQueryClient):
+    def insert_rows_json(self, table_ref, json_rows, row_ids=None):
+        self.call("insert_rows_json")
+        raise RuntimeError("Injected insert failure")
+
+
+class PipelineBranchesTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = fakes.FakeStorageClient()
+        self.module = bench.load_function("process_files", "process_files_main")
+        self.module.UPLOAD_BACKOFF_SECONDS = 0
+        self.records = generator.generate_file(0, "owner_0", "mac0", 200)
+
+    def install(self, bigquery, standin):
+        bench.install_fakes(self.module, self.storage, bigquery, {"upload_To_bucket": standin})
+        self.module._http_session = None
+
+    def ingest(self):
+        blob = self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME)
+        blob.upload_from_string(generator.serialize(self.records))
+        event = fakes.FakeCloudEvent({"bucket": UPLOAD_BUCKET, "name": FILE_NAME, "generation": str(blob.generation)},
+                                     event_id="1")
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                self.module.catalog_and_insert(event)
+            except RuntimeError:
+                return False
+        return True
+
+    def upload_exists(self):
+        return self.storage.bucket(UPLOAD_BUCKET).blob(FILE_NAME).exists()
+
+    def test_upload_deleted_when_both_branches_succeed(self):
+        bigquery = fakes.FakeBigQueryClient()
+        standin = UploadStandIn(self.module.compression.decompress)
+        self.install(bigquery, standin)
+
+        self.assertTrue(self.ingest())
+        self.assertFalse(self.upload_exists())
+        self.assertEqual(bigquery.row_count(), len(self.records))
+        self.assertEqual(len(standin.unique_ids), len(self.records))
+
+    def test_upload_kept_when_archival_fails(self):
+        bigquery = fakes.FakeBigQueryClient()
+        self.install(bigquery, UploadStandIn(self.module.compression.decompress, error_rate=1.0, status_code=400))
+
+        self.assertFalse(self.ingest())
+        self.assertTrue(self.upload_exists())
+        # The BigQuery branch is not held back by the failing archival
+        self.assertEqual(bigquery.row_count(), len(self.records))
+
+    def test_upload_kept_when_ingest_fails(self):
+        standin = UploadStandIn(self.module.compression.decompress)
+        self.install(FailingInsertsBigQueryClient(), standin)
+
+        self.assertFalse(self.ingest())
+        self.assertTrue(self.upload_exists())
+        self.assertEqual(len(standin.unique_ids), len(self.records))
+
+    def test_branches_overlap(self):
+        # About 0.2 s in each branch: two archive requests, and five BigQuery calls
+        self.install(fakes.FakeBigQueryClient(latency=0.04),
+                     UploadStandIn(self.module.compression.decompress, latency=0.1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = self.module.process_data(self.records)
+
+        self.assertTrue(stats["ok"], stats["errors"])
+        stages = stats["stages"]
+        ingest = stages["create_bq_datasets_and_tables"] + stages["map_tables_to_lists"] + stages["batch_insert_to_bq"]
+        self.assertGreater(min(stages["send_lists_to_gcs"], ingest), 0.1)
+        self.assertLess(stages["total"], stages["send_lists_to_gcs"] + ingest - 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Checks of the routing index of process_files: BigQuery metadata calls made by process_data for
+the (Owner, MAC_address) pairs of a batch, on a project that already has many other tables.
+
+    python -m unittest harness/test_routing_index.py
+"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+OTHER_DEVICES = 20
+
+
+class RoutingIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.bigquery = fakes.FakeBigQueryClient()
+        self.module = bench.load_function("process_files", "process_files_main")
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        # Tables of other owners and devices, created by another instance
+        other = bench.load_function("process_files", "process_files_other")
+        bench.install_fakes(other, fakes.FakeStorageClient(), self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        for index in range(OTHER_DEVICES):
+            self.process(generator.generate_file(index, f"other_{index % 5}", f"mac{index:04x}", 4), other)
+        self.bigquery.call_counts.clear()
+
+    def process(self, records, module=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = (module or self.module).process_data(records)
+        self.assertTrue(stats["ok"], stats["errors"])
+        return stats
+
+    def test_only_the_pairs_of_the_batch_are_looked_up(self):
+        self.process(generator.generate_file(0, "owner_0", "mac0", 50))
+
+        counts = self.bigquery.call_counts
+        self.assertEqual(counts["list_datasets"], 0)
+        self.assertEqual(counts["list_tables"], 0)
+        # One check and one creation of the new dataset and table, the inserts reuse them
+        self.assertEqual(counts["get_dataset"], 1)
+        self.assertEqual(counts["create_dataset"], 1)
+        self.assertEqual(counts["get_table"], 1)
+        self.assertEqual(counts["create_table"], 1)
+
+    def test_warm_batches_make_no_metadata_calls(self):
+        self.process(generator.generate_file(0, "owner_0", "mac0", 50))
+        self.bigquery.call_counts.clear()
+
+        for seed in range(1, 4):
+            self.process(generator.generate_file(seed, "owner_0", "mac0", 50))
+
+        counts = self.bigquery.call_counts
+        self.assertEqual(sum(counts[method] for method in ("list_datasets", "list_tables", "get_dataset",
+                                                           "get_table", "create_dataset", "create_table")), 0)
+        self.assertEqual(counts["insert_rows_json"], 3)
+
+    def test_expired_entries_are_checked_again(self):
+        self.module.ROUTING_CACHE_TTL = 0
+        self.process(generator.generate_file(0, "owner_0", "mac0", 50))
+        self.bigquery.call_counts.clear()
+
+        self.process(generator.generate_file(1, "owner_0", "mac0", 50))
+
+        counts = self.bigquery.call_counts
+        self.assertEqual(counts["get_dataset"], 1)
+        self.assertGreaterEqual(counts["get_table"], 1)
+        self.assertEqual(counts["create_table"], 0)
+
+    def test_not_found_on_insert_invalidates_the_table(self):
+        self.process(generator.generate_file(0, "owner_0", "mac0", 50))
+        # The table is deleted behind the back of the function
+        ref = f"{self.bigquery.project}.owner_0.mac0"
+        del self.bigquery.tables[ref]
+        del self.bigquery.rows[ref]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = self.module.process_data(generator.generate_file(1, "owner_0", "mac0", 50))
+        self.assertIn("ingest", stats["errors"])
+        self.assertNotIn("owner_0;mac0", self.module._routing_index)
+
+        # The next batch finds the table missing and creates it again
+        self.bigquery.call_counts.clear()
+        self.process(generator.generate_file(2, "owner_0", "mac0", 50))
+        self.assertEqual(self.bigquery.call_counts["create_table"], 1)
+        self.assertEqual(len(self.bigquery.rows[ref]), 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Checks of the schema cache of process_files: BigQuery calls of update_table_schema_if_needed
+for batches with and without new columns, and the types of the new columns.
+
+    python -m unittest harness/test_schema_cache.py
+"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+SCHEMA_CALLS = ("get_table", "update_table")
+
+
+class SchemaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.bigquery = fakes.FakeBigQueryClient()
+        self.module = bench.load_function("process_files", "process_files_main")
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        self.ref = f"{self.bigquery.project}.owner_0.mac0"
+        self.process(generator.generate_file(0, "owner_0", "mac0", 50))
+        self.bigquery.call_counts.clear()
+
+    def process(self, records):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.module.process_data(records)
+
+    def schema_calls(self):
+        return {method: self.bigquery.call_counts[method] for method in SCHEMA_CALLS}
+
+    def fields(self):
+        return {field.name: (field.field_type, field.mode) for field in self.bigquery.tables[self.ref].schema}
+
+    def test_known_columns_cost_no_calls(self):
+        for seed in range(1, 4):
+            self.assertTrue(self.process(generator.generate_file(seed, "owner_0", "mac0", 50))["ok"])
+        self.assertEqual(self.schema_calls(), {"get_table": 0, "update_table": 0})
+
+    def test_new_columns_are_added_once_with_merged_types(self):
+        records = generator.generate_file(1, "owner_0", "mac0", 50)
+        for index, record in enumerate(records):
+            # In every row, typed consistently
+            record["SensorData"]["probe"] = index * 0.5
+            # Numbers in some rows and text in others
+            record["SensorData"]["mixed"] = index if index % 2 else "n/a"
+            # Only in the last row, as a list
+            if index == len(records) - 1:
+                record["SensorData"]["tags"] = ["a", "b"]
+
+        stats = self.process(records)
+
+        self.assertTrue(stats["ok"], stats["errors"])
+        # One read of the current schema before changing it, and one update with every new field
+        self.assertEqual(self.schema_calls(), {"get_table": 1, "update_table": 1})
+        fields = self.fields()
+        self.assertEqual(fields["SensorData_probe"], ("FLOAT64", "NULLABLE"))
+        self.assertEqual(fields["SensorData_mixed"], ("STRING", "NULLABLE"))
+        self.assertEqual(fields["SensorData_tags"], ("STRING", "REPEATED"))
+        names = [field.name for field in self.bigquery.tables[self.ref].schema]
+        self.assertEqual(len(names), len(set(names)))
+
+        # The updated schema is cached
+        self.bigquery.call_counts.clear()
+        self.assertTrue(self.process(records)["ok"])
+        self.assertEqual(self.schema_calls(), {"get_table": 0, "update_table": 0})
+
+    def test_insert_errors_refresh_the_cached_schema(self):
+        # A column removed by hand: the cached schema is out of date and the insert fails
+        table = self.bigquery.tables[self.ref]
+        table.schema = [field for field in table.schema if field.name != "SensorData_temperature"]
+        self.assertFalse(self.process(generator.generate_file(1, "owner_0", "mac0", 50))["ok"])
+        self.bigquery.call_counts.clear()
+
+        # The next batch reads the schema again and adds the column back
+        self.assertTrue(self.process(generator.generate_file(2, "owner_0", "mac0", 50))["ok"])
+        self.assertEqual(self.schema_calls(), {"get_table": 2, "update_table": 1})
+        self.assertIn("SensorData_temperature", self.fields())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Checks of the schema inference of process_files on heterogeneous batches: new tables are created
+with the merged schema of the whole batch, so their first inserts need no schema update.
+
+    python -m unittest harness/test_schema_inference.py
+"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+
+class SchemaInferenceTest(unittest.TestCase):
+    def setUp(self):
+        self.bigquery = fakes.FakeBigQueryClient()
+        self.module = bench.load_function("process_files", "process_files_main")
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+
+    def process(self, records):
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = self.module.process_data(records)
+        self.assertTrue(stats["ok"], stats["errors"])
+
+    def fields(self, table):
+        return {field.name: (field.field_type, field.mode)
+                for field in self.bigquery.tables[f"{self.bigquery.project}.{table}"].schema}
+
+    def test_fields_of_later_records_are_in_the_created_table(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 60)
+        records[0]["SensorData"]["co2_ppm"] = None
+        records[30]["SensorData"]["co2_ppm"] = 412.5
+        # Only in the last records
+        records[-1]["SensorData"]["firmware"] = "1.2"
+        records[-2]["SensorData"]["channels"] = [1, 2]
+        # Numbers in some records and text in others
+        for index, record in enumerate(records):
+            record["SensorData"]["status"] = index if index % 3 else "idle"
+        self.process(records)
+
+        fields = self.fields("owner_0.mac0")
+        self.assertEqual(fields["SensorData_co2_ppm"], ("FLOAT64", "NULLABLE"))
+        self.assertEqual(fields["SensorData_firmware"], ("STRING", "NULLABLE"))
+        self.assertEqual(fields["SensorData_channels"], ("STRING", "REPEATED"))
+        self.assertEqual(fields["SensorData_status"], ("STRING", "NULLABLE"))
+        self.assertEqual(fields["TimeStamp"], ("TIMESTAMP", "NULLABLE"))
+        self.assertEqual(fields["InsertDate"], ("TIMESTAMP", "NULLABLE"))
+        self.assertEqual(self.bigquery.call_counts["update_table"], 0)
+        self.assertEqual(self.bigquery.row_count(), len(records))
+
+    def test_tables_of_a_batch_share_its_schema(self):
+        mac0 = generator.generate_file(0, "owner_0", "mac0", 20)
+        mac1 = generator.generate_file(1, "owner_1", "mac1", 20)
+        # A field only the records of one device have
+        for record in mac1:
+            record["SensorData"]["voc_index"] = 100.0
+        self.process(mac0 + mac1)
+
+        self.assertEqual(self.fields("owner_0.mac0"), self.fields("owner_1.mac1"))
+        self.assertIn("SensorData_voc_index", self.fields("owner_0.mac0"))
+        self.assertEqual(self.bigquery.call_counts["update_table"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
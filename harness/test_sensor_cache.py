@@ -0,0 +1,138 @@
+"""
+Checks of the incremental syncs of fetch_google/sensor_cache.py with the fake BigQuery: rows
+that become visible after the watermark passed their InsertDate are fetched once, the
+experiments whose labels update-labels changed are fetched again, only the TimeStamp partitions
+within the upload lag are read, and the files of a day are merged into one.
+
+    python -m unittest harness/test_sensor_cache.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+from sensor_cache_bench import MAC_ADDRESS, OWNER, START, make_rows, make_source  # noqa: E402
+
+import sensor_cache  # noqa: E402
+
+SOURCE = types.SimpleNamespace(sensors=2, interval_minutes=30)
+
+
+class SensorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="sensor_cache_")
+        self.client = make_source(SOURCE, 1)
+        self.table = f"{OWNER}.{MAC_ADDRESS}"
+        self.rows = self.client.rows[f"{self.client.project}.{self.table}"]
+        self.now = START + timedelta(days=1) + sensor_cache.SENSOR_CACHE_DELAY
+        self.first = self.sync()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def sync(self, after=timedelta(0)):
+        return sensor_cache.sync_table(self.client, OWNER, MAC_ADDRESS, self.cache_dir, now=self.now + after)
+
+    def cached(self, columns=None):
+        return sensor_cache.read_sensor_table(OWNER, MAC_ADDRESS, columns, cache_dir=self.cache_dir).to_pylist()
+
+    def test_late_rows_are_fetched_once(self):
+        watermark = self.now - sensor_cache.SENSOR_CACHE_DELAY
+        late = dict(self.rows[-1], UniqueID="late_row",
+                    InsertDate=(watermark - timedelta(minutes=10)).strftime("%Y-%m-%d %H:%M:%S.%f"))
+        # A row inserted twice, and the late row, visible only after the first sync
+        self.client.insert_rows_json(self.table, [dict(self.rows[-1]), late])
+
+        self.assertEqual(self.sync(timedelta(hours=1))["rows"], 1)
+        self.assertEqual(self.sync(timedelta(hours=2))["rows"], 0)
+
+        unique_ids = [row["UniqueID"] for row in self.cached(["UniqueID"])]
+        self.assertEqual(len(unique_ids), self.first["rows"] + 1)
+        self.assertEqual(len(set(unique_ids)), len(unique_ids))
+
+    def test_relabeled_experiments_are_fetched_again(self):
+        self.assertEqual(self.sync(timedelta(hours=1))["refetched_experiments"], [])
+
+        # An incremental run of update-labels relabels the rows of exp_1
+        for row in self.rows:
+            if row["ExperimentData_Exp_name"] == "exp_1":
+                row["SensorData_Labels"] = ["relabeled"]
+        table = self.client.get_table(self.table)
+        labels_watermark = START + timedelta(hours=12) - sensor_cache.EPOCH
+        table.labels = {sensor_cache.LABELS_WATERMARK_LABEL: str(labels_watermark // timedelta(microseconds=1))}
+        self.client.update_table(table, ["labels"])
+
+        result = self.sync(timedelta(hours=2))
+        self.assertEqual(result["refetched_experiments"], ["exp_1"])
+        self.assertEqual(result["refetched_rows"], self.first["rows"])
+        rows = self.cached(["UniqueID", "SensorData_Labels"])
+        self.assertEqual(len(rows), self.first["rows"])
+        self.assertTrue(all(row["SensorData_Labels"] == ["relabeled"] for row in rows))
+
+        # Nothing is fetched again until the labels watermark moves
+        self.assertEqual(self.sync(timedelta(hours=3))["refetched_experiments"], [])
+
+    def test_rows_of_the_next_day_are_added(self):
+        self.client.insert_rows_json(self.table, make_rows(1, 1, SOURCE.sensors, SOURCE.interval_minutes))
+        result = self.sync(timedelta(days=1))
+        self.assertEqual(result["rows"], self.first["rows"])
+        self.assertEqual(len(self.cached(["UniqueID"])), 2 * self.first["rows"])
+
+    def test_readings_older_than_the_upload_lag_are_not_read(self):
+        timestamp_start = self.now - sensor_cache.SENSOR_CACHE_DELAY - sensor_cache.SENSOR_CACHE_OVERLAP \
+            - sensor_cache.SENSOR_CACHE_MAX_UPLOAD_LAG
+        insert_date = (self.now + timedelta(minutes=10)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        late = [dict(self.rows[-1], UniqueID=unique_id, InsertDate=insert_date,
+                     TimeStamp=(timestamp_start + offset).strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+                for unique_id, offset in (("within_lag", timedelta(hours=1)), ("beyond_lag", -timedelta(hours=1)))]
+        self.client.insert_rows_json(self.table, late)
+
+        self.assertEqual(self.sync(timedelta(hours=1))["rows"], 1)
+        self.assertIn("within_lag", [row["UniqueID"] for row in self.cached(["UniqueID"])])
+
+    def test_day_files_are_merged(self):
+        self.client.insert_rows_json(self.table, make_rows(1, 1, SOURCE.sensors, SOURCE.interval_minutes))
+        for hours in (6, 12, 18, 24):
+            self.assertEqual(self.sync(timedelta(hours=hours))["compacted_days"], 0 if hours == 6 else 1)
+
+        directory = sensor_cache.table_dir(self.cache_dir, OWNER, MAC_ADDRESS)
+        for root, _, names in os.walk(directory):
+            if os.path.basename(root).startswith("date="):
+                self.assertEqual(len(names), 1, root)
+        state = sensor_cache.read_sync_state(directory)
+        self.assertEqual(state["compactions"], {})
+        self.assertEqual(len(state["syncs"]), 2)
+        unique_ids = [row["UniqueID"] for row in self.cached(["UniqueID"])]
+        self.assertEqual(len(unique_ids), 2 * self.first["rows"])
+        self.assertEqual(len(set(unique_ids)), len(unique_ids))
+
+    def test_interrupted_compaction_is_finished_by_the_next_sync(self):
+        self.client.insert_rows_json(self.table, make_rows(1, 1, SOURCE.sensors, SOURCE.interval_minutes))
+        self.sync(timedelta(hours=6))
+        # Stops after the merged files are recorded, before the parts they replace are removed
+        with mock.patch.object(sensor_cache, "finish_compactions"):
+            self.assertEqual(self.sync(timedelta(hours=12))["compacted_days"], 1)
+        directory = sensor_cache.table_dir(self.cache_dir, OWNER, MAC_ADDRESS)
+        self.assertEqual(len(sensor_cache.read_sync_state(directory)["compactions"]), 1)
+        self.assertCachedOnce(directory)
+
+        self.sync(timedelta(hours=13))
+        self.assertEqual(sensor_cache.read_sync_state(directory)["compactions"], {})
+        self.assertCachedOnce(directory)
+        # _sync.json and a file per experiment and day
+        self.assertEqual(sum(len(names) for _, _, names in os.walk(directory)), 3)
+
+    def assertCachedOnce(self, directory):
+        unique_ids = [row["UniqueID"] for row in self.cached(["UniqueID"])]
+        self.assertEqual(len(set(unique_ids)), len(unique_ids))
+        self.assertEqual(len(unique_ids), sensor_cache.read_sync_state(directory)["rows"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Checks of the streaming ingestion of process_files: iter_json_records on valid, malformed and
+truncated input, and catalog_and_insert on files that cannot be decoded, with the fakes of
+fakes.py.
+
+    python -m unittest discover -s harness
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+UPLOAD_BUCKET = "uploads"
+
+
+# Binary stream counting the bytes read from it
+class CountingStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class IterJsonRecordsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.module = bench.load_function("process_files", "process_files_main")
+
+    def parse(self, text, chunk_size):
+        return list(self.module.iter_json_records(io.BytesIO(text.encode("utf-8")), chunk_size))
+
+    def test_valid_input_at_any_chunk_size(self):
+        records = generator.generate_file(0, "owner", "mac", 20)
+        texts = [
+            (json.dumps(records), records),
+            (generator.serialize(records, ndjson=True).decode("utf-8"), records),
+            ('  [ {"a": 1.5e3}, {"b": [true, null]} ,{"c": "h\\u00e9"} ]\n', [{"a": 1.5e3}, {"b": [True, None]}, {"c": "hé"}]),
+            ('{"a": -1}\r\n\n  {"a": false}', [{"a": -1}, {"a": False}]),
+            ("[]", []),
+            ("", []),
+        ]
+        for text, expected in texts:
+            for chunk_size in (1, 3, 64, 1024 * 1024):
+                with self.subTest(text=text[:30], chunk_size=chunk_size):
+                    self.assertEqual(self.parse(text, chunk_size), expected)
+
+    def test_malformed_input_is_rejected(self):
+        texts = [
+            '[{"a": 1},,{"b": 2}]',
+            '[{"a": 1} {"b": 2}]',
+            '[{"a": 1},]',
+            '[,{"a": 1}]',
+            '{"a": 1}{"b": 2}',
+            '{"a": 1} {"b": 2}\n',
+            '[{"a": 1}',
+            '[{"a": 1}] {"b": 2}',
+            '{"a": tru}\n',
+        ]
+        for text in texts:
+            for chunk_size in (1, 3, 1024):
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    with self.assertRaises(json.JSONDecodeError):
+                        self.parse(text, chunk_size)
+
+    def test_error_stops_reading(self):
+        # A bad record early in a large file fails without reading (and buffering) the rest
+        records = generator.generate_file(0, "owner", "mac", 5000)
+        head = json.dumps(records[:10])[:-1]
+        data = (head + ', {"a": nul}, ' + json.dumps(records)[1:]).encode("utf-8")
+        stream = CountingStream(data)
+        with self.assertRaises(json.JSONDecodeError):
+            list(self.module.iter_json_records(stream, 4096))
+        self.assertLess(stream.bytes_read, len(head) + 3 * 4096)
+
+    def test_unterminated_string_is_bounded(self):
+        data = b'[{"a": "' + b"x" * 200000
+        stream = CountingStream(data)
+        with self.assertRaises(json.JSONDecodeError):
+            list(self.module.iter_json_records(stream, 4096, max_record_bytes=10000))
+        self.assertLess(stream.bytes_read, 10000 + 2 * 4096)
+
+
+class CatalogAndInsertDecodingTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = fakes.FakeStorageClient()
+        self.bigquery = fakes.FakeBigQueryClient()
+        self.module = bench.load_function("process_files", "process_files_main")
+        bench.install_fakes(self.module, self.storage, self.bigquery,
+                            {"upload_To_bucket": lambda payload, headers: (200, "ok")})
+        self.module.STREAM_BATCH_SIZE = 10
+
+    def ingest(self, name, data, content_encoding=None):
+        blob = self.storage.bucket(UPLOAD_BUCKET).blob(name)
+        blob.upload_from_string(data)
+        event_data = {"bucket": UPLOAD_BUCKET, "name": name, "generation": str(blob.generation)}
+        if content_encoding:
+            event_data["contentEncoding"] = content_encoding
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.module.catalog_and_insert(fakes.FakeCloudEvent(event_data, event_id="1"))
+        return output.getvalue()
+
+    def test_error_after_inserted_batches_is_logged_as_error(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 25)
+        data = json.dumps(records)[:-1] + ', {"a": nul}]'
+        output = self.ingest("owner_0/mac0/upload.json", data.encode("utf-8"))
+
+        self.assertEqual(self.bigquery.row_count(), 20)
+        self.assertTrue(self.storage.bucket(UPLOAD_BUCKET).blob("owner_0/mac0/upload.json").exists())
+        errors = [json.loads(line) for line in output.splitlines() if line.startswith('{"severity": "ERROR"')]
+        self.assertEqual(len(errors), 1)
+        self.assertIn("partially ingested", errors[0]["message"])
+        self.assertEqual(errors[0]["records"], 20)
+
+    def test_unsupported_content_encoding_keeps_the_file(self):
+        records = generator.generate_file(0, "owner_0", "mac0", 5)
+        # Returns instead of raising, so the event is not retried
+        self.ingest("owner_0/mac0/upload.json", json.dumps(records).encode("utf-8"), content_encoding="br")
+        self.assertEqual(self.bigquery.row_count(), 0)
+        self.assertTrue(self.storage.bucket(UPLOAD_BUCKET).blob("owner_0/mac0/upload.json").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
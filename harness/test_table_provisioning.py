@@ -0,0 +1,115 @@
+"""
+Checks of the table provisioning of process_files (create_bq_datasets_and_tables), with the
+metadata calls counted by the fake BigQuery: a batch mixing the devices of several owners only
+gets the tables of its (Owner, MAC_address) pairs, checked with bounded parallelism, and
+instances provisioning the same batch at once create each table once.
+
+    python -m unittest harness/test_table_provisioning.py
+"""
+import contextlib
+import io
+import os
+import sys
+import threading
+import unittest
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+
+OWNERS = 5
+DEVICES = 40
+
+
+# BigQuery recording the most metadata calls in flight at once
+class ConcurrencyCountingBigQueryClient(fakes.FakeBigQueryClient):
+    def __init__(self, latency=0.0):
+        super().__init__(latency=latency)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def call(self, method):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            super().call(method)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class TableProvisioningTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("process_files", "process_files_main")
+        # Each device belongs to one owner: 40 pairs, out of the 200 owner x MAC combinations
+        self.pairs = {(f"owner_{device % OWNERS}", f"mac{device:04x}") for device in range(DEVICES)}
+        records = [record for index, (owner, mac_address) in enumerate(sorted(self.pairs))
+                   for record in generator.generate_file(index, owner, mac_address, 2)]
+        self.batch = self.module.build_record_batch(records)
+
+    def provision(self, module, bigquery):
+        bench.install_fakes(module, fakes.FakeStorageClient(), bigquery)
+        module._clients.clear()
+        module.create_bq_datasets_and_tables(module.extract_paths(self.batch)[3], self.batch)
+
+    def tables(self, bigquery):
+        return {tuple(ref.split(".")[1:]) for ref in bigquery.tables}
+
+    def test_only_the_pairs_of_the_batch_get_a_table(self):
+        bigquery = fakes.FakeBigQueryClient()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provision(self.module, bigquery)
+
+        self.assertEqual(self.tables(bigquery), self.pairs)
+        counts = bigquery.call_counts
+        self.assertEqual((counts["get_dataset"], counts["create_dataset"]), (OWNERS, OWNERS))
+        self.assertEqual((counts["get_table"], counts["create_table"]), (DEVICES, DEVICES))
+
+        # Known pairs are answered by the routing index
+        bigquery.call_counts.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provision(self.module, bigquery)
+        self.assertEqual(sum(bigquery.call_counts.values()), 0)
+
+    def test_checks_run_with_bounded_parallelism(self):
+        self.module.PROVISION_MAX_WORKERS = 4
+        bigquery = ConcurrencyCountingBigQueryClient(latency=0.005)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.provision(self.module, bigquery)
+
+        self.assertEqual(self.tables(bigquery), self.pairs)
+        self.assertGreater(bigquery.max_in_flight, 1)
+        self.assertLessEqual(bigquery.max_in_flight, 4)
+
+    def test_concurrent_instances_create_each_table_once(self):
+        bigquery = fakes.FakeBigQueryClient(latency=0.002)
+        instances = [bench.load_function("process_files", f"process_files_{index}") for index in range(3)]
+        barrier = threading.Barrier(len(instances))
+        errors = []
+
+        def provision(module):
+            barrier.wait()
+            try:
+                self.provision(module, bigquery)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=provision, args=(module,)) for module in instances]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Instances that found a table missing created it with exists_ok, without an error
+        self.assertEqual(errors, [])
+        self.assertEqual(self.tables(bigquery), self.pairs)
+        self.assertEqual(len(bigquery.rows), DEVICES)
+
+
+if __name__ == "__main__":
+    unittest.main()
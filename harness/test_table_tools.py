@@ -0,0 +1,73 @@
+"""
+Checks of the table migration of process_files/table_tools.py with the fake BigQuery: a table
+still receiving streamed rows is not replaced in place, but can be copied elsewhere.
+
+    python -m unittest harness/test_table_tools.py
+"""
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import unittest
+
+from google.cloud import bigquery
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+
+TABLE = "owner_0.mac0"
+
+
+# Imports table_tools with the process_files main it reads the table layout from
+def load_table_tools():
+    main = bench.load_function("process_files", "process_files_main")
+    saved = sys.modules.get("main")
+    sys.modules["main"] = main
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "process_files_table_tools", os.path.join(bench.REPO_DIR, "process_files", "table_tools.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if saved is None:
+            del sys.modules["main"]
+        else:
+            sys.modules["main"] = saved
+    return module
+
+
+class TableToolsTest(unittest.TestCase):
+    def setUp(self):
+        self.table_tools = load_table_tools()
+        self.bigquery = fakes.FakeBigQueryClient()
+        # A table created before the partitioned layout, with streamed rows
+        self.bigquery.create_table(bigquery.Table(f"{self.bigquery.project}.{TABLE}", schema=[
+            bigquery.SchemaField("TimeStamp", "TIMESTAMP"),
+            bigquery.SchemaField("ExperimentData_Exp_name", "STRING"),
+        ]))
+        self.bigquery.insert_rows_json(TABLE, [{"TimeStamp": "2025-01-01 00:00:00", "ExperimentData_Exp_name": "exp_1"}])
+
+    def migrate(self, destination_dataset=None):
+        self.bigquery.call_counts.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.table_tools.migrate(self.bigquery, "owner_0", destination_dataset)
+
+    def test_table_with_a_streaming_buffer_is_not_replaced(self):
+        self.assertEqual(self.migrate(), [TABLE])
+        self.assertEqual(self.bigquery.call_counts["query"], 0)
+
+        self.bigquery.flush_streaming_buffer(TABLE)
+        self.assertEqual(self.migrate(), [])
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+
+    def test_table_with_a_streaming_buffer_is_copied(self):
+        self.assertEqual(self.migrate("owner_0_migrated"), [])
+        self.assertEqual(self.bigquery.call_counts["query"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Checks of the archival fan-out of process_files (send_lists_to_gcs) against a local
+upload_To_bucket stand-in with latency and injected 5xx errors.
+
+    python -m unittest harness/test_upload_fanout.py
+"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+from upload_standin import UploadStandIn  # noqa: E402
+
+
+class UploadFanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.module = bench.load_function("process_files", "process_files_main")
+        self.module.UPLOAD_BACKOFF_SECONDS = 0
+        self.records = generator.generate_file(0, "owner_0", "mac0", 400)
+        self.token_calls = 0
+
+    def send(self, standin, **kwargs):
+        def id_token(audience):
+            self.token_calls += 1
+            return fakes.fake_id_token(audience)
+
+        bench.install_fakes(self.module, fakes.FakeStorageClient(), fakes.FakeBigQueryClient(),
+                            {"upload_To_bucket": standin})
+        self.module.CLIENT_FACTORIES["id_token"] = id_token
+        self.module._http_session = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.module.send_lists_to_gcs(self.records, **kwargs)
+
+    def standin(self, **kwargs):
+        return UploadStandIn(self.module.compression.decompress, **kwargs)
+
+    def test_retried_errors_deliver_every_record_once(self):
+        standin = self.standin(latency=0.002, error_rate=0.3, max_failures=self.module.UPLOAD_MAX_RETRIES)
+        failed_chunks = self.send(standin, max_chunk_bytes=16 * 1024)
+
+        self.assertEqual(failed_chunks, [])
+        self.assertGreater(standin.errors, 0)
+        self.assertEqual(Counter(standin.unique_ids), Counter(record["UniqueID"] for record in self.records))
+        # The ID token is fetched once and shared by the workers
+        self.assertEqual(self.token_calls, 1)
+
+    def test_payloads_are_bounded_by_bytes_not_record_count(self):
+        standin = self.standin()
+        self.send(standin)
+
+        self.assertTrue(all(size <= self.module.UPLOAD_CHUNK_BYTES for size in standin.payload_sizes))
+        # The records of a payload are only limited by its size, so a payload holds more than 50 of them
+        self.assertLess(standin.requests, len(self.records) / 50)
+
+        # A record larger than the budget is sent on its own
+        standin = self.standin()
+        self.send(standin, max_chunk_bytes=100)
+        self.assertEqual(standin.requests, len(self.records))
+
+    def test_in_flight_requests_are_limited(self):
+        standin = self.standin(latency=0.02)
+        self.send(standin, max_chunk_bytes=8 * 1024, max_in_flight=4)
+        self.assertEqual(standin.peak_in_flight, 4)
+
+    def test_failed_chunks_are_reported(self):
+        # Retryable errors are retried UPLOAD_MAX_RETRIES times before the chunk is reported
+        standin = self.standin(error_rate=1.0)
+        failed_chunks = self.send(standin, max_chunk_bytes=64 * 1024)
+        self.assertEqual(sum(chunk["records"] for chunk in failed_chunks), len(self.records))
+        self.assertEqual(standin.requests, len(failed_chunks) * (self.module.UPLOAD_MAX_RETRIES + 1))
+        self.assertEqual({chunk["error"] for chunk in failed_chunks}, {"Status code: 503"})
+
+        # Other errors are not retried
+        standin = self.standin(error_rate=1.0, status_code=400)
+        failed_chunks = self.send(standin, max_chunk_bytes=64 * 1024)
+        self.assertEqual(standin.requests, len(failed_chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Throughput of the archival fan-out of process_files (send_lists_to_gcs) by number of requests
+in flight, against a local upload_To_bucket stand-in with latency and injected 5xx errors.
+
+    python harness/upload_fanout_bench.py [--records 20000] [--concurrency 1 2 4 8 16]
+                                          [--latency 0.05] [--error-rate 0.05] [--runs 3]
+
+Each request of the stand-in takes --latency seconds and fails with a 503 with probability
+--error-rate. The records of one upload are sent once per concurrency level, with the default
+payload budget (UPLOAD_CHUNK_BYTES) and gzip payloads. Retries back off for 50 ms, 100 ms...
+Reported: records per second (median of --runs runs), requests and injected errors, and the
+chunks still failing after UPLOAD_MAX_RETRIES retries.
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HARNESS_DIR)
+
+import bench  # noqa: E402
+import fakes  # noqa: E402
+import generator  # noqa: E402
+from upload_standin import UploadStandIn  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request of the stand-in")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Share of requests failing with a 503")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    module = bench.load_function("process_files", "process_files_main")
+    module.UPLOAD_BACKOFF_SECONDS = 0.05
+    records = generator.generate_file(0, "owner_0", "mac0", args.records)
+
+    print(f"{len(records)} records, {args.latency * 1000:.0f} ms per request, {args.error_rate:.0%} errors, "
+          f"median of {args.runs} runs")
+    print(f"{'in flight':>9}{'records/s':>11}{'requests':>10}{'errors':>8}{'failed':>8}")
+    for concurrency in args.concurrency:
+        throughputs = []
+        for seed in range(args.runs):
+            standin = UploadStandIn(module.compression.decompress, args.latency, args.error_rate, seed=seed)
+            bench.install_fakes(module, fakes.FakeStorageClient(), fakes.FakeBigQueryClient(),
+                                {"upload_To_bucket": standin})
+            module._http_session = None
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed_chunks = module.send_lists_to_gcs(records, max_in_flight=concurrency)
+            throughputs.append(len(records) / (time.perf_counter() - started))
+        print(f"{concurrency:>9}{statistics.median(throughputs):>11.0f}{standin.requests:>10}{standin.errors:>8}"
+              f"{len(failed_chunks):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Stand-in for the upload_To_bucket function behind the fake HTTP session: answers after a
+# delay, fails a share of the requests with a 5xx status, and records the records it accepted
+# and the requests in flight. max_failures caps the errors injected for the same payload, so
+# a sender retrying at least that many times delivers everything.
+# Used by test_upload_fanout.py and upload_fanout_bench.py.
+import json
+import random
+import threading
+import time
+
+
+class UploadStandIn:
+    def __init__(self, decompress, latency=0.0, error_rate=0.0, status_code=503, max_failures=None, seed=0):
+        self.decompress = decompress
+        self.latency = latency
+        self.error_rate = error_rate
+        self.status_code = status_code
+        self.max_failures = max_failures
+        self.failures = {}  # payload -> errors injected
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.payload_sizes = []
+        self.unique_ids = []
+
+    # Route of fakes.FakeHttpSession: (payload bytes, headers) -> (status, text)
+    def __call__(self, payload, headers):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            failed = self.rng.random() < self.error_rate
+            if failed and self.max_failures is not None:
+                failed = self.failures.get(payload, 0) < self.max_failures
+                self.failures[payload] = self.failures.get(payload, 0) + failed
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if failed:
+                with self.lock:
+                    self.errors += 1
+                return self.status_code, "Injected error"
+            body = self.decompress(payload, headers.get("Content-Encoding"))
+            records = json.loads(body)
+            with self.lock:
+                self.payload_sizes.append(len(body))
+                self.unique_ids.extend(record["UniqueID"] for record in records)
+            return 200, "ok"
+        finally:
+            with self.lock:
+                self.in_flight -= 1
@@ -0,0 +1,101 @@
+# Ingestion ledger: the tables and rows of each batch of an uploaded file committed to BigQuery.
+# A file is identified by bucket, name and generation, so a retried event for the same upload
+# skips the rows committed by the earlier attempt, while a new upload of the same name starts
+# from an empty entry. Entries are cleared when the file is deleted after full success.
+#
+# One document per batch in the state store (state_store.py), keyed by the file and the offset of
+# the first record of the batch in the file: {"records", "tables", "offsets", "updated_at"}, tables
+# being the "owner;mac_address" keys whose rows of the batch are all done with (inserted, or
+# rejected as invalid), and offsets the offsets in the file of the rows done with in the other
+# tables. Recording a batch only rewrites its own small document, however many batches the file has.
+#
+# Backend selected with INGEST_LEDGER_BACKEND:
+#   "gcs"    - in INGEST_LEDGER_BUCKET (default STATE_BUCKET), shared by all instances; the
+#              default when a bucket is set
+#   "memory" - in-process LRU of INGEST_LEDGER_MAX_BATCHES batches, for tests and offline runs
+#              (only retries that reach the same warm instance would benefit)
+#   "none"   - disabled, the default without a bucket
+import os
+import threading
+import time
+
+import state_store
+
+INGEST_LEDGER_BUCKET = os.environ.get("INGEST_LEDGER_BUCKET", state_store.STATE_BUCKET)
+INGEST_LEDGER_BACKEND = state_store.default_backend(os.environ.get("INGEST_LEDGER_BACKEND"), INGEST_LEDGER_BUCKET)
+# Storage triggers are retried for up to 7 days
+INGEST_LEDGER_TTL = int(os.environ.get("INGEST_LEDGER_TTL", 7 * 24 * 3600))
+INGEST_LEDGER_MAX_BATCHES = int(os.environ.get("INGEST_LEDGER_MAX_BATCHES", 10000))
+
+_store = state_store.StateStore("ingest_ledger", INGEST_LEDGER_BACKEND, INGEST_LEDGER_BUCKET,
+                                INGEST_LEDGER_MAX_BATCHES)
+
+_lock = threading.Lock()
+
+# Records looked up and records skipped as already committed, since the instance started
+_dedup_counts = {"records": 0, "skipped": 0}
+
+
+def file_key(bucket_name, file_name, generation):
+    return f"{bucket_name}/{file_name}#{generation}"
+
+
+# Offsets are zero-padded so the batches of a file list in order
+def _batch_key(key, offset):
+    return f"{key}/{offset:012d}"
+
+
+def enabled():
+    return _store.enabled
+
+
+# Returns {offset: {"records", "tables", "offsets"}} of the batches of a file committed by earlier
+# attempts, tables being a set of "owner;mac_address" keys and offsets a set of record offsets
+def get_committed_batches(key):
+    if not _store.enabled:
+        return {}
+    prefix = f"{key}/"
+    oldest = time.time() - INGEST_LEDGER_TTL
+    return {
+        int(batch_key[len(prefix):]): {"records": entry["records"], "tables": set(entry["tables"]),
+                                       "offsets": set(entry.get("offsets", []))}
+        for batch_key, entry in _store.get_many(_store.keys(prefix)).items()
+        if entry["updated_at"] >= oldest
+    }
+
+
+# Adds tables and record offsets to the committed ones of the batch of records records starting
+# at offset
+def record_committed_tables(key, offset, records, tables, offsets=()):
+    if not _store.enabled or not (tables or offsets):
+        return
+
+    def merge(entry):
+        same_batch = entry and entry["records"] == records
+        committed = set(entry["tables"]) if same_batch else set()
+        committed_offsets = set(entry.get("offsets", [])) if same_batch else set()
+        return {"records": records, "tables": sorted(committed | set(tables)),
+                "offsets": sorted(committed_offsets | set(offsets)), "updated_at": time.time()}
+
+    if not _store.update(_batch_key(key, offset), merge):
+        # Not fatal: the rows are committed, a retry would insert them again with the same insertIds
+        print(f"Could not update the ingestion ledger of {key} at record {offset}.")
+
+
+# Forgets a file, once it has been fully processed and deleted
+def clear_committed_batches(key):
+    if _store.enabled:
+        _store.delete_prefix(f"{key}/")
+
+
+def count_dedup(records, skipped):
+    with _lock:
+        _dedup_counts["records"] += records
+        _dedup_counts["skipped"] += skipped
+
+
+# Returns {"records", "skipped", "hit_rate"} since the instance started
+def dedup_stats():
+    with _lock:
+        records, skipped = _dedup_counts["records"], _dedup_counts["skipped"]
+    return {"records": records, "skipped": skipped, "hit_rate": skipped / records if records else 0.0}
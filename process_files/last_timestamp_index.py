@@ -0,0 +1,77 @@
+# Last-timestamp index: the newest TimeStamp per (Owner, MAC_address, Exp_name).
+# query_last_timestamp reads it before BigQuery and back-fills it from BigQuery, and process_files
+# raises its entries as it inserts rows.
+# This file is shared by both functions and must be kept identical in process_files/ and
+# query_last_timestamp/.
+#
+# One document per owner/MAC in the state store (state_store.py),
+# {exp_name: {"last_timestamp", "updated_at"}}, with the backend selected with LAST_TIMESTAMP_BACKEND:
+#   "gcs"    - in LAST_TIMESTAMP_BUCKET (default STATE_BUCKET), shared by all instances; the
+#              default when a bucket is set
+#   "memory" - in-process LRU of LAST_TIMESTAMP_CACHE_SIZE owner/MACs, for tests and offline runs
+#   "none"   - disabled, the default without a bucket
+import os
+import time
+
+import state_store
+
+LAST_TIMESTAMP_BUCKET = os.environ.get("LAST_TIMESTAMP_BUCKET", state_store.STATE_BUCKET)
+LAST_TIMESTAMP_BACKEND = state_store.default_backend(os.environ.get("LAST_TIMESTAMP_BACKEND"), LAST_TIMESTAMP_BUCKET)
+LAST_TIMESTAMP_TTL = int(os.environ.get("LAST_TIMESTAMP_TTL", 3600))
+LAST_TIMESTAMP_CACHE_SIZE = int(os.environ.get("LAST_TIMESTAMP_CACHE_SIZE", 10000))
+
+# Timestamps are stored in the format of the query_last_timestamp response, which sorts as text
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_store = state_store.StateStore("last_timestamps", LAST_TIMESTAMP_BACKEND, LAST_TIMESTAMP_BUCKET,
+                                LAST_TIMESTAMP_CACHE_SIZE)
+
+
+# Returns {exp_name: timestamp} for the experiments found in the index and not expired
+def get_last_timestamps(owner, mac_address, experiment_names):
+    if not _store.enabled or not experiment_names:
+        return {}
+    entries = _store.get(f"{owner}/{mac_address}") or {}
+    oldest = time.time() - LAST_TIMESTAMP_TTL
+    return {
+        experiment_name: entries[experiment_name]["last_timestamp"]
+        for experiment_name in experiment_names
+        if experiment_name in entries and entries[experiment_name]["updated_at"] >= oldest
+    }
+
+
+# Records {exp_name: timestamp}, keeping the newer value when the experiment is already indexed,
+# expired or not. Only values read from BigQuery (from_bigquery) add experiments or renew expired
+# entries: the rows of an ingested batch may be older than those already stored (a re-upload or
+# a backfill), so process_files only raises the entries the index has, and expired entries stay
+# expired until query_last_timestamp reads them again.
+def record_last_timestamps(owner, mac_address, timestamps, from_bigquery=True):
+    if not _store.enabled or not timestamps:
+        return
+
+    def merge(entries):
+        entries = entries or {}
+        now = time.time()
+        changed = False
+        for experiment_name, timestamp in timestamps.items():
+            current = entries.get(experiment_name)
+            if current is None:
+                if not from_bigquery:
+                    continue
+                entry = {"last_timestamp": timestamp, "updated_at": now}
+            else:
+                live = current["updated_at"] >= now - LAST_TIMESTAMP_TTL
+                entry = {"last_timestamp": max(current["last_timestamp"], timestamp),
+                         "updated_at": now if from_bigquery or live else current["updated_at"]}
+            entries[experiment_name] = entry
+            changed = changed or entry != current
+        return entries if changed else None
+
+    if not _store.update(f"{owner}/{mac_address}", merge):
+        print(f"Could not update the last-timestamp index of {owner}/{mac_address}, invalidating it.")
+        invalidate_last_timestamps(owner, mac_address)
+
+
+# Forgets every experiment of an owner/MAC, so the next read goes to BigQuery
+def invalidate_last_timestamps(owner, mac_address):
+    _store.delete(f"{owner}/{mac_address}")
@@ -4,15 +4,148 @@ import json
 from google.cloud import bigquery
 from datetime import datetime, timezone
 from google.cloud.exceptions import NotFound
-import google.auth.transport.requests
-import google.oauth2.id_token
 import os
+import re
+import codecs
+import io
+import uuid
+import hashlib
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import time
+import warnings
 import numpy as np
+import last_timestamp_index
+import daily_stats
+import ingest_ledger
+import metrics
+import compression
+import state_store
+from record_batch import EXP_NAME_COLUMN, MAC_ADDRESS_COLUMN, OWNER_COLUMN, RecordBatch
+
+# Streaming ingestion settings: bytes read from the uploaded blob per chunk and
+# number of records handed to process_data at a time
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 1024 * 1024))
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 5000))
+# Largest record accepted, in characters: a longer one (or an unterminated string) is an error
+# instead of growing the buffer to the end of the file
+STREAM_MAX_RECORD_BYTES = int(os.environ.get("STREAM_MAX_RECORD_BYTES", 16 * 1024 * 1024))
+
+# Archival fan-out settings for send_lists_to_gcs: concurrent requests, maximum payload
+# bytes per request, and retries (with exponential backoff) for a failing request
+UPLOAD_MAX_IN_FLIGHT = int(os.environ.get("UPLOAD_MAX_IN_FLIGHT", 8))
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", 256 * 1024))
+UPLOAD_MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", 3))
+UPLOAD_BACKOFF_SECONDS = float(os.environ.get("UPLOAD_BACKOFF_SECONDS", 0.5))
+# Content-Encoding of the payloads: "gzip", "zstd" or "identity" (uncompressed), and the
+# compression level (default: compression.DEFAULT_LEVELS). upload_To_bucket must be deployed
+# with compressed request support before this function sends compressed payloads.
+UPLOAD_CONTENT_ENCODING = compression.normalize_encoding(os.environ.get("UPLOAD_CONTENT_ENCODING", "gzip"))
+UPLOAD_COMPRESSION_LEVEL = int(os.environ["UPLOAD_COMPRESSION_LEVEL"]) if os.environ.get("UPLOAD_COMPRESSION_LEVEL") else None
+
+# Status codes worth retrying, anything else is reported as a permanent failure
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# The auth transport modules are only imported when an ID token is first needed
+def _fetch_id_token(audience):
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+
+    return google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), audience)
+
+
+# The Storage Write API client is only imported by the write_api ingestion backend
+def _new_bigquery_write_client():
+    from google.cloud import bigquery_storage_v1
+
+    return bigquery_storage_v1.BigQueryWriteClient()
+
+
+# Constructors of the Google clients, of the HTTP session and of the ID tokens used to call
+# the other functions. The offline harness (harness/) replaces them with local stand-ins.
+CLIENT_FACTORIES = {
+    "bigquery": bigquery.Client,
+    "bigquery_write": _new_bigquery_write_client,
+    "storage": storage.Client,
+    "http_session": requests.Session,
+    "id_token": _fetch_id_token,
+}
+
+# Clients created on first use and shared by the worker threads and warm invocations
+_clients = {}
+_clients_lock = threading.Lock()
+
+# HTTP session and ID tokens reused across warm invocations
+_http_session = None
+_id_tokens = {}  # audience -> (token, expiry timestamp)
+_id_tokens_lock = threading.Lock()
+
+# Datasets and tables checked or created at the same time by create_bq_datasets_and_tables
+PROVISION_MAX_WORKERS = int(os.environ.get("PROVISION_MAX_WORKERS", 8))
+
+# Tables are partitioned by day on TimeStamp and clustered by experiment and sensor, so queries
+# on a time range or an experiment only read the matching blocks
+TABLE_PARTITION_FIELD = "TimeStamp"
+TABLE_CLUSTERING_FIELDS = ["ExperimentData_Exp_name", "SensorData_Name"]
+
+# Seconds a dataset or table stays in the routing index before it is checked again
+ROUTING_CACHE_TTL = int(os.environ.get("ROUTING_CACHE_TTL", 600))
+
+# Routing index of datasets ("owner") and tables ("owner;mac_address") known to exist.
+# It lives at module level so warm invocations reuse it; entries map to their expiry time.
+_routing_index = {}
+
+# Streaming insert settings: limits of a single insert_rows_json request, tables inserted
+# concurrently, and retries for rows reported in the insert errors
+INSERT_MAX_ROWS = int(os.environ.get("INSERT_MAX_ROWS", 500))
+INSERT_MAX_BYTES = int(os.environ.get("INSERT_MAX_BYTES", 5 * 1024 * 1024))
+INSERT_MAX_WORKERS = int(os.environ.get("INSERT_MAX_WORKERS", 8))
+INSERT_MAX_RETRIES = int(os.environ.get("INSERT_MAX_RETRIES", 3))
+INSERT_BACKOFF_SECONDS = float(os.environ.get("INSERT_BACKOFF_SECONDS", 0.5))
+
+# Ingestion backend used by batch_insert_to_bq: "streaming" (insert_rows_json), "load_json" or
+# "load_parquet" (batched load jobs), "write_api" (Storage Write API Arrow appends) or "local"
+# (newline-delimited JSON files under LOCAL_INGEST_DIR, for offline runs)
+INGEST_BACKEND = os.environ.get("INGEST_BACKEND", "streaming")
+# Optional bucket where load job files are staged; without it they are loaded from memory
+INGEST_STAGING_BUCKET = os.environ.get("INGEST_STAGING_BUCKET")
+LOCAL_INGEST_DIR = os.environ.get("LOCAL_INGEST_DIR", "/tmp/local_ingest")
+
+# Maximum number of record shapes flatten_record keeps compiled key plans for
+FLATTEN_PLAN_CACHE_SIZE = int(os.environ.get("FLATTEN_PLAN_CACHE_SIZE", 4096))
+
+# Schema cache: table_ref -> (schema, set of field names), kept for the lifetime of a warm instance
+_schema_cache = {}
+
+def _get_client(kind):
+    with _clients_lock:
+        if kind not in _clients:
+            _clients[kind] = CLIENT_FACTORIES[kind]()
+        return _clients[kind]
+
+
+def get_bigquery_client():
+    return _get_client("bigquery")
+
+
+def get_storage_client():
+    return _get_client("storage")
+
+
+# The gcs backend of the state store (last-timestamp index) uses the storage client of the function
+state_store.set_storage_client_factory(get_storage_client)
+
+
+# Logs a structured line with severity ERROR, which Cloud Logging reports as an error
+def log_error(message, **fields):
+    print(json.dumps({"severity": "ERROR", "message": message, **fields}, default=str))
+
 
 # Triggered by a change in a storage bucket
 @functions_framework.cloud_event
+@metrics.instrumented("process_files")
 def catalog_and_insert(cloud_event):
     data = cloud_event.data
 
@@ -25,7 +158,7 @@ def catalog_and_insert(cloud_event):
     print(f"Event Details:\nID: {event_id}\nType: {event_type}\nBucket: {bucket_name}\nFile: {file_name}")
 
     # Access the Cloud Storage client
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
 
     # Get the bucket object
     bucket = storage_client.bucket(bucket_name)
@@ -33,285 +166,1013 @@ def catalog_and_insert(cloud_event):
     # Get the file object
     blob = bucket.blob(file_name)
 
-    # Download the file contents as a string
-    contents = blob.download_as_string()
+    # Batches of this upload already committed to BigQuery by an earlier attempt of the event
+    ledger_key = ingest_ledger.file_key(bucket_name, file_name, data.get("generation"))
+    committed_batches = ingest_ledger.get_committed_batches(ledger_key)
+    metrics.count("file_bytes", int(data.get("size") or 0))
 
-    try:
-        # Assuming the file contains a list of JSON objects
-        json_data_list = json.loads(contents.decode("utf-8"))
+    # Number of batches where the archival or the BigQuery branch failed
+    failed_batches = 0
+    records = 0
+    skipped = 0
 
-        if isinstance(json_data_list, list):
-            # Call process_data and pass the list of JSON objects
-            process_data(json_data_list)
+    try:
+        # Stream the file in chunks and process it in bounded batches of records,
+        # so memory use depends on STREAM_BATCH_SIZE and not on the file size.
+        # gzip and zstd files are decompressed as they are read; raw_download keeps Cloud Storage
+        # from decompressing gzip objects itself, which does not work with ranged reads.
+        with blob.open("rb", chunk_size=STREAM_CHUNK_SIZE, raw_download=True) as raw_stream:
+            encoding, stream = compression.open_decompressed(raw_stream, data.get("contentEncoding"), file_name)
+            if encoding:
+                print(f"Reading {encoding} compressed file")
+            for batch in iter_batches(iter_json_records(stream, STREAM_CHUNK_SIZE), STREAM_BATCH_SIZE):
+                # Tables and rows of this batch committed by an earlier attempt, when it read the same batch
+                committed = committed_batches.get(records)
+                same_batch = committed and committed["records"] == len(batch)
+                committed_tables = committed["tables"] if same_batch else set()
+                committed_offsets = committed["offsets"] if same_batch else set()
+
+                # Call process_data and pass the current batch of JSON objects
+                stats = process_data(batch, committed_tables, ledger_key, records, committed_offsets)
+                # Rows inserted are committed even when the batch failed elsewhere, or when other
+                # rows of their table failed
+                new_tables = set(stats["committed_tables"]) - committed_tables
+                new_offsets = set(stats["committed_offsets"]) - committed_offsets
+                if new_tables or new_offsets:
+                    ingest_ledger.record_committed_tables(ledger_key, records, len(batch), committed_tables | new_tables,
+                                                          committed_offsets | new_offsets)
+                records += len(batch)
+                skipped += stats["skipped"]
+                ingest_ledger.count_dedup(len(batch), stats["skipped"])
+                metrics.count("records", len(batch))
+                metrics.count("records_skipped", stats["skipped"])
+                if not stats["ok"]:
+                    failed_batches += 1
+            metrics.count("file_bytes_decompressed", stream.bytes_read)
+
+    except (json.JSONDecodeError, compression.DecompressionError, compression.UnsupportedEncodingError) as e:
+        # Retrying would fail the same way, so the file is kept for inspection without raising
+        print(f"Error decoding JSON: {e}")
+        if records:
+            # The batches before the error are in BigQuery, the rest of the file is not
+            metrics.count("files_partially_ingested")
+            log_error(f"Blob {file_name} partially ingested: {records} records processed before a decoding "
+                      f"error, the rest of the file was not. Blob kept.",
+                      bucket=bucket_name, file=file_name, generation=data.get("generation"), records=records,
+                      error=str(e))
         else:
-            print("The uploaded file does not contain a list of JSON objects.")
+            print(f"Blob {file_name} kept.")
+        return
 
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
+    print(f"Ingestion ledger: {skipped} of {records} records already committed, "
+          f"dedup stats since start: {json.dumps(ingest_ledger.dedup_stats())}")
 
-    # Deleting the file from the bucket after processing
+    # Deleting the file from the bucket only when both the archival and the BigQuery branches succeeded
+    # Otherwise raising makes the trigger retry the event (when retries are enabled), and the
+    # ledger keeps the retry from inserting the committed records again
+    if failed_batches:
+        raise RuntimeError(f"Blob {file_name} kept, {failed_batches} batches were not fully processed.")
     blob.delete()
+    ingest_ledger.clear_committed_batches(ledger_key)
     print(f"Blob {file_name} deleted.")
 
-# Returns 3 sets of strings to catalog by
-def extract_paths(json_list):
-    _id_set = set()
-    mac_address_set = set()
-    exp_name_set = set()
+# Whitespace between the tokens of the top-level array or between NDJSON records
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# An error this close to the end of the buffer may be a token cut at the chunk boundary (e.g. a
+# literal like "tru"); further from the end, more data cannot fix it
+_TRUNCATION_WINDOW = 64
+
+
+# Returns True if a decoding error of the buffer may go away once more data is read
+def _may_be_truncated(error, buffer):
+    return error.msg.startswith("Unterminated string") or len(buffer) - error.pos <= _TRUNCATION_WINDOW
+
+
+# Incrementally parses JSON records from a binary stream.
+# Accepts either a top-level JSON array or newline-delimited JSON (NDJSON), and rejects records
+# that are not separated by a comma (array) or a line break (NDJSON). The buffer only holds the
+# record being parsed and one chunk, so a record larger than max_record_bytes is an error.
+def iter_json_records(stream, chunk_size=STREAM_CHUNK_SIZE, max_record_bytes=STREAM_MAX_RECORD_BYTES):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    eof = False
+    is_array = None
+    # Array: whether a value (after "[" or ",") or a separator (after a value) comes next,
+    # and whether "]" may come next. NDJSON: whether a line break was seen since the last record.
+    expect_value = True
+    can_close = True
+    line_break = True
+
+    # Drops the consumed part of the buffer and appends the next chunk of text
+    def refill(buffer, pos):
+        if len(buffer) - pos > max_record_bytes:
+            raise json.JSONDecodeError(f"Record larger than {max_record_bytes} bytes", buffer, pos)
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return buffer[pos:] + text_decoder.decode(b"", final=True), True
+        return buffer[pos:] + text_decoder.decode(chunk), False
+
+    while True:
+        # Skip whitespace, reading more data until a token starts or the stream ends
+        end = _WHITESPACE.match(buffer, pos).end()
+        line_break = line_break or "\n" in buffer[pos:end]
+        pos = end
+        if pos >= len(buffer):
+            if eof:
+                if is_array:
+                    raise json.JSONDecodeError("Unterminated JSON array", buffer, pos)
+                return
+            buffer, eof = refill(buffer, pos)
+            pos = 0
+            continue
+
+        # The first character decides between a JSON array and NDJSON
+        if is_array is None:
+            is_array = buffer[pos] == "["
+            if is_array:
+                pos += 1
+                continue
+
+        if is_array:
+            if buffer[pos] == "]" and can_close:
+                # Only whitespace may follow the closing bracket
+                pos += 1
+                while True:
+                    trailing = _WHITESPACE.match(buffer, pos).end()
+                    if trailing != len(buffer):
+                        raise json.JSONDecodeError("Extra data", buffer, trailing)
+                    if eof:
+                        return
+                    buffer, eof = refill(buffer, len(buffer))
+                    pos = 0
+            if not expect_value:
+                if buffer[pos] != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                pos += 1
+                expect_value = True
+                can_close = False
+                continue
+        elif not line_break:
+            raise json.JSONDecodeError("Expecting a line break between records", buffer, pos)
 
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            # Only a record cut at the chunk boundary is worth reading more data for
+            if eof or not _may_be_truncated(e, buffer):
+                raise
+            buffer, eof = refill(buffer, pos)
+            pos = 0
+            continue
+
+        # A value ending exactly at the buffer end may be truncated (e.g. a number)
+        if end == len(buffer) and not eof:
+            buffer, eof = refill(buffer, pos)
+            pos = 0
+            continue
+
+        pos = end
+        expect_value = False
+        can_close = True
+        line_break = False
+        yield record
+
+
+# Groups the records into lists of at most batch_size JSON objects
+def iter_batches(records, batch_size):
+    batch = []
+    for record in records:
+        if not isinstance(record, dict):
+            print("Skipping record that is not a JSON object.")
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Returns 3 sets of strings to catalog by, and the set of (Owner, MAC_address) pairs (the tables)
+def extract_paths(batch):
+    _id_set = {_id for _id in batch.column(OWNER_COLUMN) if _id}
+    mac_address_set = {mac_address for mac_address in batch.column(MAC_ADDRESS_COLUMN) if mac_address}
+    exp_name_set = {exp_name for exp_name in batch.column(EXP_NAME_COLUMN) if exp_name}
+    table_pairs = set(batch.group_index())
+
+    return _id_set, mac_address_set, exp_name_set, table_pairs
+
+
+# Returns a pooled HTTP session shared by all requests of this instance
+def get_http_session():
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            session = CLIENT_FACTORIES["http_session"]()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(UPLOAD_MAX_IN_FLIGHT, 10))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+# Function to get the ID token for authentication, cached until shortly before it expires
+def get_id_token(audience, force_refresh=False):
+    with _id_tokens_lock:
+        token, expires_at = _id_tokens.get(audience, (None, 0))
+        if force_refresh or token is None or expires_at - 300 < time.time():
+            token = CLIENT_FACTORIES["id_token"](audience)
+            import google.auth.jwt
+
+            expires_at = google.auth.jwt.decode(token, verify=False).get("exp", 0)
+            _id_tokens[audience] = (token, expires_at)
+        return token
+
+
+# Splits the records into JSON payloads of at most max_chunk_bytes serialized bytes, so small
+# records share a request and a record larger than the budget is sent on its own
+def split_into_payloads(json_list, max_chunk_bytes):
+    chunk = []
+    chunk_bytes = 2
     for json_obj in json_list:
-        # Extract _id
-        _id = json_obj.get('Owner', None)
-        if _id:
-            _id_set.add(_id)
+        serialized = json.dumps(json_obj)
+        record_bytes = len(serialized.encode("utf-8")) + 2
+        if chunk and chunk_bytes + record_bytes > max_chunk_bytes:
+            yield len(chunk), "[" + ", ".join(chunk) + "]"
+            chunk = []
+            chunk_bytes = 2
+        chunk.append(serialized)
+        chunk_bytes += record_bytes
+    if chunk:
+        yield len(chunk), "[" + ", ".join(chunk) + "]"
+
+
+# Posts one payload, retrying with backoff on connection errors and retryable status codes.
+# A compressed payload is sent with its Content-Encoding.
+# Returns None on success or a description of the last error.
+def post_with_retries(url, payload, max_retries=UPLOAD_MAX_RETRIES, content_encoding=None):
+    session = get_http_session()
+    error = None
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(UPLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1) * (0.5 + random.random()))
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {get_id_token(url, force_refresh=(error == 401))}'  # Add ID token to the headers
+        }
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        try:
+            with metrics.timed_call("http.upload_To_bucket"):
+                response = session.post(url, data=payload, headers=headers, timeout=60)
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+            continue
 
-        # Extract MAC_address
-        mac_address = json_obj.get('ExperimentData', {}).get('MAC_address', None)
-        if mac_address:
-            mac_address_set.add(mac_address)
+        if response.status_code == 200:
+            return None
+        error = response.status_code
+        if response.status_code not in RETRYABLE_STATUS_CODES and response.status_code != 401:
+            break
 
-        # Extract Exp_name
-        exp_name = json_obj.get('ExperimentData', {}).get('Exp_name', None)
-        if exp_name:
-            exp_name_set.add(exp_name)
+    return f"Status code: {error}" if isinstance(error, int) else error
 
-    return _id_set, mac_address_set, exp_name_set
 
+# Compresses a payload with content_encoding (None: sent as is) and posts it. Runs on the upload
+# pool, where gzip and zstd release the GIL while compressing.
+def compress_and_post(url, payload, content_encoding=None):
+    if content_encoding:
+        payload = compression.compress(payload, content_encoding, UPLOAD_COMPRESSION_LEVEL)
+    metrics.count("archive_bytes_sent", len(payload))
+    return post_with_retries(url, payload, content_encoding=content_encoding)
 
-# Splits the lists into smaller lists to be processed by a separate cloud function
-def send_lists_to_gcs(json_list, size_of_list):
+
+# Splits the lists into smaller lists and sends them concurrently to a separate cloud function,
+# compressed with content_encoding. max_chunk_bytes bounds the uncompressed payloads.
+# Returns the chunks that still failed after retries.
+def send_lists_to_gcs(json_list, max_chunk_bytes=UPLOAD_CHUNK_BYTES, max_in_flight=UPLOAD_MAX_IN_FLIGHT,
+                      content_encoding=UPLOAD_CONTENT_ENCODING):
     # Cloud Function URL
     cloud_function_url = "https://me-west1-iucc-f4d.cloudfunctions.net/upload_To_bucket"
 
-    # Function to split the list into smaller lists
-    def split_into_lists(lst, size_of_list):
-        for i in range(0, len(lst), size_of_list):
-            yield lst[i:i + size_of_list]
-
-    # Function to get the ID token for authentication
-    def get_id_token(audience):
-        auth_req = google.auth.transport.requests.Request()
-        id_token = google.oauth2.id_token.fetch_id_token(auth_req, audience)
-        return id_token
-
-    # Split json_list into smaller lists
-    lists = split_into_lists(json_list, size_of_list)
-
-    # Get the ID token for authorization
-    id_token = get_id_token(cloud_function_url)
-
-    for list_number, current_list in enumerate(lists, start=1):
-        # Convert the current list to a JSON payload
-        payload = json.dumps(current_list)
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {id_token}'  # Add ID token to the headers
-        }
-
-        try:
-            # Send the current list via HTTP POST request to the cloud function
-            response = requests.post(cloud_function_url, data=payload, headers=headers)
+    # Get the ID token once up front, so the workers share the cached token
+    get_id_token(cloud_function_url)
+
+    failed_chunks = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = []
+        for list_number, (record_count, payload) in enumerate(
+                split_into_payloads(json_list, max_chunk_bytes), start=1):
+            payload = payload.encode("utf-8")
+            metrics.count("archive_bytes", len(payload))
+            future = executor.submit(compress_and_post, cloud_function_url, payload, content_encoding)
+            futures.append((list_number, record_count, future))
+
+        for list_number, record_count, future in futures:
+            error = future.result()
+            if error is not None:
+                print(f"Failed to send list {list_number} ({record_count} records): {error}")
+                failed_chunks.append({"list_number": list_number, "records": record_count, "error": error})
+
+    if failed_chunks:
+        print(f"{len(failed_chunks)} of {len(futures)} lists could not be sent.")
+    return failed_chunks
+
+
+# Returns True if the key is in the routing index and has not expired yet
+def _routing_index_contains(key):
+    expires_at = _routing_index.get(key)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        _routing_index.pop(key, None)
+        return False
+    return True
+
+
+def _routing_index_add(key):
+    _routing_index[key] = time.monotonic() + ROUTING_CACHE_TTL
+
+
+# Removes a table, or a dataset and all of its tables, from the routing index
+def invalidate_routing_index(dataset_id, table_id=None):
+    if table_id is not None:
+        _routing_index.pop(f"{dataset_id};{table_id}", None)
+        return
+    _routing_index.pop(dataset_id, None)
+    for key in [key for key in _routing_index if key.startswith(f"{dataset_id};")]:
+        _routing_index.pop(key, None)
+
+
+# Checks if the dataset exists, using the routing index before asking BigQuery
+def dataset_exists(client, dataset_id):
+    if _routing_index_contains(dataset_id):
+        return True
+    try:
+        with metrics.timed_call("bigquery.get_dataset"):
+            client.get_dataset(f"{client.project}.{dataset_id}")
+    except NotFound:
+        return False
+    _routing_index_add(dataset_id)
+    return True
+
+
+# Checks if the table exists, using the routing index before asking BigQuery
+def table_exists(client, dataset_id, table_id):
+    key = f"{dataset_id};{table_id}"
+    if _routing_index_contains(key):
+        return True
+    try:
+        with metrics.timed_call("bigquery.get_table"):
+            client.get_table(f"{client.project}.{dataset_id}.{table_id}")
+    except NotFound:
+        return False
+    _routing_index_add(dataset_id)
+    _routing_index_add(key)
+    return True
+
+
+# Sets the day partitioning on TABLE_PARTITION_FIELD and the clustering on TABLE_CLUSTERING_FIELDS,
+# as far as the schema has these fields (the partition field must be a TIMESTAMP)
+def apply_table_layout(table, schema):
+    field_types = {field.name: (field.field_type, field.mode) for field in schema}
+    if field_types.get(TABLE_PARTITION_FIELD, (None,))[0] == "TIMESTAMP" \
+            and field_types[TABLE_PARTITION_FIELD][1] != "REPEATED":
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=TABLE_PARTITION_FIELD)
+    else:
+        print(f"Table {table.table_id} has no {TABLE_PARTITION_FIELD} TIMESTAMP field, creating it unpartitioned.")
 
-            # Check if the request was successful
-            if response.status_code == 200:
-                continue
-            else:
-                print(f"Failed to send list {list_number}. Status code: {response.status_code}")
-                print(f"Response: {response.text}")
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred while sending list {list_number}: {e}")
+    clustering_fields = [
+        name for name in TABLE_CLUSTERING_FIELDS
+        if name in field_types and field_types[name][1] != "REPEATED"
+    ]
+    if clustering_fields:
+        table.clustering_fields = clustering_fields
 
 
-def create_bq_datasets_and_tables(_id_set, mac_address_set, json_sample):
+# Creates the datasets and tables of the (Owner, MAC_address) pairs seen in the batch, if absent.
+# Checks and creations run concurrently on PROVISION_MAX_WORKERS threads.
+def create_bq_datasets_and_tables(table_pairs, batch):
     # Initialize the BigQuery client
-    client = bigquery.Client()
+    client = get_bigquery_client()
+
+    # Schema of the batch, inferred once when the first table has to be created
+    batch_schema = []
+    batch_schema_lock = threading.Lock()
 
     # Helper function to create dataset if it doesn't exist
-    def create_dataset_if_not_exists(dataset_id):
-        try:
-            client.get_dataset(dataset_id)
+    def create_dataset_if_not_exists(_id):
+        dataset_id = f"{client.project}.{_id}"
+        if dataset_exists(client, _id):
             print(f"Dataset {dataset_id} already exists.")
-        except NotFound:
+        else:
             dataset = bigquery.Dataset(dataset_id)
             dataset.location = "US"  # Set location; you can customize this
-            client.create_dataset(dataset)
+            # exists_ok makes the creation idempotent when another instance created it meanwhile
+            with metrics.timed_call("bigquery.create_dataset"):
+                client.create_dataset(dataset, exists_ok=True)
+            _routing_index_add(_id)
             print(f"Created dataset {dataset_id}.")
 
-    # Helper function to create table if it doesn't exist
-    def create_table_if_not_exists(dataset_id, table_id, schema):
-        table_ref = f"{dataset_id}.{table_id}"
-        try:
-            client.get_table(table_ref)
+    # Helper function to create table if it doesn't exist, with the complete schema of the batch
+    def create_table_if_not_exists(_id, table_id):
+        dataset_id = f"{client.project}.{_id}"
+        if table_exists(client, _id, table_id):
             print(f"Table {table_id} already exists in dataset {dataset_id}.")
-        except NotFound:
-            table = bigquery.Table(table_ref, schema=schema)
-            client.create_table(table)
+        else:
+            with batch_schema_lock:
+                if not batch_schema:
+                    batch_schema.extend(infer_schema(batch))
+            table = bigquery.Table(f"{dataset_id}.{table_id}", schema=batch_schema)
+            apply_table_layout(table, batch_schema)
+            with metrics.timed_call("bigquery.create_table"):
+                table = client.create_table(table, exists_ok=True)
+            _routing_index_add(f"{_id};{table_id}")
+            # The table has every field of the batch, so the inserts need no schema update
+            _schema_cache[f"{dataset_id}.{table_id}"] = (table.schema, {field.name for field in table.schema})
             print(f"Created table {table_id} in dataset {dataset_id}.")
 
-    # Recursive function to build schema from JSON structure
-    def create_schema(json_obj, prefix=""):
-        schema = []
-        for key, value in json_obj.items():
-            # Sanitize the key by replacing invalid characters like '$' and '.' with '_'
-            sanitized_key = key.replace('$', '_').replace('.', '_')
-            field_name = f"{prefix}{sanitized_key}" if prefix else sanitized_key
-
-            if isinstance(value, dict):
-                # Recursively process nested fields
-                schema.extend(create_schema(value, prefix=f"{field_name}_"))
-            elif isinstance(value, list):
-                # Treat lists as repeated fields
-                schema.append(bigquery.SchemaField(field_name, "STRING", mode="REPEATED"))
-            else:
-                # Determine field type and add it to the schema
-                if isinstance(value, int): # nir change 20241217
-                    field_type = "FLOAT64"
-                elif isinstance(value, float):
-                    field_type = "FLOAT64"
-                elif isinstance(value, str):
-                    # Check for timestamp fields
-                    if 'TimeStamp' in key:
-                        field_type = "TIMESTAMP"
-                    else:
-                        field_type = "STRING"
-                else:
-                    field_type = "STRING"
-
-                schema.append(bigquery.SchemaField(field_name, field_type))
-
-        return schema
-
-    # Loop through each _id (dataset) and MAC_address (table)
-    for _id in _id_set:
-        dataset_id = f"{client.project}.{_id}"
-        # Create dataset if it doesn't exist
-        create_dataset_if_not_exists(dataset_id)
-
-        for mac_address in mac_address_set:
-            # Create schema from the sample JSON object
-            schema = create_schema(json_sample)
-            # Add the InsertDate field
-            schema.append(bigquery.SchemaField("InsertDate", "TIMESTAMP"))
-            # Create table if it doesn't exist
-            create_table_if_not_exists(dataset_id, mac_address, schema)
+    with ThreadPoolExecutor(max_workers=PROVISION_MAX_WORKERS) as executor:
+        # Datasets first, then the tables of the pairs actually present in the batch
+        list(executor.map(create_dataset_if_not_exists, {_id for _id, _ in table_pairs}))
+        list(executor.map(lambda pair: create_table_if_not_exists(*pair), table_pairs))
 
 
-# function that maps the datasets\tables to a list of JSONs to be batch inserted into BigQuery
-def map_tables_to_lists(json_list):
+# function that maps the datasets\tables to the rows of the batch to be batch inserted into BigQuery
+def map_tables_to_lists(batch):
     # Initialize the BigQuery client
-    client = bigquery.Client()
+    client = get_bigquery_client()
 
     # Map to hold the result
     table_map = {}
 
-    # Fetch all datasets in the project
-    datasets = client.list_datasets()  # List of DatasetListItem
-    for dataset in datasets:
-        dataset_id = dataset.dataset_id
+    # Resolve only the (Owner, MAC_address) pairs present in this batch through the routing index.
+    # The rows of each pair are taken from the group index of the batch.
+    for (_id, mac_address), indices in batch.group_index().items():
+        # Create the corresponding key for the rows in the format "_id;mac_address"
+        key = f"{_id};{mac_address}"
 
-        # Fetch all tables in the dataset
-        tables = client.list_tables(dataset_id)
-        for table in tables:
-            table_id = table.table_id
+        if table_exists(client, _id, mac_address):
+            table_map[key] = batch.take(indices)
+        else:
+            print(f"Warning: No matching dataset and table found for key {key}")
 
-            # Create a key for the map in the format "dataset_id;table_id"
-            key = f"{dataset_id};{table_id}"
-            # Initialize an empty list for this key
-            table_map[key] = []
+    return table_map
 
-    # Go over the json_list and map each JSON to the correct key
-    for json_obj in json_list:
-        # Extract the _id and MAC_address from the JSON
-        _id = json_obj.get('Owner', None)
-        mac_address = json_obj.get('ExperimentData', {}).get('MAC_address', None)
+# Returns the (field_type, mode) BigQuery uses for JSON values of the given Python type
+def bq_kind_type(kind, is_timestamp=False):
+    if issubclass(kind, list):
+        # Treat lists as repeated fields
+        return "STRING", "REPEATED"
+    if issubclass(kind, (int, float)):  # nir change 20241217 - integers are stored as FLOAT64
+        return "FLOAT64", "NULLABLE"
+    if issubclass(kind, str) and is_timestamp:
+        return "TIMESTAMP", "NULLABLE"
+    return "STRING", "NULLABLE"
+
+
+# Resolves two types seen for the same new field: the wider one wins, so mixed values fall back to STRING
+def _merge_field_types(current, seen):
+    if current is None or current == seen:
+        return seen
+    if seen is None:
+        return current
+    if "REPEATED" in (current[1], seen[1]):
+        return "STRING", "REPEATED"
+    return "STRING", "NULLABLE"
+
+
+# Names of the flattened fields whose original key contains 'TimeStamp', known from the flatten plans
+def _timestamp_field_names():
+    return {new_key for plan in list(_flatten_plans.values()) for new_key, is_timestamp in plan if is_timestamp}
+
+
+# Returns the new fields of the batch missing from existing_fields, in the order they first appear.
+# Each is typed from the types of the values of its column, merged like values of different rows.
+def find_new_fields(existing_fields, batch):
+    timestamp_fields = _timestamp_field_names()
+    new_fields = []
+    for field_name in batch.column_names:
+        if field_name in existing_fields:
+            continue
+        # None carries no type information, a column of nulls only is a STRING
+        is_timestamp = field_name in timestamp_fields or field_name.endswith('TimeStamp')
+        field_type = None
+        for kind in batch.value_kinds(field_name):
+            field_type = _merge_field_types(field_type, bq_kind_type(kind, is_timestamp))
+        new_fields.append(bigquery.SchemaField(field_name, *(field_type or ("STRING", "NULLABLE"))))
 
-        if _id and mac_address:
-            # Create the corresponding key for the JSON in the format "_id;mac_address"
-            key = f"{_id};{mac_address}"
+    return new_fields
 
-            # Add the JSON to the map under the correct key
-            if key in table_map:
-                table_map[key].append(json_obj)
-            else:
-                print(f"Warning: No matching dataset and table found for key {key}")
 
-    return table_map
+# Infers the merged schema of a batch: the union of the fields of all records, typed like the
+# schema updates, plus InsertDate
+def infer_schema(batch):
+    schema = find_new_fields({"InsertDate"}, batch)
+    # Add the InsertDate field
+    schema.append(bigquery.SchemaField("InsertDate", "TIMESTAMP"))
+    return schema
+
+
+# Drops the cached schema of a table, so the next batch fetches it again
+def invalidate_schema_cache(table_ref):
+    _schema_cache.pop(table_ref, None)
+
 
 # this function adds new columns if needed
-def update_table_schema_if_needed(table_ref, flattened_rows):
+def update_table_schema_if_needed(table_ref, batch, client=None):
     """
     Check if new columns exist in the data and add them dynamically to the table schema.
+    The table schema is cached, so rows without new columns cost no API calls.
     """
-    client = bigquery.Client()
-    table = client.get_table(table_ref)  # Fetch the current table schema
-    existing_fields = {field.name for field in table.schema}
-    new_fields = []
+    if table_ref not in _schema_cache:
+        client = client or get_bigquery_client()
+        with metrics.timed_call("bigquery.get_table"):
+            table = client.get_table(table_ref)  # Fetch the current table schema
+        _schema_cache[table_ref] = (table.schema, {field.name for field in table.schema})
 
     # Identify new fields from the data
-    for row in flattened_rows:
-        for field_name, value in row.items():
-            if field_name not in existing_fields:
-                # Dynamically determine the field type
-                if isinstance(value, int):
-                    field_type = "FLOAT64"  # Use FLOAT64 for integers - for edge cases 
-                elif isinstance(value, float):
-                    field_type = "FLOAT64"  # Use FLOAT64 for floating-point numbers
-                elif isinstance(value, str):
-                    field_type = "STRING"  # Use STRING for text
-                else:
-                    field_type = "STRING"  # Default to STRING for unsupported types
-
-                new_fields.append(bigquery.SchemaField(field_name, field_type))
+    new_fields = find_new_fields(_schema_cache[table_ref][1], batch)
+    if not new_fields:
+        return
+
+    # Re-read the table before changing it, another instance may have added columns already
+    client = client or get_bigquery_client()
+    with metrics.timed_call("bigquery.get_table"):
+        table = client.get_table(table_ref)
+    existing_fields = {field.name for field in table.schema}
+    new_fields = [field for field in new_fields if field.name not in existing_fields]
 
     if new_fields:
         # Update the table schema
-        updated_schema = table.schema + new_fields
-        table.schema = updated_schema
-        client.update_table(table, ["schema"])
+        table.schema = table.schema + new_fields
+        with metrics.timed_call("bigquery.update_table"):
+            table = client.update_table(table, ["schema"])
         print(f"4.5 - Added new columns to table {table_ref}: {[field.name for field in new_fields]}")
 
+    _schema_cache[table_ref] = (table.schema, {field.name for field in table.schema})
+
+
+# Splits rows into insert requests bounded by both the row count and the serialized size.
+# Takes the (upper bound of the) JSON size of each row and yields (start, end) row ranges.
+def split_insert_requests(row_sizes, max_rows=INSERT_MAX_ROWS, max_bytes=INSERT_MAX_BYTES):
+    start = 0
+    request_bytes = 0
+    for index, row_bytes in enumerate(row_sizes.tolist()):
+        if index > start and (index - start >= max_rows or request_bytes + row_bytes > max_bytes):
+            yield start, index
+            start = index
+            request_bytes = 0
+        request_bytes += row_bytes
+    if start < len(row_sizes):
+        yield start, len(row_sizes)
+
+
+# insertIds of the streamed rows, so BigQuery drops rows sent again by a retried request or a
+# retried event: the UniqueID, else a hash of the file and offset the row was read from, else
+# (batches not read from a file) a hash of the row without its InsertDate
+def row_insert_ids(batch, rows):
+    insert_ids = []
+    for unique_id, offset, row in zip(batch.column("UniqueID"), batch.offsets.tolist(), rows):
+        if unique_id:
+            insert_ids.append(unique_id)
+            continue
+        if batch.source is not None:
+            identity = f"{batch.source}:{offset}"
+        else:
+            identity = json.dumps({name: value for name, value in row.items() if name != "InsertDate"},
+                                  sort_keys=True, default=str)
+        insert_ids.append(hashlib.sha1(identity.encode("utf-8")).hexdigest())
+    return insert_ids
+
+
+# Returns True for the error of a row BigQuery would reject again whatever the retry: "invalid",
+# except for a field missing from the table, which the next batch adds to the cached schema
+def _is_permanently_invalid(error):
+    details = error.get("errors", [])
+    return any(detail.get("reason") == "invalid" for detail in details) and \
+        not any(str(detail.get("message", "")).startswith("no such field") for detail in details)
+
+
+# Inserts rows in size-bounded requests. Only the rows reported in the errors are retried;
+# rows rejected as "invalid" would fail again and are counted as failed right away.
+# failed_rows are the indexes in the batch of the rows that failed, invalid_rows those of the
+# rows that no retry of the event would insert (see _is_permanently_invalid).
+def insert_rows_with_retries(client, table_ref, batch):
+    result = {"rows_ok": 0, "rows_failed": 0, "retries": 0, "errors": [], "failed_rows": [], "invalid_rows": []}
+
+    rows = batch.to_rows()
+    # Computed once, so every attempt of a row sends the same insertId
+    insert_ids = row_insert_ids(batch, rows)
+    for start, end in split_insert_requests(batch.row_sizes()):
+        request_rows = rows[start:end]
+        request_ids = insert_ids[start:end]
+        request_positions = list(range(start, end))
+        for attempt in range(INSERT_MAX_RETRIES + 1):
+            if attempt:
+                result["retries"] += 1
+                time.sleep(INSERT_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+            with metrics.timed_call("bigquery.insert_rows_json"):
+                errors = client.insert_rows_json(table_ref, request_rows, row_ids=request_ids)
+            failed_indexes = {error["index"] for error in errors}
+            result["rows_ok"] += len(request_rows) - len(failed_indexes)
+
+            retry_indexes = []
+            for error in errors:
+                reasons = {detail.get("reason") for detail in error.get("errors", [])}
+                if "invalid" in reasons or attempt == INSERT_MAX_RETRIES:
+                    result["rows_failed"] += 1
+                    result["failed_rows"].append(request_positions[error["index"]])
+                    if _is_permanently_invalid(error):
+                        result["invalid_rows"].append(request_positions[error["index"]])
+                    if len(result["errors"]) < 10:
+                        result["errors"].append(error)
+                else:
+                    retry_indexes.append(error["index"])
 
-def batch_insert_to_bq(table_map):
-    # Initialize the BigQuery client
-    client = bigquery.Client()
+            if not retry_indexes:
+                break
+            request_rows = [request_rows[index] for index in retry_indexes]
+            request_ids = [request_ids[index] for index in retry_indexes]
+            request_positions = [request_positions[index] for index in retry_indexes]
 
-    # Iterate over the table_map
-    for key, json_list in table_map.items():
-        # Split the key to get dataset_id and table_id
-        dataset_id, table_id = key.split(";")
+    result["failed_rows"].sort()
+    result["invalid_rows"].sort()
+    return result
 
-        # Create the full table reference
-        table_ref = f"{client.project}.{dataset_id}.{table_id}"
 
-        # Prepare the rows to insert
-        rows_to_insert = []
-        for json_obj in json_list:
-            # Add InsertDate field with the current timestamp
+# Converts an ISO timestamp string (as produced by flatten_json) to an aware UTC datetime
+def _parse_bq_timestamp(value):
+    if not isinstance(value, str):
+        return value
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-            # Getting current time
-            current_timestamp = datetime.now(timezone.utc)
 
-            # Format the timestamp as a string suitable for BigQuery (removing the timezone offset)
-            formatted_timestamp = current_timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]  # Microsecond precision
+# Parses a column of timestamps (ISO strings as flattened, or datetimes) to UTC datetime64[us].
+# Returns the array, NaT where there is no value, and the mask of the values that cannot be parsed.
+# ISO strings without an offset are parsed by NumPy at once, anything else one value at a time.
+def parse_timestamp_column(values):
+    if all(value is None or (type(value) is str and value[:1].isdigit()) for value in values):
+        try:
+            with warnings.catch_warnings():
+                # NumPy warns on UTC offsets, which it cannot represent
+                warnings.simplefilter("error")
+                return np.array(values, dtype="datetime64[us]"), np.zeros(len(values), dtype=bool)
+        except (ValueError, Warning):
+            pass
+
+    timestamps = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[us]")
+    invalid = np.zeros(len(values), dtype=bool)
+    for index, value in enumerate(values):
+        if value is None:
+            continue
+        try:
+            timestamps[index] = np.datetime64(
+                _parse_bq_timestamp(value).astimezone(timezone.utc).replace(tzinfo=None), "us")
+        except (TypeError, ValueError, AttributeError):
+            invalid[index] = True
+    return timestamps, invalid
+
+
+# Text BigQuery stores for a JSON value in a STRING field: booleans as true/false and objects as
+# JSON, like the rows of the streaming and load job backends
+def _string_value(value):
+    if isinstance(value, (bool, dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+# Builds a pyarrow Table with one typed column per field of the BigQuery schema.
+# Numeric and timestamp columns are converted from their NumPy arrays.
+def batch_to_arrow(batch, schema):
+    import pyarrow as pa
+
+    arrays = []
+    fields = []
+    for field in schema:
+        if field.mode == "REPEATED":
+            arrow_type = pa.list_(pa.string())
+            values = [[_string_value(item) for item in value] if value else [] for value in batch.column(field.name)]
+            array = pa.array(values, type=arrow_type)
+        elif field.field_type in ("FLOAT64", "FLOAT"):
+            arrow_type = pa.float64()
+            if field.name in batch.columns and batch.is_numeric(field.name):
+                array = pa.array(batch.columns[field.name].values, type=arrow_type,
+                                 mask=batch.null_mask(field.name))
+            else:
+                array = pa.array(batch.column(field.name), type=arrow_type)
+        elif field.field_type == "TIMESTAMP":
+            arrow_type = pa.timestamp("us", tz="UTC")
+            timestamps, invalid = parse_timestamp_column(batch.column(field.name))
+            if invalid.any():
+                raise ValueError(f"Invalid TIMESTAMP values in {field.name}")
+            array = pa.array(timestamps, mask=np.isnat(timestamps)).cast(arrow_type)
+        else:
+            arrow_type = pa.string()
+            array = pa.array([None if value is None else _string_value(value) for value in batch.column(field.name)],
+                             type=arrow_type)
+        arrays.append(array)
+        fields.append(pa.field(field.name, arrow_type))
 
-            json_obj["InsertDate"] = formatted_timestamp
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
 
-            # Flatten the JSON object to match BigQuery schema (no nested structures)
-            flattened_row = flatten_json(json_obj)
-            rows_to_insert.append(flattened_row)
 
-        if rows_to_insert:
-            # 20241218 - update chema if neede before insering rows
-            update_table_schema_if_needed(table_ref, rows_to_insert)
+# Lands rows with a single load job, from newline-delimited JSON or Parquet.
+# The file is staged in INGEST_STAGING_BUCKET when it is set.
+def load_rows_with_job(client, table_ref, batch, source_format="NEWLINE_DELIMITED_JSON"):
+    if source_format == "PARQUET":
+        import pyarrow.parquet as pq
 
+        buffer = io.BytesIO()
+        pq.write_table(batch_to_arrow(batch, _schema_cache[table_ref][0]), buffer)
+        extension = "parquet"
+    else:
+        buffer = io.BytesIO("\n".join(json.dumps(row) for row in batch.to_rows()).encode("utf-8"))
+        extension = "json"
+    buffer.seek(0)
 
-            # Insert rows into BigQuery table
-            errors = client.insert_rows_json(table_ref, rows_to_insert)
+    job_config = bigquery.LoadJobConfig(
+        source_format=source_format,
+        write_disposition="WRITE_APPEND",
+    )
 
-            if errors:
-                print(f"Errors occurred while inserting into {table_ref}: {errors}")
-            else:
-                print(f"Successfully inserted {len(rows_to_insert)} rows into {table_ref}")
+    staged_blob = None
+    try:
+        if INGEST_STAGING_BUCKET:
+            staged_blob = get_storage_client().bucket(INGEST_STAGING_BUCKET).blob(
+                f"staging/{table_ref}/{uuid.uuid4().hex}.{extension}")
+            staged_blob.upload_from_file(buffer)
+            load_job = client.load_table_from_uri(
+                f"gs://{INGEST_STAGING_BUCKET}/{staged_blob.name}", table_ref, job_config=job_config)
+        else:
+            load_job = client.load_table_from_file(buffer, table_ref, job_config=job_config)
+        with metrics.timed_call("bigquery.load_job"):
+            load_job.result()
+    except Exception as e:
+        return {"rows_ok": 0, "rows_failed": len(batch), "retries": 0, "errors": [repr(e)]}
+    finally:
+        if staged_blob is not None:
+            try:
+                staged_blob.delete()
+            except NotFound:
+                pass
+
+    return {"rows_ok": len(batch), "rows_failed": 0, "retries": 0, "errors": []}
+
+
+def load_rows_with_parquet_job(client, table_ref, batch):
+    return load_rows_with_job(client, table_ref, batch, source_format="PARQUET")
+
+
+# Appends rows as Arrow record batches to the default stream of the Storage Write API
+def append_rows_with_write_api(client, table_ref, batch):
+    from google.cloud.bigquery_storage_v1 import types, writer
+
+    project, dataset_id, table_id = table_ref.split(".")
+    schema = _schema_cache[table_ref][0]
+    arrow_schema = batch_to_arrow(batch.slice(0, 0), schema).schema
+
+    template = types.AppendRowsRequest()
+    template.write_stream = f"projects/{project}/datasets/{dataset_id}/tables/{table_id}/streams/_default"
+    template.arrow_rows.writer_schema.serialized_schema = arrow_schema.serialize().to_pybytes()
+
+    result = {"rows_ok": 0, "rows_failed": 0, "retries": 0, "errors": []}
+    # The write client (and its gRPC channel) is shared by the tables and warm invocations
+    append_stream = writer.AppendRowsStream(_get_client("bigquery_write"), template)
+    try:
+        sent = []
+        for start, end in split_insert_requests(batch.row_sizes()):
+            request = types.AppendRowsRequest()
+            record_batch = batch_to_arrow(batch.slice(start, end), schema).combine_chunks().to_batches()[0]
+            request.arrow_rows.rows.serialized_record_batch = record_batch.serialize().to_pybytes()
+            sent.append((end - start, append_stream.send(request)))
+
+        for row_count, future in sent:
+            try:
+                response = future.result()
+                row_errors = len(response.row_errors)
+                result["rows_ok"] += row_count - row_errors
+                result["rows_failed"] += row_errors
+                if row_errors:
+                    result["errors"].extend(str(error) for error in response.row_errors[:10])
+            except Exception as e:
+                result["rows_failed"] += row_count
+                result["errors"].append(repr(e))
+    finally:
+        append_stream.close()
+
+    return result
+
+
+# Offline stand-in: appends rows as newline-delimited JSON to LOCAL_INGEST_DIR/<table_ref>.json
+def write_rows_to_local_files(client, table_ref, batch):
+    os.makedirs(LOCAL_INGEST_DIR, exist_ok=True)
+    with open(os.path.join(LOCAL_INGEST_DIR, f"{table_ref}.json"), "a", encoding="utf-8") as f:
+        for row in batch.to_rows():
+            f.write(json.dumps(row) + "\n")
+    return {"rows_ok": len(batch), "rows_failed": 0, "retries": 0, "errors": []}
+
+
+# Ingestion backends: each takes (client, table_ref, batch) and returns
+# {"rows_ok", "rows_failed", "retries", "errors"}. The streaming backend also returns the
+# "failed_rows" and "invalid_rows" indexes; with the others, a table with failures is retried whole.
+INGEST_BACKENDS = {
+    "streaming": insert_rows_with_retries,
+    "load_json": load_rows_with_job,
+    "load_parquet": load_rows_with_parquet_job,
+    "write_api": append_rows_with_write_api,
+    "local": write_rows_to_local_files,
+}
+
+
+def get_ingest_backend(name=None):
+    name = name or INGEST_BACKEND
+    if name not in INGEST_BACKENDS:
+        raise ValueError(f"Unknown ingestion backend {name}, expected one of {sorted(INGEST_BACKENDS)}")
+    return INGEST_BACKENDS[name]
+
+
+# Raises the last-timestamp index entries of the experiments of the inserted rows to their newest
+# TimeStamp; experiments the index does not have are left to the back-fill of query_last_timestamp,
+# since the batch may be older than the rows already in BigQuery. When rows failed, or a TimeStamp cannot be parsed, the owner/MAC is invalidated instead, so
+# query_last_timestamp goes back to BigQuery rather than answering with an older value.
+def update_last_timestamp_index(dataset_id, table_id, batch, result):
+    if result["rows_failed"]:
+        last_timestamp_index.invalidate_last_timestamps(dataset_id, table_id)
+        return
+
+    timestamps, invalid = parse_timestamp_column(batch.column("TimeStamp"))
+    exp_codes, exp_names = _factorize(batch.column(EXP_NAME_COLUMN))
+    # Rows without an experiment are not indexed, whatever their TimeStamp
+    has_exp_name = np.array([bool(exp_name) for exp_name in exp_names], dtype=bool)[exp_codes]
+    if np.any(invalid & has_exp_name):
+        last_timestamp_index.invalidate_last_timestamps(dataset_id, table_id)
+        return
+
+    last_timestamps = {}
+    for exp_name, timestamp in zip(exp_names, _group_max(exp_codes, len(exp_names), timestamps)):
+        if exp_name and not np.isnat(timestamp):
+            last_timestamps[exp_name] = timestamp.item().strftime(last_timestamp_index.TIMESTAMP_FORMAT)
+
+    last_timestamp_index.record_last_timestamps(dataset_id, table_id, last_timestamps, from_bigquery=False)
+
+
+# Codes of the values of a column and the distinct values, in the order they first appear
+def _factorize(values):
+    codes = {}
+    value_codes = np.fromiter((codes.setdefault(value, len(codes)) for value in values),
+                              dtype=np.intp, count=len(values))
+    return value_codes, list(codes)
+
+
+# Newest timestamp of each of the groups given by codes, NaT for a group without any
+def _group_max(codes, num_groups, timestamps):
+    # NaT is the smallest datetime64 value, so it only wins in groups without a timestamp
+    newest = np.full(num_groups, np.datetime64("NaT"), dtype="datetime64[us]").view(np.int64)
+    np.maximum.at(newest, codes, timestamps.view(np.int64))
+    return newest.view("datetime64[us]")
+
+
+# Aggregates the rows of one table into the rollup of daily_stats.rollup_rows, from the columns:
+# {(exp_name, day): {"num_entries", "sensors", "last_timestamp"}}
+def daily_rollup(batch):
+    timestamps, _ = parse_timestamp_column(batch.column("TimeStamp"))
+    exp_codes, exp_names = _factorize([exp_name or "" for exp_name in batch.column(EXP_NAME_COLUMN)])
+    days = timestamps.astype("datetime64[D]")
+    day_codes, day_values = _factorize(days.tolist())
+    groups, group_codes = np.unique(exp_codes * len(day_values) + day_codes, return_inverse=True)
+    counts = np.bincount(group_codes, minlength=len(groups))
+    newest = _group_max(group_codes, len(groups), timestamps)
+
+    sensors = [set() for _ in groups]
+    sensor_codes, sensor_names = _factorize(batch.column("SensorData_Name"))
+    for group, sensor in np.unique(np.stack([group_codes, sensor_codes], axis=1), axis=0).tolist():
+        if sensor_names[sensor] is not None:
+            sensors[group].add(sensor_names[sensor])
+
+    rollup = {}
+    for index, group in enumerate(groups.tolist()):
+        day = day_values[group % len(day_values)]
+        rollup[(exp_names[group // len(day_values)], "" if day is None else day.isoformat())] = {
+            "num_entries": int(counts[index]),
+            "sensors": sensors[index],
+            "last_timestamp": None if np.isnat(newest[index]) else
+            newest[index].item().strftime(daily_stats.TIMESTAMP_FORMAT),
+        }
+    return rollup
+
+
+# Adds the inserted rows to the daily statistics rollup read by the fetch_google notebook.
+# Only the rows that landed are counted. When some rows will be retried, they are counted only if
+# the ingestion ledger keeps the retried event from sending the landed rows again; otherwise
+# the retry inserts them again with the same insertId, and they are counted then. The delta of
+# rows read from a file is keyed by the file and their offsets, so a retry that inserts the same
+# rows again does not count them twice.
+def update_daily_stats(dataset_id, table_id, batch, result):
+    if not daily_stats.enabled():
+        return
+    if result["rows_failed"]:
+        if "failed_rows" not in result or \
+                (rows_to_retry(result, len(batch)) and (batch.source is None or not ingest_ledger.enabled())):
+            return
+        landed = np.ones(len(batch), dtype=bool)
+        landed[result["failed_rows"]] = False
+        batch = batch.take(landed)
+        if not len(batch):
+            return
+    delta_id = None
+    if batch.source is not None:
+        delta_id = hashlib.sha1(f"{batch.source}:".encode("utf-8") + batch.offsets.tobytes()).hexdigest()[:16]
+    with metrics.timed_call("daily_stats.record"):
+        recorded = daily_stats.record_daily_stats(dataset_id, table_id, daily_rollup(batch), delta_id)
+    if not recorded:
+        metrics.count("daily_stats_update_failed")
+        log_error(f"Daily statistics of {dataset_id}/{table_id} not updated, other writers kept changing them. "
+                  f"Run `python daily_stats.py check --project PROJECT --owner {dataset_id} --repair`.",
+                  owner=dataset_id, mac_address=table_id, rows=len(batch), source=batch.source)
+
+
+# Updates the schema if needed and inserts the rows of one table
+def insert_table(client, dataset_id, table_id, batch, ingest_backend=None):
+    # Create the full table reference
+    table_ref = f"{client.project}.{dataset_id}.{table_id}"
+    start_time = time.time()
+
+    # Add InsertDate field with the current timestamp, formatted once for the rows of the table
+    # as a string suitable for BigQuery (removing the timezone offset, millisecond precision)
+    batch.set_constant("InsertDate", datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
+
+    try:
+        # 20241218 - update chema if neede before insering rows
+        with metrics.stage("update_table_schema"):
+            update_table_schema_if_needed(table_ref, batch, client)
+
+        # Insert rows into BigQuery table with the configured ingestion backend
+        with metrics.stage("ingest_backend"):
+            result = get_ingest_backend(ingest_backend)(client, table_ref, batch)
+    except Exception as e:
+        if isinstance(e, NotFound):
+            # The table was removed since it was cached, so drop it from the routing index
+            invalidate_routing_index(dataset_id, table_id)
+        invalidate_schema_cache(table_ref)
+        result = {"rows_ok": 0, "rows_failed": len(batch), "retries": 0, "errors": [repr(e)]}
+
+    result["latency"] = time.time() - start_time
+    metrics.count("rows_ok", result["rows_ok"])
+    metrics.count("rows_failed", result["rows_failed"])
+    metrics.count("insert_retries", result["retries"])
+    # Keep the last-timestamp index read by query_last_timestamp up to date
+    try:
+        update_last_timestamp_index(dataset_id, table_id, batch, result)
+    except Exception as e:
+        print(f"Could not update the last-timestamp index of {table_ref}: {e}")
+
+    try:
+        update_daily_stats(dataset_id, table_id, batch, result)
+    except Exception as e:
+        print(f"Could not update the daily statistics of {table_ref}: {e}")
+
+    invalid_rows = result.get("invalid_rows", [])
+    if invalid_rows:
+        # Rejected again by every retry: the rows are reported and left out of the table, the
+        # archived records keep them
+        metrics.count("rows_invalid", len(invalid_rows))
+        unique_ids = batch.column("UniqueID")
+        log_error(f"{len(invalid_rows)} rows rejected as invalid by {table_ref}, not retried.",
+                  table=table_ref, source=batch.source, offsets=batch.offsets[invalid_rows[:10]].tolist(),
+                  unique_ids=[unique_ids[index] for index in invalid_rows[:10]], errors=result["errors"][:3])
+
+    if result["rows_failed"]:
+        # The cached schema may be out of date (e.g. "no such field"), refresh it on the next batch
+        invalidate_schema_cache(table_ref)
+        print(f"Errors occurred while inserting into {table_ref}: {result['errors']}")
+    else:
+        print(f"Successfully inserted {result['rows_ok']} rows into {table_ref}")
+
+    return table_ref, result
+
+
+# Inserts the mapped rows into their tables, one table per worker.
+# Returns {table_ref: {"rows_ok", "rows_failed", "retries", "latency", "errors"}}.
+def batch_insert_to_bq(table_map, ingest_backend=None):
+    # Initialize the BigQuery client
+    client = get_bigquery_client()
+
+    with ThreadPoolExecutor(max_workers=INSERT_MAX_WORKERS) as executor:
+        futures = []
+        # Iterate over the table_map
+        for key, table_batch in table_map.items():
+            if len(table_batch):
+                # Split the key to get dataset_id and table_id
+                dataset_id, table_id = key.split(";")
+                futures.append(executor.submit(insert_table, client, dataset_id, table_id, table_batch, ingest_backend))
+
+        return dict(future.result() for future in futures)
 
 
 # Helper function to flatten JSON objects (handle nested structures)
@@ -345,6 +1206,69 @@ def flatten_json(json_obj, parent_key='', sep='_'):
 
     return flattened
 
+# Compiled key plans used by flatten_record: (parent_key, tuple of keys) -> [(flattened key, is TimeStamp key)]
+_flatten_plans = {}
+
+# Fixed format of the TimeStamp strings sent by the devices, e.g. 2025-01-20T13:19:00.000Z
+_TIMESTAMP_PATTERN = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})\.([0-9]{1,6})Z")
+
+
+# Same conversion as flatten_json's strptime call, without going through strptime for the usual format
+def parse_timestamp(value):
+    try:
+        match = _TIMESTAMP_PATTERN.fullmatch(value)
+        if match:
+            year, month, day, hour, minute, second, fraction = match.groups()
+            return datetime(
+                int(year), int(month), int(day), int(hour), int(minute), int(second), int(fraction.ljust(6, "0"))
+            ).isoformat()
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').isoformat()
+    except ValueError:
+        # If parsing fails, keep the original value
+        return value
+
+
+# Sanitizes the keys of one level of a record once, so records with the same shape reuse them
+def _compile_flatten_plan(parent_key, keys):
+    plan = []
+    for key in keys:
+        sanitized_key = key.replace('$', '_').replace('.', '_')
+        new_key = f"{parent_key}_{sanitized_key}" if parent_key else sanitized_key
+        plan.append((new_key, 'TimeStamp' in key))
+    return plan
+
+
+# Fast version of flatten_json for the insert path, producing the same output.
+# Key plans are memoized per record shape; novel shapes beyond the cache size use flatten_json.
+def flatten_record(json_obj, parent_key='', flattened=None):
+    if flattened is None:
+        flattened = {}
+
+    signature = (parent_key, tuple(json_obj))
+    plan = _flatten_plans.get(signature)
+    if plan is None:
+        if len(_flatten_plans) >= FLATTEN_PLAN_CACHE_SIZE:
+            flattened.update(flatten_json(json_obj, parent_key))
+            return flattened
+        plan = _flatten_plans[signature] = _compile_flatten_plan(parent_key, signature[1])
+
+    for (new_key, is_timestamp), value in zip(plan, json_obj.values()):
+        if isinstance(value, dict):
+            flatten_record(value, new_key, flattened)
+        elif is_timestamp and isinstance(value, str):
+            flattened[new_key] = parse_timestamp(value)
+        else:
+            flattened[new_key] = value
+
+    return flattened
+
+
+# Flattens the records once into the columnar batch the pipeline stages work on. source and
+# offset locate the records in their uploaded file.
+def build_record_batch(json_list, source=None, offset=0):
+    return RecordBatch.from_rows([flatten_record(json_obj) for json_obj in json_list], source, offset)
+
+
 def convert_ndarray_to_list(data):
     """
     Recursively converts all NumPy ndarray elements in the payload to lists.
@@ -396,34 +1320,116 @@ def update_labels_cf(payload):
         print("An error occurred:", e)
 
 
-def process_data(json_list):
+# Indexes of the rows of a table insert a retry has to send again: the failed rows except those
+# rejected as invalid, or every row when the backend does not report which rows failed
+def rows_to_retry(result, num_rows):
+    if not result["rows_failed"]:
+        return []
+    if "failed_rows" not in result:
+        return list(range(num_rows))
+    invalid_rows = set(result.get("invalid_rows", []))
+    return [index for index in result["failed_rows"] if index not in invalid_rows]
+
+
+# Runs one pipeline stage and records its wall time in stats["stages"] and in the invocation metrics
+def run_stage(stats, name, func, *args):
+    stage_start = time.time()
+    try:
+        return func(*args)
+    finally:
+        stats["stages"][name] = time.time() - stage_start
+        metrics.add_stage_time(name, stats["stages"][name])
+
+
+# Runs the pipeline on a list of JSONs. The archival branch (step 2) and the BigQuery branch
+# (steps 3-5) are independent, so they run concurrently. Records of the tables ("owner;mac_address")
+# in committed_tables, and records at the file offsets in committed_offsets, are archived again
+# (uploads overwrite) but not inserted. source and offset locate the records in their uploaded
+# file. Returns the per-stage timings, the errors of each branch, whether both branches
+# succeeded, the number of skipped records, the tables done with (all their rows committed to
+# BigQuery or rejected as invalid) and the offsets of the rows done with in the other tables.
+def process_data(json_list, committed_tables=None, source=None, offset=0, committed_offsets=None):
     start_time = time.time()
-    # Step 1: extract_paths (process_json_data)
-    _id_set, mac_address_set, exp_name_set = extract_paths(json_list)
-    print("Completed path extraction (step 1)")
+    stats = {"stages": {}, "errors": {}, "ok": False, "skipped": 0, "committed_tables": [], "committed_offsets": []}
 
-    # Step 2: send_lists_to_gcs
-    size_of_list = 50
-    send_lists_to_gcs(json_list, size_of_list)
-    print("JSON list split and sent to multiple cloud functions (step 2)") 
+    # The records are flattened once into a columnar batch, read by step 1 and steps 3-5
+    batch = run_stage(stats, "build_record_batch", build_record_batch, json_list, source, offset)
 
-    # Step 3: create_bq_datasets_and_tables
-    # Use the first JSON object as a sample for creating the schema
-    create_bq_datasets_and_tables(_id_set, mac_address_set, json_list[0])
-    print("Completed dataset and table creation (step 3)")
+    ingest_batch = batch
+    if committed_tables or committed_offsets:
+        committed_tables = committed_tables or set()
+        committed_offsets = committed_offsets or set()
+        ingest_batch = batch.take([
+            f"{owner};{mac_address}" not in committed_tables and row_offset not in committed_offsets
+            for owner, mac_address, row_offset in
+            zip(batch.column(OWNER_COLUMN), batch.column(MAC_ADDRESS_COLUMN), batch.offsets.tolist())])
+        stats["skipped"] = len(batch) - len(ingest_batch)
 
-    # Step 4: map_tables_to_lists
-    table_map = map_tables_to_lists(json_list)
-    print("Completed JSON list mapping (step 4)")
+    # Step 1: extract_paths (process_json_data)
+    _id_set, mac_address_set, exp_name_set, table_pairs = run_stage(stats, "extract_paths", extract_paths, batch)
+    print("Completed path extraction (step 1)")
 
-    # Step 5: batch_insert_to_bq
-    batch_insert_to_bq(table_map)
-    print("Completed BigQuery batch inserts (step 5)")
+    # Step 2: send_lists_to_gcs
+    def archive_branch():
+        failed_chunks = run_stage(stats, "send_lists_to_gcs", send_lists_to_gcs, json_list)
+        print(f"JSON list split and sent to multiple cloud functions, {len(failed_chunks)} lists failed (step 2)")
+        if failed_chunks:
+            raise RuntimeError(f"{len(failed_chunks)} lists could not be sent to upload_To_bucket")
+
+    # Steps 3-5: create tables, map the rows to them and insert
+    def ingest_branch():
+        if not len(ingest_batch):
+            print(f"All {len(json_list)} records already committed, skipping steps 3-5")
+            return
+
+        # Step 3: create_bq_datasets_and_tables
+        # New tables get the schema inferred from the whole batch
+        run_stage(stats, "create_bq_datasets_and_tables", create_bq_datasets_and_tables,
+                  table_pairs, ingest_batch)
+        print("Completed dataset and table creation (step 3)")
+
+        # Step 4: map_tables_to_lists
+        table_map = run_stage(stats, "map_tables_to_lists", map_tables_to_lists, ingest_batch)
+        print("Completed JSON list mapping (step 4)")
+
+        # Step 5: batch_insert_to_bq
+        insert_results = run_stage(stats, "batch_insert_to_bq", batch_insert_to_bq, table_map)
+        print("Completed BigQuery batch inserts (step 5)")
+        failed_tables = []
+        for table_ref, result in insert_results.items():
+            key = ";".join(table_ref.split(".")[1:])
+            retry_rows = rows_to_retry(result, len(table_map[key]))
+            if not retry_rows:
+                stats["committed_tables"].append(key)
+                continue
+            failed_tables.append(table_ref)
+            # The other rows of the table landed or were rejected as invalid, so a retry skips them
+            done = np.ones(len(table_map[key]), dtype=bool)
+            done[retry_rows] = False
+            stats["committed_offsets"].extend(table_map[key].offsets[done].tolist())
+        if failed_tables:
+            raise RuntimeError(f"Inserts failed for tables: {failed_tables}")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        branches = {
+            "archive": executor.submit(archive_branch),
+            "ingest": executor.submit(ingest_branch),
+        }
+        for branch, future in branches.items():
+            try:
+                future.result()
+            except Exception as e:
+                stats["errors"][branch] = str(e)
+                print(f"Error in {branch} branch: {e}")
 
     #Step 6: sends the first JSON to udpate labels CF
     #update_labels_cf(json_list[0])
     #print("Completed Sending to update labels CF (step 6)")
-    
+
+    stats["ok"] = not stats["errors"]
     end_time = time.time()
     execution_time = end_time - start_time
+    stats["stages"]["total"] = execution_time
+    print(f"Stage timings: {json.dumps(stats['stages'])}")
     print(f"Execution time: {execution_time} seconds")
+    return stats
@@ -0,0 +1,209 @@
+# Per-invocation metrics: stage wall times, API call counts and latencies, and counters
+# (records, bytes, rows failed...). Each invocation ends with one structured JSON log line,
+# which Cloud Logging parses into jsonPayload, and is optionally aggregated into METRICS_FILE.
+# This file is shared by all functions and must be kept identical in process_files/,
+# upload_To_bucket/, update-labels/ and query_last_timestamp/.
+#
+# Usage: decorate the entry point with @instrumented("name"), then inside it
+#   with stage("flatten"): ...          adds the block wall time to a stage
+#   with timed_call("bigquery.query"):  counts an API call and its latency, and failures
+#   count("records", len(rows))         adds to a counter
+#
+# Stage times are summed over the threads that run them, so they can exceed the total.
+# The metrics of an invocation are module-level state: with several concurrent requests per
+# instance (2nd gen functions with concurrency > 1) they are mixed together.
+#
+# Profiling: with METRICS_PROFILE=1, or ?profile=1 / {"profile": true} on an HTTP request, the
+# invocation runs under cProfile. The stats are written to METRICS_PROFILE_DIR and the top
+# functions logged. cProfile only sees the thread of the entry point, not the worker pools.
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_PROFILE = os.environ.get("METRICS_PROFILE", "0") == "1"
+METRICS_PROFILE_DIR = os.environ.get("METRICS_PROFILE_DIR", "/tmp/profiles")
+METRICS_PROFILE_TOP = int(os.environ.get("METRICS_PROFILE_TOP", 25))
+
+_lock = threading.Lock()
+
+# Metrics of the running invocation, None outside of an instrumented entry point
+_current = None
+
+
+def _new_invocation(function_name):
+    return {"function": function_name, "start": time.time(), "stages": {}, "calls": {}, "counters": {}}
+
+
+def add_stage_time(name, seconds):
+    with _lock:
+        if _current is not None:
+            _current["stages"][name] = _current["stages"].get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - started)
+
+
+def record_call(api, seconds, ok=True):
+    with _lock:
+        if _current is None:
+            return
+        call = _current["calls"].setdefault(api, {"count": 0, "errors": 0, "latencies": []})
+        call["count"] += 1
+        call["errors"] += not ok
+        call["latencies"].append(seconds)
+
+
+@contextmanager
+def timed_call(api):
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_call(api, time.perf_counter() - started, ok)
+
+
+def count(name, value=1):
+    with _lock:
+        if _current is not None:
+            _current["counters"][name] = _current["counters"].get(name, 0) + value
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+# Turns the raw invocation metrics into the logged summary
+def _summarize(invocation):
+    calls = {}
+    for api, call in invocation["calls"].items():
+        latencies = sorted(call["latencies"])
+        calls[api] = {
+            "count": call["count"],
+            "errors": call["errors"],
+            "total_seconds": round(sum(latencies), 6),
+            "p50_seconds": round(_percentile(latencies, 0.5), 6),
+            "max_seconds": round(latencies[-1], 6),
+        }
+    return {
+        "function": invocation["function"],
+        "duration_seconds": round(time.time() - invocation["start"], 6),
+        "stages": {name: round(seconds, 6) for name, seconds in invocation["stages"].items()},
+        "calls": calls,
+        "counters": invocation["counters"],
+    }
+
+
+# Adds an invocation summary to the totals in METRICS_FILE, under an exclusive file lock
+def _aggregate(summary, path):
+    import fcntl
+
+    with open(path, "a+", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        contents = f.read()
+        totals = json.loads(contents) if contents.strip() else {}
+        function = totals.setdefault(summary["function"], {
+            "invocations": 0, "errors": 0, "duration_seconds": 0.0, "stages": {}, "calls": {}, "counters": {}})
+        function["invocations"] += 1
+        function["errors"] += "error" in summary
+        function["duration_seconds"] += summary["duration_seconds"]
+        for name, seconds in summary["stages"].items():
+            function["stages"][name] = function["stages"].get(name, 0.0) + seconds
+        for api, call in summary["calls"].items():
+            total = function["calls"].setdefault(api, {"count": 0, "errors": 0, "total_seconds": 0.0})
+            total["count"] += call["count"]
+            total["errors"] += call["errors"]
+            total["total_seconds"] += call["total_seconds"]
+        for name, value in summary["counters"].items():
+            function["counters"][name] = function["counters"].get(name, 0) + value
+        f.seek(0)
+        f.truncate()
+        json.dump(totals, f, indent=2)
+
+
+def _profile_requested(args):
+    if METRICS_PROFILE:
+        return True
+    request = args[0] if args else None
+    if hasattr(request, "args") and request.args.get("profile") in ("1", "true"):
+        return True
+    if hasattr(request, "get_json"):
+        body = request.get_json(silent=True)
+        return isinstance(body, dict) and body.get("profile") is True
+    return False
+
+
+def _write_profile(profiler, function_name):
+    os.makedirs(METRICS_PROFILE_DIR, exist_ok=True)
+    path = os.path.join(METRICS_PROFILE_DIR, f"{function_name}-{int(time.time() * 1000)}.prof")
+    profiler.dump_stats(path)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(METRICS_PROFILE_TOP)
+    print(f"Profile of {function_name} written to {path}\n{output.getvalue()}")
+
+
+# Returns the HTTP status of a handler return value, if it has one
+def _status_code(returned):
+    if isinstance(returned, tuple) and len(returned) > 1 and isinstance(returned[1], int):
+        return returned[1]
+    return getattr(returned, "status_code", None)
+
+
+# Decorator for function entry points: collects the metrics of each invocation and logs them
+def instrumented(function_name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _current
+            invocation = _new_invocation(function_name)
+            with _lock:
+                _current = invocation
+            profiler = cProfile.Profile() if _profile_requested(args) else None
+            error = None
+            returned = None
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                returned = func(*args, **kwargs)
+                return returned
+            except Exception as e:
+                error = repr(e)
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                with _lock:
+                    if _current is invocation:
+                        _current = None
+                summary = _summarize(invocation)
+                status_code = _status_code(returned)
+                if status_code is not None:
+                    summary["status_code"] = status_code
+                if error is not None:
+                    summary["error"] = error
+                print(json.dumps({"severity": "ERROR" if error else "INFO",
+                                  "message": f"{function_name} metrics", "metrics": summary}))
+                if METRICS_FILE:
+                    try:
+                        _aggregate(summary, METRICS_FILE)
+                    except Exception as e:
+                        print(f"Could not update {METRICS_FILE}: {e}")
+                if profiler is not None:
+                    _write_profile(profiler, function_name)
+        return wrapper
+    return decorator
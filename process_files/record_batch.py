@@ -0,0 +1,219 @@
+# Columnar form of a batch of flattened records, built once per batch by process_data and
+# shared by its stages: routing, schema inference, the rows and Arrow tables of the ingestion
+# backends and the index updates read columns instead of walking the records again.
+#
+# Every column is a NumPy array: float64 for numeric columns (None as NaN, ints marked so they
+# come back as ints), object otherwise. Owner, MAC address and experiment name columns are
+# never numeric, their values are interned strings.
+# Columns only some records have keep a mask of the rows that have the key, so rows are
+# rebuilt with the keys of their record.
+# Each row also keeps its offset, the position of its record in the uploaded file the batch was
+# read from (source), which the streaming inserts derive insertIds from.
+import json
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+OWNER_COLUMN = "Owner"
+MAC_ADDRESS_COLUMN = "ExperimentData_MAC_address"
+EXP_NAME_COLUMN = "ExperimentData_Exp_name"
+KEY_COLUMNS = (OWNER_COLUMN, MAC_ADDRESS_COLUMN, EXP_NAME_COLUMN)
+
+_NUMERIC_KINDS = {int, float, type(None)}
+# Integers beyond this are not exact as float64 and stay in an object column
+_MAX_EXACT_INTEGER = 2 ** 53
+# Upper bound of the JSON size of a float64 value, e.g. -1.2345678901234567e-300
+_MAX_FLOAT_JSON_BYTES = 24
+
+# values: the array; nulls, present, integers: masks of the null values, of the rows that
+# have the key and of the int values, None when no row needs them
+Column = namedtuple("Column", ["values", "nulls", "present", "integers"])
+
+
+def _object_array(values):
+    # fromiter keeps lists as elements instead of turning them into a second dimension
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+# Converts the values of one column to a Column
+def _make_column(values, present=None, numeric=True):
+    kinds = set(map(type, values))
+    if numeric and kinds <= _NUMERIC_KINDS and kinds - {type(None)}:
+        nulls = integers = None
+        numbers = values
+        if type(None) in kinds:
+            nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+            numbers = [np.nan if value is None else value for value in values]
+        if int in kinds:
+            integers = np.fromiter((type(value) is int for value in values), dtype=bool, count=len(values))
+        array = np.array(numbers, dtype=np.float64)
+        if integers is None or not np.any(np.abs(array[integers]) > _MAX_EXACT_INTEGER):
+            return Column(array, nulls, present, integers)
+    return Column(_object_array(values), None, present, None)
+
+
+class RecordBatch:
+    def __init__(self, columns, num_rows, offsets=None, source=None):
+        # name -> Column, in the order the keys first appear in the records
+        self.columns = columns
+        self.num_rows = num_rows
+        self.offsets = np.arange(num_rows, dtype=np.int64) if offsets is None else offsets
+        self.source = source
+        self._group_index = None
+
+    # Builds the batch from flattened rows (dicts of column name to value). Rows with the same
+    # keys are transposed together, so a batch of records of one shape is a single zip.
+    # The rows are the records of source starting at offset.
+    @classmethod
+    def from_rows(cls, rows, source=None, offset=0):
+        num_rows = len(rows)
+        shapes = {}
+        for index, row in enumerate(rows):
+            shapes.setdefault(tuple(row), []).append(index)
+
+        if len(shapes) == 1:
+            names = next(iter(shapes))
+            values_by_name = dict(zip(names, map(list, zip(*(row.values() for row in rows)))))
+            presence = {}
+        else:
+            values_by_name = {}
+            presence = {}
+            for names, indices in shapes.items():
+                for name, values in zip(names, zip(*(rows[index].values() for index in indices))):
+                    column_values = values_by_name.get(name)
+                    if column_values is None:
+                        column_values = values_by_name[name] = [None] * num_rows
+                        presence[name] = np.zeros(num_rows, dtype=bool)
+                    for index, value in zip(indices, values):
+                        column_values[index] = value
+                    presence[name][indices] = True
+
+        for name in KEY_COLUMNS:
+            if name in values_by_name:
+                values_by_name[name] = [sys.intern(value) if type(value) is str else value
+                                        for value in values_by_name[name]]
+
+        columns = {}
+        for name, values in values_by_name.items():
+            present = presence.get(name)
+            columns[name] = _make_column(values, None if present is None or present.all() else present,
+                                         numeric=name not in KEY_COLUMNS)
+        return cls(columns, num_rows, np.arange(offset, offset + num_rows, dtype=np.int64), source)
+
+    @property
+    def column_names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return self.num_rows
+
+    def is_numeric(self, name):
+        return self.columns[name].values.dtype == np.float64
+
+    # Values of a column as a list, None where the value is null or the key is absent
+    def column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            return [None] * self.num_rows
+        values = column.values.tolist()
+        if column.integers is not None:
+            for index in np.flatnonzero(column.integers):
+                values[index] = int(values[index])
+        if column.nulls is not None:
+            for index in np.flatnonzero(column.nulls):
+                values[index] = None
+        if column.present is not None:
+            for index in np.flatnonzero(~column.present):
+                values[index] = None
+        return values
+
+    # Mask of the rows where a column is null or absent, None when it has a value on every row
+    def null_mask(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            return np.ones(self.num_rows, dtype=bool)
+        masks = [mask for mask in (column.nulls, None if column.present is None else ~column.present)
+                 if mask is not None]
+        if not masks:
+            return None
+        return masks[0] | masks[1] if len(masks) == 2 else masks[0]
+
+    # Types of the non-null values of a column
+    def value_kinds(self, name):
+        column = self.columns[name]
+        if column.values.dtype == np.float64:
+            has_values = column.nulls is None or not column.nulls.all()
+            if not has_values:
+                return set()
+            return {float, int} if column.integers is not None and column.integers.any() else {float}
+        return set(map(type, column.values)) - {type(None)}
+
+    # Rows at the given positions (array of indices or boolean mask); columns none of
+    # them has are dropped
+    def take(self, indices):
+        indices = np.asarray(indices)
+        indices = np.flatnonzero(indices) if indices.dtype == bool else indices.astype(np.intp)
+        columns = {}
+        for name, column in self.columns.items():
+            present = column.present[indices] if column.present is not None else None
+            if present is not None and not present.any():
+                continue
+            columns[name] = Column(
+                column.values[indices],
+                column.nulls[indices] if column.nulls is not None else None,
+                None if present is None or present.all() else present,
+                column.integers[indices] if column.integers is not None else None,
+            )
+        return RecordBatch(columns, len(indices), self.offsets[indices], self.source)
+
+    def slice(self, start, end):
+        return self.take(np.arange(start, min(end, self.num_rows)))
+
+    # Sets a column to the same value on every row
+    def set_constant(self, name, value):
+        self.columns[name] = _make_column([value] * self.num_rows)
+
+    # {(owner, mac_address): array of row indices} of the rows that have both keys
+    def group_index(self):
+        if self._group_index is None:
+            groups = {}
+            for index, key in enumerate(zip(self.column(OWNER_COLUMN), self.column(MAC_ADDRESS_COLUMN))):
+                if key[0] and key[1]:
+                    groups.setdefault(key, []).append(index)
+            self._group_index = {key: np.array(indices, dtype=np.intp) for key, indices in groups.items()}
+        return self._group_index
+
+    # The rows as dicts, with the keys of each record
+    def to_rows(self):
+        names = list(self.columns)
+        rows = [dict(zip(names, values)) for values in zip(*(self.column(name) for name in names))]
+        if not names:
+            rows = [{} for _ in range(self.num_rows)]
+        for name, column in self.columns.items():
+            if column.present is not None:
+                for index in np.flatnonzero(~column.present):
+                    del rows[index][name]
+        return rows
+
+    # Upper bound of the JSON size of each row, computed per column: float64 values count
+    # as their longest form, strings as their length when they need no escaping
+    def row_sizes(self):
+        sizes = np.full(self.num_rows, 2, dtype=np.int64)
+        for name, column in self.columns.items():
+            key_bytes = len(json.dumps(name)) + 2
+            if column.values.dtype == np.float64:
+                value_bytes = np.full(self.num_rows, _MAX_FLOAT_JSON_BYTES, dtype=np.int64)
+                if column.nulls is not None:
+                    value_bytes[column.nulls] = 4
+            else:
+                value_bytes = np.fromiter(
+                    (len(value) + 2 if type(value) is str and value.isascii() and value.isprintable()
+                     and '"' not in value and "\\" not in value else len(json.dumps(value))
+                     for value in column.values),
+                    dtype=np.int64, count=self.num_rows)
+            if column.present is not None:
+                sizes += np.where(column.present, key_bytes + value_bytes, 0)
+            else:
+                sizes += key_bytes + value_bytes
+        return sizes
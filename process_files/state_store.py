@@ -0,0 +1,179 @@
+# Keyed JSON documents shared by the instances of the functions, used by the last-timestamp
+# index, the ingestion ledger and the daily statistics rollup. A document is read and written as
+# a whole; updates are read-modify-write with a generation precondition, so concurrent writers
+# never lose an update. This file is shared by the functions and must be kept identical in
+# process_files/, query_last_timestamp/ and fetch_google/.
+#
+# Backends:
+#   "gcs"    - one JSON object per key, <bucket>/<store name>/<key>.json, shared by all instances
+#   "memory" - in-process LRU, for tests and offline runs; other instances do not see it
+#   "none"   - disabled: nothing is stored and every read finds nothing
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Bucket of the stores that are not given a bucket of their own
+STATE_BUCKET = os.environ.get("STATE_BUCKET")
+
+BACKENDS = ("gcs", "memory", "none")
+
+# Attempts of an update while other instances keep changing the same document
+UPDATE_ATTEMPTS = 5
+
+_storage_lock = threading.Lock()
+
+# Storage client of the gcs backend: built by the factory set by the function, or created on
+# first use and reused by warm invocations
+_storage_client_factory = None
+_storage_client = None
+
+
+# Sets the function returning the storage client of the gcs backend, e.g. the cached client of
+# the function or a client built with service account credentials
+def set_storage_client_factory(factory):
+    global _storage_client_factory
+    _storage_client_factory = factory
+
+
+def _get_storage_client():
+    global _storage_client
+    if _storage_client_factory is not None:
+        return _storage_client_factory()
+    with _storage_lock:
+        if _storage_client is None:
+            from google.cloud import storage
+
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+# The configured backend, else "gcs" when there is a bucket and "none" otherwise: the shared
+# stores are never kept by a single instance unless asked to
+def default_backend(configured, bucket):
+    return configured or ("gcs" if bucket else "none")
+
+
+class StateStore:
+    def __init__(self, name, backend, bucket=None, max_keys=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown {name} backend {backend}, expected one of {list(BACKENDS)}")
+        if backend == "gcs" and not bucket:
+            raise ValueError(f"The gcs backend of {name} needs a bucket (or STATE_BUCKET)")
+        self.name = name
+        self.backend = backend
+        self.bucket = bucket
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # memory backend: key -> (generation, JSON text), least recently used first
+        self._memory = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.backend != "none"
+
+    def _blob(self, key):
+        return _get_storage_client().bucket(self.bucket).blob(f"{self.name}/{key}.json")
+
+    # Returns (document, generation), or (None, 0) when there is no document for the key
+    def read(self, key):
+        if self.backend == "none":
+            return None, 0
+        if self.backend == "memory":
+            with self._lock:
+                entry = self._memory.get(key)
+                if entry is None:
+                    return None, 0
+                self._memory.move_to_end(key)
+            return json.loads(entry[1]), entry[0]
+
+        from google.cloud.exceptions import NotFound
+
+        blob = self._blob(key)
+        try:
+            contents = blob.download_as_bytes()
+        except NotFound:
+            return None, 0
+        return json.loads(contents), blob.generation
+
+    def get(self, key):
+        return self.read(key)[0]
+
+    # Returns {key: document} for the keys that have one, read concurrently from gcs
+    def get_many(self, keys):
+        keys = list(keys)
+        if self.backend == "gcs" and len(keys) > 1:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                documents = list(executor.map(self.get, keys))
+        else:
+            documents = [self.get(key) for key in keys]
+        return {key: document for key, document in zip(keys, documents) if document is not None}
+
+    # Writes the document when the stored one still has the given generation (0: no document),
+    # raises PreconditionFailed otherwise; generation None writes unconditionally
+    def write(self, key, document, generation=None):
+        if self.backend == "none":
+            return
+        if self.backend == "gcs":
+            self._blob(key).upload_from_string(
+                json.dumps(document), content_type="application/json", if_generation_match=generation)
+            return
+
+        from google.api_core.exceptions import PreconditionFailed
+
+        with self._lock:
+            current = self._memory.get(key, (0, None))[0]
+            if generation is not None and current != generation:
+                raise PreconditionFailed(f"{self.name}/{key} changed since it was read")
+            self._memory[key] = (current + 1, json.dumps(document))
+            self._memory.move_to_end(key)
+            while self.max_keys and len(self._memory) > self.max_keys:
+                self._memory.popitem(last=False)
+
+    # Replaces the document of the key with change(document), document being None when there
+    # is none yet; change returns None to leave it as it is. Returns False when the document
+    # kept changing under the update for UPDATE_ATTEMPTS attempts.
+    def update(self, key, change):
+        from google.api_core.exceptions import PreconditionFailed
+
+        if self.backend == "none":
+            return True
+        for attempt in range(UPDATE_ATTEMPTS):
+            document, generation = self.read(key)
+            document = change(document)
+            if document is None:
+                return True
+            try:
+                self.write(key, document, generation)
+                return True
+            except PreconditionFailed:
+                continue
+        return False
+
+    def delete(self, key):
+        if self.backend == "memory":
+            with self._lock:
+                self._memory.pop(key, None)
+        elif self.backend == "gcs":
+            from google.cloud.exceptions import NotFound
+
+            try:
+                self._blob(key).delete()
+            except NotFound:
+                pass
+
+    # Keys starting with prefix, sorted
+    def keys(self, prefix=""):
+        if self.backend == "memory":
+            with self._lock:
+                return sorted(key for key in self._memory if key.startswith(prefix))
+        if self.backend == "none":
+            return []
+        object_prefix = f"{self.name}/"
+        blobs = _get_storage_client().list_blobs(self.bucket, prefix=object_prefix + prefix)
+        return sorted(blob.name[len(object_prefix):-len(".json")] for blob in blobs if blob.name.endswith(".json"))
+
+    def delete_prefix(self, prefix):
+        for key in self.keys(prefix):
+            self.delete(key)
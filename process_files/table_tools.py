@@ -0,0 +1,196 @@
+"""
+Maintenance tools for the sensor tables created by process_files.
+
+    python table_tools.py migrate [--dataset DATASET] [--destination-dataset DATASET] [--dry-run]
+        Converts existing tables to the partitioned and clustered layout of new tables
+        (TABLE_PARTITION_FIELD / TABLE_CLUSTERING_FIELDS in main.py). By default tables are
+        replaced in place with CREATE OR REPLACE ... AS SELECT *; with --destination-dataset a
+        migrated copy is written there instead, e.g. to compare costs with `estimate` first.
+        Exits with status 1 when tables were refused.
+
+    python table_tools.py estimate --before DATASET.TABLE --after DATASET.TABLE
+        Dry-runs the queries the repo runs against sensor tables on both tables and reports
+        the bytes each one would scan. The incremental script of update-labels is not
+        included: it filters on InsertDate, which neither layout prunes, so it scans the
+        same columns of both tables.
+
+Replacing a table while devices stream into it would drop the rows streamed during the
+replacement, and rows still in the streaming buffer cannot be copied reliably. `migrate` refuses
+to replace a table with a streaming buffer: pause uploads and run it again once the buffer has
+been flushed (up to 90 minutes after the last insert). Copies to --destination-dataset are not
+refused, the source table is left as it is.
+"""
+import argparse
+
+from google.cloud import bigquery
+
+from main import TABLE_CLUSTERING_FIELDS, TABLE_PARTITION_FIELD
+
+# Queries run against sensor tables, as SELECTs so they can be dry-run:
+# (name, query with a {table} placeholder, query parameters)
+REPO_QUERIES = [
+    (
+        "query_last_timestamp (whole table)",
+        """
+        SELECT ExperimentData_Exp_name, MAX(TimeStamp) AS last_timestamp
+        FROM `{table}`
+        WHERE ExperimentData_Exp_name IN UNNEST(@experiment_names)
+        GROUP BY ExperimentData_Exp_name
+        """,
+        [bigquery.ArrayQueryParameter("experiment_names", "STRING", ["example_exp"])],
+    ),
+    (
+        "query_last_timestamp (last 7 days)",
+        """
+        SELECT ExperimentData_Exp_name, MAX(TimeStamp) AS last_timestamp
+        FROM `{table}`
+        WHERE ExperimentData_Exp_name IN UNNEST(@experiment_names)
+          AND TimeStamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY)
+        GROUP BY ExperimentData_Exp_name
+        """,
+        [bigquery.ArrayQueryParameter("experiment_names", "STRING", ["example_exp"])],
+    ),
+    (
+        "update-labels full rewrite",
+        """
+        WITH LatestSensorData AS (
+          SELECT MetaData_LLA, ExperimentData_Exp_name, SensorData_Labels, SensorData_LabelOptions,
+            ROW_NUMBER() OVER (PARTITION BY MetaData_LLA, ExperimentData_Exp_name ORDER BY InsertDate DESC) AS rn
+          FROM `{table}`
+        )
+        SELECT t.* REPLACE(lsd.SensorData_Labels AS SensorData_Labels,
+                           lsd.SensorData_LabelOptions AS SensorData_LabelOptions)
+        FROM `{table}` AS t
+        LEFT JOIN LatestSensorData AS lsd
+        ON t.MetaData_LLA = lsd.MetaData_LLA AND t.ExperimentData_Exp_name = lsd.ExperimentData_Exp_name AND lsd.rn = 1
+        """,
+        [],
+    ),
+    (
+        "notebook query_combined_data",
+        """
+        SELECT ExperimentData_Exp_name, COUNT(DISTINCT SensorData_Name) AS sensor_count,
+          COUNT(*) AS num_entries, MAX(TimeStamp) AS last_timestamp
+        FROM `{table}`
+        GROUP BY ExperimentData_Exp_name
+        """,
+        [],
+    ),
+    (
+        "notebook query_daily_data",
+        """
+        SELECT DATE(TimeStamp) AS date, COUNT(*) AS num_entries
+        FROM `{table}`
+        GROUP BY date
+        """,
+        [],
+    ),
+]
+
+
+# Returns the PARTITION BY / CLUSTER BY clauses for a table schema, or None without a TimeStamp field
+def layout_clause(table):
+    field_types = {field.name: field.field_type for field in table.schema}
+    if field_types.get(TABLE_PARTITION_FIELD) != "TIMESTAMP":
+        return None
+    clause = f"PARTITION BY TIMESTAMP_TRUNC({TABLE_PARTITION_FIELD}, DAY)"
+    clustering_fields = [name for name in TABLE_CLUSTERING_FIELDS if name in field_types]
+    if clustering_fields:
+        clause += f" CLUSTER BY {', '.join(clustering_fields)}"
+    return clause
+
+
+def is_migrated(table):
+    partitioning = table.time_partitioning
+    return partitioning is not None and partitioning.field == TABLE_PARTITION_FIELD
+
+
+# Migrates one table; returns False when it was refused because rows are still being streamed into it
+def migrate_table(client, table, destination_dataset=None, dry_run=False):
+    source = f"{table.project}.{table.dataset_id}.{table.table_id}"
+    destination = f"{table.project}.{destination_dataset}.{table.table_id}" if destination_dataset else source
+
+    if destination == source and is_migrated(table):
+        print(f"{source}: already partitioned on {TABLE_PARTITION_FIELD}, skipped.")
+        return True
+    clause = layout_clause(table)
+    if clause is None:
+        print(f"{source}: no {TABLE_PARTITION_FIELD} TIMESTAMP field, skipped.")
+        return True
+    if destination == source and table.streaming_buffer is not None:
+        print(f"{source}: refused, about {table.streaming_buffer.estimated_rows} rows are in the streaming buffer "
+              f"(oldest from {table.streaming_buffer.oldest_entry_time}). Pause uploads and run again once it is flushed.")
+        return False
+
+    # Keep the table labels, e.g. the update-labels watermark
+    options = ""
+    if table.labels:
+        labels = ", ".join(f'("{key}", "{value}")' for key, value in table.labels.items())
+        options = f"OPTIONS (labels = [{labels}])"
+
+    ddl = f"CREATE OR REPLACE TABLE `{destination}` {clause} {options} AS SELECT * FROM `{source}`"
+    if dry_run:
+        print(ddl)
+        return True
+    client.query(ddl).result()
+    print(f"{source}: migrated to {destination}.")
+    return True
+
+
+# Migrates the tables of a dataset, or of every dataset; returns the tables refused
+def migrate(client, dataset=None, destination_dataset=None, dry_run=False):
+    datasets = [dataset] if dataset else [item.dataset_id for item in client.list_datasets()]
+    refused = []
+    for dataset_id in datasets:
+        if dataset_id == destination_dataset:
+            continue
+        for item in client.list_tables(dataset_id):
+            table = client.get_table(f"{dataset_id}.{item.table_id}")
+            if not migrate_table(client, table, destination_dataset, dry_run):
+                refused.append(f"{dataset_id}.{item.table_id}")
+    return refused
+
+
+# Dry-runs the repo queries on both tables and returns [(query name, bytes before, bytes after)]
+def estimate(client, before, after):
+    def dry_run_bytes(query, params, table):
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=params)
+        return client.query(query.format(table=table), job_config=job_config).total_bytes_processed
+
+    report = []
+    for name, query, params in REPO_QUERIES:
+        report.append((name, dry_run_bytes(query, params, before), dry_run_bytes(query, params, after)))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Partition and cluster existing tables")
+    migrate_parser.add_argument("--dataset", help="Only migrate the tables of this dataset")
+    migrate_parser.add_argument("--destination-dataset", help="Write migrated copies here instead of in place")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="Print the statements without running them")
+
+    estimate_parser = subparsers.add_parser("estimate", help="Compare bytes scanned by the repo queries")
+    estimate_parser.add_argument("--before", required=True, help="DATASET.TABLE with the old layout")
+    estimate_parser.add_argument("--after", required=True, help="DATASET.TABLE with the new layout")
+
+    args = parser.parse_args()
+    client = bigquery.Client()
+
+    if args.command == "migrate":
+        refused = migrate(client, args.dataset, args.destination_dataset, args.dry_run)
+        if refused:
+            print(f"{len(refused)} tables refused, still receiving streamed rows: {', '.join(refused)}")
+            raise SystemExit(1)
+    else:
+        before = f"{client.project}.{args.before}"
+        after = f"{client.project}.{args.after}"
+        print(f"{'query':<40} {'before (MB)':>14} {'after (MB)':>14}")
+        for name, bytes_before, bytes_after in estimate(client, before, after):
+            print(f"{name:<40} {bytes_before / 1024 ** 2:>14.2f} {bytes_after / 1024 ** 2:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
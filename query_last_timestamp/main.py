@@ -1,7 +1,89 @@
-from google.cloud import bigquery
 import json
+import os
+import last_timestamp_index
+import metrics
+import state_store
 
+# Tables are partitioned by day on TimeStamp: experiments are first looked up in the partitions of
+# the last LAST_TIMESTAMP_LOOKBACK_DAYS days, and only the ones not found there scan the whole table
+LAST_TIMESTAMP_LOOKBACK_DAYS = int(os.environ.get("LAST_TIMESTAMP_LOOKBACK_DAYS", 7))
 
+
+# google.cloud.bigquery is only imported when an experiment is missing from the index,
+# so requests answered from the index do not pay for it on a cold start
+def _new_bigquery_client(project):
+    from google.cloud import bigquery
+
+    return bigquery.Client(project=project)
+
+
+# The storage client reads the last-timestamp index (gcs backend)
+def _new_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+# Constructors of the clients, replaced by the offline harness (harness/)
+CLIENT_FACTORIES = {"bigquery": _new_bigquery_client, "storage": _new_storage_client}
+
+# Clients created on first use and reused by warm invocations: project -> BigQuery client,
+# "storage" -> storage client
+_clients = {}
+
+
+def get_bigquery_client(project):
+    if project not in _clients:
+        _clients[project] = CLIENT_FACTORIES["bigquery"](project=project)
+    return _clients[project]
+
+
+def get_storage_client():
+    if "storage" not in _clients:
+        _clients["storage"] = CLIENT_FACTORIES["storage"]()
+    return _clients["storage"]
+
+
+state_store.set_storage_client_factory(get_storage_client)
+
+
+def query_max_timestamps(client, table_full_name, experiment_names, lookback_days=None):
+    """
+    Returns {experiment_name: 'YYYY-MM-DD HH:MM:SS'} for the experiments that have rows in the table,
+    optionally only looking at the partitions of the last lookback_days days.
+    """
+    from google.cloud import bigquery
+
+    time_filter = ""
+    query_params = [
+        bigquery.ArrayQueryParameter("experiment_names", "STRING", experiment_names)
+    ]
+    if lookback_days:
+        time_filter = "AND TimeStamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @lookback_days DAY)"
+        query_params.append(bigquery.ScalarQueryParameter("lookback_days", "INT64", lookback_days))
+
+    query = f"""
+    SELECT 
+        ExperimentData_Exp_name AS experiment_name,
+        MAX(TimeStamp) AS last_timestamp
+    FROM `{table_full_name}`
+    WHERE ExperimentData_Exp_name IN UNNEST(@experiment_names)
+    {time_filter}
+    GROUP BY ExperimentData_Exp_name
+    """
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_params)
+    with metrics.timed_call("bigquery.query"):
+        results = client.query(query, job_config=job_config).result()
+
+    return {
+        row["experiment_name"]: row["last_timestamp"].strftime('%Y-%m-%d %H:%M:%S')
+        for row in results
+        if row["last_timestamp"]
+    }
+
+
+@metrics.instrumented("query_last_timestamp")
 def query_last_timestamp(request):
     """
     Google Cloud Function to query BigQuery and return the last timestamps for specific experiments.
@@ -29,49 +111,53 @@ def query_last_timestamp(request):
         print("Step 2: Missing required parameters!")  # Debugging
         return "Missing required parameters: owner (dataset_id), mac_address (table_name), or experiment_names.", 400
 
-    # Step 3: Initialize BigQuery client
-    print("Step 3: Initializing BigQuery client...")
     project_id = "iucc-f4d"
-    # print("Step 3: Using project_id:", project_id)
-    client = bigquery.Client(project=project_id)
+
+    # Step 3: Read the last-timestamp index maintained by process_files
+    print("Step 3: Reading the last-timestamp index...")
+    try:
+        with metrics.timed_call("index.get"):
+            cached_timestamps = last_timestamp_index.get_last_timestamps(dataset_id, mac_address, experiment_names)
+    except Exception as e:
+        print("Step 3: Could not read the last-timestamp index:", str(e))
+        cached_timestamps = {}
+    missing_experiments = [name for name in experiment_names if name not in cached_timestamps]
+    metrics.count("experiments", len(experiment_names))
+    metrics.count("index_hits", len(cached_timestamps))
 
     # Step 4: Initialize response dictionary
     print("Step 4: Initializing response dictionary...")
     response_data = {}
 
     try:
-        # Step 5: Loop through each experiment name and query BigQuery
+        last_timestamps = {}
+        if missing_experiments:
+            # Get the BigQuery client only for the experiments missing from the index
+            client = get_bigquery_client(project_id)
+
+            # Step 5: Query the last timestamp of the recent partitions in a single grouped query
+            table_full_name = f"{project_id}.{dataset_id}.{mac_address}"
+            print(f"Step 5: Processing experiment_names: {missing_experiments}...")
+            last_timestamps = query_max_timestamps(
+                client, table_full_name, missing_experiments, LAST_TIMESTAMP_LOOKBACK_DAYS)
+
+            # Step 6: Experiments without recent rows need a query over the whole table
+            older_experiments = [name for name in missing_experiments if name not in last_timestamps]
+            if older_experiments and LAST_TIMESTAMP_LOOKBACK_DAYS:
+                print(f"Step 6: Querying the whole table for: {older_experiments}...")
+                last_timestamps.update(query_max_timestamps(client, table_full_name, older_experiments))
+
+            # Step 7: Back-fill the index
+            try:
+                with metrics.timed_call("index.put"):
+                    last_timestamp_index.record_last_timestamps(dataset_id, mac_address, last_timestamps)
+            except Exception as e:
+                print("Step 7: Could not back-fill the last-timestamp index:", str(e))
+
+        # Experiments without rows are reported as 0
+        last_timestamps.update(cached_timestamps)
         for experiment_name in experiment_names:
-            print(f"Step 5: Processing experiment_name: {experiment_name}...")
-            query = f"""
-            SELECT 
-                MAX(TimeStamp) AS last_timestamp
-            FROM `{project_id}.{dataset_id}.{mac_address}`
-            WHERE ExperimentData_Exp_name = @experiment_name
-            """
-            # print("Step 5: Generated query:", query)
-
-            query_params = [
-                bigquery.ScalarQueryParameter("experiment_name", "STRING", experiment_name)
-            ]
-            # print("Step 5: Query parameters for", experiment_name, ":", query_params or "None")
-
-            job_config = bigquery.QueryJobConfig(query_parameters=query_params)
-
-            # Step 6: Execute the query
-            print(f"Step 6: Executing query for {experiment_name}...")
-            query_job = client.query(query, job_config=job_config)
-            results = query_job.result()
-            # print(f"Step 6: Query executed successfully for {experiment_name}!")
-
-            # Step 7: Process query results
-            for row in results:
-                # print(f"Step 7: Row retrieved for {experiment_name}:", row or "No data found")
-                timestamp = row["last_timestamp"]
-                if timestamp:
-                    response_data[experiment_name] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    response_data[experiment_name] = 0
+            response_data[experiment_name] = last_timestamps.get(experiment_name, 0)
 
         # Step 8: Finalize and return response
         print("Step 8: Final response data:", json.dumps(response_data))
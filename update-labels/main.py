@@ -1,10 +1,73 @@
 import functions_framework
 from google.cloud import bigquery
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from flask import make_response
 import json
+import os
+import time
+from collections import deque
+import metrics
+
+# "incremental" only updates the label groups that received new rows since the last run,
+# "full" rewrites every table with build_full_query
+LABELS_MODE = os.environ.get("LABELS_MODE", "incremental")
+
+# Table label holding the InsertDate watermark (epoch microseconds) of the last incremental run
+WATERMARK_LABEL = "labels_watermark"
+
+# Rows newer than this are still in the streaming buffer, where DML cannot update them;
+# they are picked up by the next run
+STREAMING_BUFFER_DELAY = timedelta(minutes=int(os.environ.get("LABELS_STREAMING_DELAY_MINUTES", 90)))
+
+# Rows inserted slightly before the watermark may become visible after it was taken,
+# so every run re-reads this window before the watermark
+WATERMARK_OVERLAP = timedelta(minutes=int(os.environ.get("LABELS_WATERMARK_OVERLAP_MINUTES", 10)))
+
+# Job scheduling: label-update queries running at once, seconds between completion polls,
+# seconds after which no new job is submitted (keep it below the function timeout), and
+# extra seconds to wait for the running jobs after that
+LABELS_MAX_CONCURRENT_JOBS = int(os.environ.get("LABELS_MAX_CONCURRENT_JOBS", 20))
+LABELS_POLL_SECONDS = float(os.environ.get("LABELS_POLL_SECONDS", 2))
+LABELS_TIME_BUDGET_SECONDS = float(os.environ.get("LABELS_TIME_BUDGET_SECONDS", 420))
+LABELS_DRAIN_SECONDS = float(os.environ.get("LABELS_DRAIN_SECONDS", 60))
+
+# Optional gs://bucket/path.json where the tables completed in the current pass are saved,
+# so an invocation that is cut short is resumed by the next one
+LABELS_CHECKPOINT_URI = os.environ.get("LABELS_CHECKPOINT_URI")
+
+
+def _new_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+# Constructors of the Google clients, replaced by the offline harness (harness/)
+CLIENT_FACTORIES = {"bigquery": bigquery.Client, "storage": _new_storage_client}
+
+# Clients created on first use and reused by warm invocations
+_clients = {}
+
+
+def get_client(kind):
+    if kind not in _clients:
+        _clients[kind] = CLIENT_FACTORIES[kind]()
+    return _clients[kind]
+
+# Returns the max_concurrent of a request as an integer of at least 1, or None when it is not one
+# (booleans, fractions and text other than an integer are refused)
+def parse_max_concurrent(value):
+    if isinstance(value, (bool, float)):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 1 else None
+
 
 @functions_framework.http
+@metrics.instrumented("update-labels")
 def hello_http(request):
     """HTTP Cloud Function.
     Args:
@@ -16,83 +79,309 @@ def hello_http(request):
         <https://flask.palletsprojects.com/en/1.1.x/api/#flask.make_response>.
     """
 
-    update_labels()
-    # Construct a response
-    response_data = {"message": "Hello, Cloud Function!"}
-    response = make_response(response_data, 200)
+    request_json = request.get_json(silent=True) or {}
+    max_concurrent = parse_max_concurrent(request_json.get("max_concurrent", LABELS_MAX_CONCURRENT_JOBS))
+    if max_concurrent is None:
+        response = make_response({"error": "max_concurrent must be an integer of at least 1."}, 400)
+        response.headers["Content-Type"] = "application/json"
+        return response
+    summary = update_labels(request_json.get("mode", LABELS_MODE), max_concurrent=max_concurrent)
+    # Construct a response with the status and duration of every table
+    response = make_response(summary, 200 if not summary.get("error") else 500)
     response.headers["Content-Type"] = "application/json"
 
     return response
 
 
 
-def execute_query(dataset_id, table_id):
-    try:
-        # Create a BigQuery client
-        client = bigquery.Client()
-
-        # Define the full table name
-        table_full_name = f"`{dataset_id}.{table_id}`"
-
-        # Define the query
-        query = f"""
-        CREATE OR REPLACE TABLE {table_full_name} AS
-        WITH LatestSensorData AS (
-          SELECT 
-            MetaData_LLA,
-            ExperimentData_Exp_name,
-            SensorData_Labels,
-            SensorData_LabelOptions,
-            InsertDate,
-            ROW_NUMBER() OVER (PARTITION BY MetaData_LLA, ExperimentData_Exp_name ORDER BY InsertDate DESC) AS rn
-          FROM 
-            {table_full_name}
-          WHERE
-            SensorData_Labels IS NOT NULL
-            AND SensorData_LabelOptions IS NOT NULL
-        )
-
-        SELECT 
-          t.* REPLACE(
-            lsd.SensorData_Labels AS SensorData_Labels,
-            lsd.SensorData_LabelOptions AS SensorData_LabelOptions
-          )
-        FROM {table_full_name} AS t
-        LEFT JOIN LatestSensorData AS lsd
-        ON t.MetaData_LLA = lsd.MetaData_LLA
-          AND t.ExperimentData_Exp_name = lsd.ExperimentData_Exp_name
-          AND lsd.rn = 1;
-        """
-
-        # Execute the query
-        query_job = client.query(query)
-
-        # Wait for the job to complete
+# Returns the PARTITION BY / CLUSTER BY clauses of a table, which CREATE OR REPLACE must repeat
+# (BigQuery refuses to replace a table with a different partitioning spec)
+def table_layout_clause(table):
+    clauses = []
+    if table.time_partitioning is not None and table.time_partitioning.field:
+        clauses.append(f"PARTITION BY TIMESTAMP_TRUNC({table.time_partitioning.field}, {table.time_partitioning.type_})")
+    if table.clustering_fields:
+        clauses.append(f"CLUSTER BY {', '.join(table.clustering_fields)}")
+    return "\n    ".join(clauses)
+
+
+# Builds the query that rewrites the whole table with the latest labels of each group
+def build_full_query(table_full_name, layout_clause=""):
+    return f"""
+    CREATE OR REPLACE TABLE {table_full_name}
+    {layout_clause}
+    AS
+    WITH LatestSensorData AS (
+      SELECT 
+        MetaData_LLA,
+        ExperimentData_Exp_name,
+        SensorData_Labels,
+        SensorData_LabelOptions,
+        InsertDate,
+        ROW_NUMBER() OVER (PARTITION BY MetaData_LLA, ExperimentData_Exp_name ORDER BY InsertDate DESC) AS rn
+      FROM 
+        {table_full_name}
+      WHERE
+        SensorData_Labels IS NOT NULL
+        AND SensorData_LabelOptions IS NOT NULL
+    )
+
+    SELECT 
+      t.* REPLACE(
+        lsd.SensorData_Labels AS SensorData_Labels,
+        lsd.SensorData_LabelOptions AS SensorData_LabelOptions
+      )
+    FROM {table_full_name} AS t
+    LEFT JOIN LatestSensorData AS lsd
+    ON t.MetaData_LLA = lsd.MetaData_LLA
+      AND t.ExperimentData_Exp_name = lsd.ExperimentData_Exp_name
+      AND lsd.rn = 1;
+    """
+
+
+# Returns the InsertDate watermark stored on the table, or the epoch if the table was never processed
+def get_watermark(table):
+    value = (table.labels or {}).get(WATERMARK_LABEL)
+    if not value:
+        return datetime.fromtimestamp(0, timezone.utc)
+    return datetime.fromtimestamp(0, timezone.utc) + timedelta(microseconds=int(value))
+
+
+def set_watermark(client, table, watermark):
+    epoch = datetime.fromtimestamp(0, timezone.utc)
+    micros = (watermark - epoch) // timedelta(microseconds=1)
+    table.labels = {**(table.labels or {}), WATERMARK_LABEL: str(micros)}
+    with metrics.timed_call("bigquery.update_table"):
+        client.update_table(table, ["labels"])
+
+
+# Builds the incremental label update script for one table. New rows are those with
+# InsertDate > @watermark; since they are newer than every older row, the latest labels of each
+# (MetaData_LLA, ExperimentData_Exp_name) group are always found among them. Only the groups with
+# new rows are merged, and only rows whose labels differ are updated.
+def build_incremental_query(table_full_name):
+    return f"""
+    DECLARE new_watermark TIMESTAMP DEFAULT (
+      SELECT MAX(InsertDate)
+      FROM {table_full_name}
+      WHERE InsertDate > @watermark AND InsertDate <= @cutoff
+    );
+
+    IF new_watermark IS NOT NULL THEN
+      MERGE {table_full_name} AS t
+      USING (
+        SELECT
+          MetaData_LLA,
+          ExperimentData_Exp_name,
+          SensorData_Labels,
+          SensorData_LabelOptions
+        FROM
+          {table_full_name}
+        WHERE
+          InsertDate > @window_start
+          AND InsertDate <= @cutoff
+          AND SensorData_Labels IS NOT NULL
+          AND SensorData_LabelOptions IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY MetaData_LLA, ExperimentData_Exp_name ORDER BY InsertDate DESC) = 1
+      ) AS lsd
+      ON t.MetaData_LLA = lsd.MetaData_LLA
+        AND t.ExperimentData_Exp_name = lsd.ExperimentData_Exp_name
+      WHEN MATCHED AND t.InsertDate <= @cutoff AND (
+        TO_JSON_STRING(t.SensorData_Labels) != TO_JSON_STRING(lsd.SensorData_Labels)
+        OR TO_JSON_STRING(t.SensorData_LabelOptions) != TO_JSON_STRING(lsd.SensorData_LabelOptions)
+      ) THEN
+        UPDATE SET
+          SensorData_Labels = lsd.SensorData_Labels,
+          SensorData_LabelOptions = lsd.SensorData_LabelOptions;
+
+      -- The LEFT JOIN of the full rewrite clears the labels of rows without a group key
+      UPDATE {table_full_name}
+      SET SensorData_Labels = [], SensorData_LabelOptions = []
+      WHERE InsertDate > @window_start
+        AND InsertDate <= @cutoff
+        AND (MetaData_LLA IS NULL OR ExperimentData_Exp_name IS NULL)
+        AND (ARRAY_LENGTH(SensorData_Labels) > 0 OR ARRAY_LENGTH(SensorData_LabelOptions) > 0);
+    END IF;
+
+    SELECT new_watermark AS new_watermark;
+    """
+
+
+# Starts the incremental label update of one table. Returns the query job and the function
+# that finishes it once the job is done (moves the watermark, returns True if there were new rows).
+def submit_incremental_query(client, dataset_id, table_id):
+    with metrics.timed_call("bigquery.get_table"):
+        table = client.get_table(f"{dataset_id}.{table_id}")
+    watermark = get_watermark(table)
+    cutoff = datetime.now(timezone.utc) - STREAMING_BUFFER_DELAY
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("watermark", "TIMESTAMP", watermark),
+        bigquery.ScalarQueryParameter("window_start", "TIMESTAMP", watermark - WATERMARK_OVERLAP),
+        bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", cutoff),
+    ])
+    with metrics.timed_call("bigquery.query_submit"):
+        query_job = client.query(build_incremental_query(f"`{dataset_id}.{table_id}`"), job_config=job_config)
+
+    def finish(query_job):
+        rows = list(query_job.result())
+        new_watermark = rows[0]["new_watermark"] if rows else None
+        if new_watermark is None:
+            print(f"Table `{dataset_id}.{table_id}` has no new rows since {watermark.isoformat()}.")
+            return False
+
+        # The MERGE changed the table, so the etag of the table read before it is out of date and
+        # updating the labels of that copy would fail with 412 Precondition Failed
+        with metrics.timed_call("bigquery.get_table"):
+            updated_table = client.get_table(f"{dataset_id}.{table_id}")
+        set_watermark(client, updated_table, new_watermark)
+        print(f"Table `{dataset_id}.{table_id}` labels updated up to {new_watermark.isoformat()}.")
+        return True
+
+    return query_job, finish
+
+
+# Starts the full rewrite of one table, same contract as submit_incremental_query
+def submit_full_query(client, dataset_id, table_id):
+    with metrics.timed_call("bigquery.get_table"):
+        table = client.get_table(f"{dataset_id}.{table_id}")
+    with metrics.timed_call("bigquery.query_submit"):
+        query_job = client.query(build_full_query(f"`{dataset_id}.{table_id}`", table_layout_clause(table)))
+
+    def finish(query_job):
         query_job.result()
+        print(f"Table `{dataset_id}.{table_id}` has been updated successfully.")
+        return True
 
-        print(f"Table `{table_full_name}` has been updated successfully.")
+    return query_job, finish
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+
+# Reads the tables completed in the current pass from LABELS_CHECKPOINT_URI
+def load_checkpoint(mode):
+    if not LABELS_CHECKPOINT_URI:
+        return set()
+    blob = _checkpoint_blob()
+    if not blob.exists():
+        return set()
+    checkpoint = json.loads(blob.download_as_text())
+    if checkpoint.get("mode") != mode:
+        return set()
+    return set(checkpoint.get("completed", []))
+
+
+def save_checkpoint(mode, completed):
+    if LABELS_CHECKPOINT_URI:
+        _checkpoint_blob().upload_from_string(
+            json.dumps({"mode": mode, "completed": sorted(completed)}), content_type="application/json")
 
 
-def update_labels():
+def clear_checkpoint():
+    if LABELS_CHECKPOINT_URI:
+        blob = _checkpoint_blob()
+        if blob.exists():
+            blob.delete()
+
+
+def _checkpoint_blob():
+    bucket_name, _, path = LABELS_CHECKPOINT_URI[len("gs://"):].partition("/")
+    return get_client("storage").bucket(bucket_name).blob(path)
+
+
+# Runs the label-update jobs of the given tables with at most max_concurrent jobs at once.
+# No job is submitted after the deadline; running jobs are waited for until drain_deadline.
+# Returns {table: {"status", "duration", ...}} and calls on_done(table) for each completed table.
+def schedule_label_jobs(client, tables, mode, max_concurrent, deadline, drain_deadline, on_done=None):
+    submit = submit_full_query if mode == "full" else submit_incremental_query
+    pending = deque(tables)
+    running = {}
+    results = {}
+
+    while pending or running:
+        # Fill the free slots
+        while pending and len(running) < max_concurrent and time.time() < deadline:
+            table_name = pending.popleft()
+            dataset_id, table_id = table_name.split(".", 1)
+            started = time.time()
+            try:
+                query_job, finish = submit(client, dataset_id, table_id)
+                running[table_name] = (query_job, finish, started)
+            except Exception as e:
+                results[table_name] = {"status": "failed", "duration": time.time() - started, "error": str(e)}
+
+        if not running or time.time() > drain_deadline:
+            break
+
+        time.sleep(LABELS_POLL_SECONDS)
+
+        # Collect the finished jobs
+        for table_name, (query_job, finish, started) in list(running.items()):
+            try:
+                if not query_job.done():
+                    continue
+                status = "updated" if finish(query_job) else "no_new_rows"
+                results[table_name] = {"status": status, "duration": time.time() - started}
+                # Job time from submission to completion, as seen by the polling loop
+                metrics.record_call("bigquery.label_job", results[table_name]["duration"])
+                if on_done:
+                    on_done(table_name)
+            except Exception as e:
+                results[table_name] = {"status": "failed", "duration": time.time() - started, "error": str(e)}
+            del running[table_name]
+
+    for table_name, (query_job, finish, started) in running.items():
+        results[table_name] = {"status": "running", "duration": time.time() - started, "job_id": query_job.job_id}
+    for table_name in pending:
+        results[table_name] = {"status": "pending"}
+
+    return results
+
+
+# Updates the labels of every table in the project and returns a JSON-serializable summary
+def update_labels(mode=LABELS_MODE, max_concurrent=LABELS_MAX_CONCURRENT_JOBS):
+    start_time = time.time()
+    summary = {"mode": mode, "tables": {}}
     try:
-        # Create a BigQuery client
-        client = bigquery.Client()
+        # BigQuery client shared by the invocations of this instance
+        client = get_client("bigquery")
 
-        # Iterate over all datasets in the project
-        datasets = client.list_datasets()
-        for dataset in datasets:
-            dataset_id = dataset.dataset_id
+        # Collect all tables of all datasets in the project
+        tables = []
+        with metrics.stage("list_tables"):
+            for dataset in client.list_datasets():
+                dataset_id = dataset.dataset_id
+                for table in client.list_tables(dataset_id):
+                    tables.append(f"{dataset_id}.{table.table_id}")
+        tables.sort()
 
-            # Iterate over all tables in the dataset
-            tables = client.list_tables(dataset_id)
-            for table in tables:
-                table_id = table.table_id
+        # Resume the pass of an invocation that was cut short
+        completed = load_checkpoint(mode)
+        for table_name in tables:
+            if table_name in completed:
+                summary["tables"][table_name] = {"status": "done_in_previous_invocation"}
 
-                # Call execute_query for each dataset and table
-                execute_query(dataset_id, table_id)
+        def on_done(table_name):
+            completed.add(table_name)
+            save_checkpoint(mode, completed)
+
+        deadline = start_time + LABELS_TIME_BUDGET_SECONDS
+        with metrics.stage("label_jobs"):
+            summary["tables"].update(schedule_label_jobs(
+                client, [table_name for table_name in tables if table_name not in completed], mode,
+                max_concurrent, deadline, deadline + LABELS_DRAIN_SECONDS, on_done,
+            ))
+
+        statuses = [result["status"] for result in summary["tables"].values()]
+        for status in statuses:
+            metrics.count(f"tables_{status}")
+        summary["incomplete"] = sum(status in ("pending", "running") for status in statuses)
+        summary["failed"] = statuses.count("failed")
+        if not summary["incomplete"]:
+            # The pass is over, the next invocation starts from the beginning
+            clear_checkpoint()
 
     except Exception as e:
-        print(f"An error occurred while updating labels: {e}")
\ No newline at end of file
+        summary["error"] = str(e)
+        print(f"An error occurred while updating labels: {e}")
+
+    summary["duration"] = time.time() - start_time
+    return summary
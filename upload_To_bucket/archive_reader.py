@@ -0,0 +1,68 @@
+"""
+Finds archived records in the destination bucket, in either archive mode.
+
+    python archive_reader.py OWNER MAC_ADDRESS EXP_NAME UNIQUE_ID
+
+Looks for the per-record object {UniqueID}.json first, then scans the grouped
+group-*.ndjson.gz objects of the owner/MAC/experiment folder and prints the record.
+"""
+import argparse
+import gzip
+import json
+
+from google.cloud.exceptions import NotFound
+
+from main import GROUP_OBJECT_PREFIX, GROUP_OBJECT_SUFFIX, get_bucket
+
+
+# Returns the record from a grouped object, or None. Lines are only parsed when they contain the id.
+def find_in_group(blob, unique_id):
+    # raw_download skips decompressive transcoding, the object is gunzipped here
+    contents = gzip.decompress(blob.download_as_bytes(raw_download=True))
+    needle = unique_id.encode("utf-8")
+    for line in contents.splitlines():
+        if needle in line:
+            json_obj = json.loads(line)
+            if json_obj.get("UniqueID") == unique_id:
+                return json_obj
+    return None
+
+
+# Returns (object name, record) for a UniqueID, or (None, None) when it is not archived
+def find_record(owner, mac_address, exp_name, unique_id, bucket=None):
+    bucket = bucket or get_bucket()
+    folder_path = f"{owner}/{mac_address}/{exp_name}/"
+
+    blob = bucket.blob(f"{folder_path}{unique_id}.json")
+    try:
+        return blob.name, json.loads(blob.download_as_bytes())
+    except NotFound:
+        pass
+
+    for blob in bucket.client.list_blobs(bucket, prefix=folder_path + GROUP_OBJECT_PREFIX):
+        if not blob.name.endswith(GROUP_OBJECT_SUFFIX):
+            continue
+        json_obj = find_in_group(blob, unique_id)
+        if json_obj is not None:
+            return blob.name, json_obj
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("owner")
+    parser.add_argument("mac_address")
+    parser.add_argument("exp_name")
+    parser.add_argument("unique_id")
+    args = parser.parse_args()
+
+    name, json_obj = find_record(args.owner, args.mac_address, args.exp_name, args.unique_id)
+    if json_obj is None:
+        print(f"{args.unique_id} not found.")
+        raise SystemExit(1)
+    print(f"Found in {name}:")
+    print(json.dumps(json_obj, indent=4))
+
+
+if __name__ == "__main__":
+    main()
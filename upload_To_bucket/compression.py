@@ -0,0 +1,148 @@
+# Compressed transport between the uploads, process_files and upload_To_bucket: gzip (standard
+# library) and zstd (the zstandard package, imported when first used) bodies and files.
+# This file is shared by both functions and must be kept identical in process_files/ and
+# upload_To_bucket/.
+#
+# Encodings are named like the Content-Encoding header: "gzip", "zstd", or None for plain data
+# ("identity" and "" are read as None).
+import gzip
+import io
+import sys
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# File extensions of compressed uploads
+EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+
+ENCODINGS = ("gzip", "zstd")
+
+# Default levels, picked for transport: gzip 1 costs a third of the CPU of level 6 for a
+# somewhat larger body, zstd 3 is faster than both and close to gzip 6 in size
+DEFAULT_LEVELS = {"gzip": 1, "zstd": 3}
+
+
+class DecompressionError(ValueError):
+    pass
+
+
+class UnsupportedEncodingError(ValueError):
+    pass
+
+
+def _zstd():
+    import zstandard
+
+    return zstandard
+
+
+# Returns "gzip", "zstd" or None for a Content-Encoding header value
+def normalize_encoding(content_encoding):
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    if encoding == "x-gzip":
+        return "gzip"
+    if encoding not in ENCODINGS:
+        raise UnsupportedEncodingError(f"Unsupported content encoding {content_encoding}, expected one of {ENCODINGS}")
+    return encoding
+
+
+# Encoding of a body or file: its Content-Encoding when given, else the extension of its name,
+# else its first bytes
+def detect_encoding(content_encoding=None, name=None, head=b""):
+    encoding = normalize_encoding(content_encoding)
+    if encoding:
+        return encoding
+    for extension, encoding in EXTENSIONS.items():
+        if name and name.lower().endswith(extension):
+            return encoding
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+# Exceptions of the decompressors on corrupt or truncated data. Not OSError as a whole, which
+# would also catch the connection errors of the stream being read.
+def _errors():
+    errors = (gzip.BadGzipFile, EOFError, zlib.error)
+    if "zstandard" in sys.modules:
+        errors += (sys.modules["zstandard"].ZstdError,)
+    return errors
+
+
+def compress(data, encoding, level=None):
+    encoding = normalize_encoding(encoding)
+    if encoding is None:
+        return data
+    level = DEFAULT_LEVELS[encoding] if level is None else level
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    return _zstd().ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data, encoding):
+    encoding = normalize_encoding(encoding)
+    try:
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        if encoding == "zstd":
+            return _zstd().ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True).read()
+    except _errors() as e:
+        raise DecompressionError(f"Invalid {encoding} data: {e}") from e
+    return data
+
+
+# Binary stream over head followed by the rest of stream, for reading the magic bytes ahead
+class _PrefixedStream(io.RawIOBase):
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._head:
+            size = min(len(buffer), len(self._head))
+            buffer[:size] = self._head[:size]
+            self._head = self._head[size:]
+            return size
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Decompressing stream, raising DecompressionError on corrupt data and counting the bytes read
+class _DecompressedStream(io.RawIOBase):
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self._stream.read(len(buffer))
+        except _errors() as e:
+            raise DecompressionError(f"Invalid compressed data: {e}") from e
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+# Opens a binary stream of (maybe) compressed data for reading, decompressing it as it is read.
+# Returns (encoding, stream); stream.bytes_read counts the decompressed bytes.
+def open_decompressed(stream, content_encoding=None, name=None):
+    head = stream.read(len(ZSTD_MAGIC))
+    encoding = detect_encoding(content_encoding, name, head)
+    source = _PrefixedStream(head, stream)
+    if encoding == "gzip":
+        source = gzip.GzipFile(fileobj=source, mode="rb")
+    elif encoding == "zstd":
+        source = _zstd().ZstdDecompressor().stream_reader(source, read_across_frames=True)
+    return encoding, _DecompressedStream(source)
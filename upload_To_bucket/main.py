@@ -1,40 +1,132 @@
 import functions_framework
 import json
+import gzip
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
+import compression
+import metrics
 
 # Global parameter for the destination bucket
 destination_bucket = 'hu-post-process-bucket'
 
-def upload_files_to_gcs(json_list):
-    # Initialize the Cloud Storage client
-    client = storage.Client()
-    bucket = client.get_bucket(destination_bucket)
+# Number of uploads running at the same time for one request
+UPLOAD_MAX_WORKERS = int(os.environ.get("UPLOAD_MAX_WORKERS", 16))
 
+# "per_record": one {UniqueID}.json object per record
+# "grouped": one gzip NDJSON object per (Owner, MAC_address, Exp_name) group per request
+ARCHIVE_MODE = os.environ.get("ARCHIVE_MODE", "per_record")
+
+# Content-Encoding of the per_record objects: "gzip" (default) or "identity". Cloud Storage
+# serves gzip objects decompressed to clients that do not accept gzip (decompressive
+# transcoding), so readers of the {UniqueID}.json objects are unaffected. It only does so for
+# gzip, which is why zstd is not offered here.
+ARCHIVE_CONTENT_ENCODING = compression.normalize_encoding(os.environ.get("ARCHIVE_CONTENT_ENCODING", "gzip"))
+if ARCHIVE_CONTENT_ENCODING not in (None, "gzip"):
+    raise ValueError(f"ARCHIVE_CONTENT_ENCODING must be gzip or identity, not {ARCHIVE_CONTENT_ENCODING}")
+
+# Grouped objects are named group-{hash}.ndjson.gz, the hash covering the UniqueIDs they hold,
+# so a retried request overwrites its own objects instead of archiving the records twice
+GROUP_OBJECT_PREFIX = "group-"
+GROUP_OBJECT_SUFFIX = ".ndjson.gz"
+
+# Constructor of the storage client, replaced by the offline harness (harness/)
+CLIENT_FACTORIES = {"storage": storage.Client}
+
+# Client and bucket are created once per instance and reused by warm invocations
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bucket():
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            # bucket() does not call the API, unlike get_bucket()
+            _bucket = CLIENT_FACTORIES["storage"]().bucket(destination_bucket)
+    return _bucket
+
+
+# Returns (folder path, UniqueID) of a record, or None when a required field is missing
+def record_location(json_obj):
+    _id = json_obj.get('Owner', None)  # Using _id instead of oid
+    mac_address = json_obj.get('ExperimentData', {}).get('MAC_address', None)
+    exp_name = json_obj.get('ExperimentData', {}).get('Exp_name', None)
+    unique_id = json_obj.get('UniqueID', None)
+    if _id and mac_address and exp_name and unique_id:
+        return f"{_id}/{mac_address}/{exp_name}/", unique_id
+    return None
+
+
+def upload_record(bucket, folder_path, unique_id, json_obj):
+    full_path = f"{folder_path}{unique_id}.json"
+    file_content = json.dumps(json_obj, separators=(',', ':')).encode("utf-8")
+    blob = bucket.blob(full_path)
+    if ARCHIVE_CONTENT_ENCODING:
+        blob.content_encoding = ARCHIVE_CONTENT_ENCODING
+        file_content = compression.compress(file_content, ARCHIVE_CONTENT_ENCODING, level=6)
+    with metrics.timed_call("gcs.upload"):
+        blob.upload_from_string(file_content, content_type='application/json')
+    metrics.count("bytes_uploaded", len(file_content))
+    return full_path
+
+
+def group_object_name(folder_path, unique_ids):
+    digest = hashlib.sha1("\n".join(sorted(unique_ids)).encode("utf-8")).hexdigest()[:20]
+    return f"{folder_path}{GROUP_OBJECT_PREFIX}{digest}{GROUP_OBJECT_SUFFIX}"
+
+
+def upload_group(bucket, folder_path, records):
+    full_path = group_object_name(folder_path, [unique_id for unique_id, _ in records])
+    lines = "".join(json.dumps(json_obj, separators=(',', ':')) + "\n" for _, json_obj in records)
+    blob = bucket.blob(full_path)
+    blob.content_encoding = "gzip"
+    compressed = gzip.compress(lines.encode("utf-8"), compresslevel=6)
+    with metrics.timed_call("gcs.upload"):
+        blob.upload_from_string(compressed, content_type='application/x-ndjson')
+    metrics.count("bytes_uploaded", len(compressed))
+    return full_path
+
+
+# Uploads the records concurrently and returns the number of objects written.
+# Raises when any upload failed, after every other upload has finished.
+def upload_files_to_gcs(json_list, mode=None, max_workers=UPLOAD_MAX_WORKERS):
+    mode = mode or ARCHIVE_MODE
+    if mode not in ("per_record", "grouped"):
+        raise ValueError(f"Unknown archive mode {mode}, expected per_record or grouped")
+    bucket = get_bucket()
+
+    groups = {}
     for json_obj in json_list:
-        # Extract _id, MAC_address, Exp_name, and UniqueID
-        _id = json_obj.get('Owner', None)  # Using _id instead of oid
-        mac_address = json_obj.get('ExperimentData', {}).get('MAC_address', None)
-        exp_name = json_obj.get('ExperimentData', {}).get('Exp_name', None)
-        unique_id = json_obj.get('UniqueID', None)
-
-        # Only proceed if all required fields are available
-        if _id and mac_address and exp_name and unique_id:
-            # Define the folder path and file name
-            folder_path = f"{_id}/{mac_address}/{exp_name}/"
-            file_name = f"{unique_id}.json"
-            full_path = folder_path + file_name
-
-            # Convert the json_obj to a JSON string to upload as file content
-            file_content = json.dumps(json_obj, indent=4)
-
-            # Upload the file
-            blob = bucket.blob(full_path)
-            blob.upload_from_string(file_content, content_type='application/json')
-            #print(f"Uploaded file: {full_path}")
-        else:
+        location = record_location(json_obj)
+        if location is None:
             print("Missing required fields in JSON object, skipping upload.")
+            metrics.count("records_skipped")
+            continue
+        folder_path, unique_id = location
+        groups.setdefault(folder_path, []).append((unique_id, json_obj))
+
+    metrics.count("records", len(json_list))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if mode == "grouped":
+            futures = [executor.submit(upload_group, bucket, folder_path, records)
+                       for folder_path, records in groups.items()]
+        else:
+            futures = [executor.submit(upload_record, bucket, folder_path, unique_id, json_obj)
+                       for folder_path, records in groups.items()
+                       for unique_id, json_obj in records]
+
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    metrics.count("objects_written", len(futures) - len(errors))
+    if errors:
+        raise RuntimeError(f"{len(errors)} of {len(futures)} uploads failed, first error: {errors[0]!r}")
+    return len(futures)
+
 
 @functions_framework.http
+@metrics.instrumented("upload_To_bucket")
 def upload_json_to_gcs(request):
     """HTTP Cloud Function to upload JSON objects to GCS.
     Args:
@@ -43,8 +135,22 @@ def upload_json_to_gcs(request):
         A response indicating success or failure.
     """
     try:
+        # Bodies compressed by process_files (Content-Encoding gzip or zstd) are decompressed
+        # here, Flask leaves them as they are
+        try:
+            encoding = compression.normalize_encoding(request.headers.get("Content-Encoding"))
+        except ValueError as e:
+            return str(e), 415
+        metrics.count("request_bytes", request.content_length or 0)
+
         # Parse the incoming JSON data from the request
-        request_json = request.get_json(silent=True)
+        if encoding:
+            try:
+                request_json = json.loads(compression.decompress(request.get_data(), encoding))
+            except ValueError:
+                request_json = None
+        else:
+            request_json = request.get_json(silent=True)
 
         if request_json and isinstance(request_json, list):
             # Call the function to upload the files to GCS